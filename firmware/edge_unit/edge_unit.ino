@@ -8,6 +8,9 @@
  *   - K(Ping) / V(Version) / H(HW情報) / E(Error) 応答
  *   - P(Patlite): Core1がTSL2561を常時サンプリング（13ms/GAIN_1X + 1.5秒maxウィンドウ）
  *   - C(Current): Core1がMCP3208を~1kHzサンプリング → RMS計算 → 実電流値で応答
+ *   - A(All): 兼務ユニット向けに lux×3 + 電流を1フレームで応答（P/C 2往復 → 1往復）
+ *   - B(Bulk): Core1が1分ごとに max lux / 平均RMS をリングバッファ(240分)に記録し、
+ *              GWの取りこぼし分を「何分前から何件」で一括応答（欠測バックフィル用）
  *   - 初回起動時 E220 自動設定（DESIRED_ADDH 定数 + DIPから自動設定される ADDL に基づく）
  *   - DIPスイッチによるユニット種別判定
  *   - Core1/Core0 mutex_t コア間共有データ保護
@@ -145,6 +148,26 @@ static int64_t  g_current_sum_sq       = 0;
 static uint32_t g_current_count        = 0;
 static uint32_t g_current_window_start = 0;
 
+// ===== 分単位履歴リングバッファ（'B'バルク応答用） =====
+// Core1が1分ごとにスロットを確定し、Core0が'B'コマンドで読み出す（g_mutex で保護）
+static const uint16_t HIST_MINUTES       = 240;    // 4時間分（9B×240 ≈ 2.2KB）
+static const uint32_t HIST_SLOT_MS       = 60000;  // 1スロット = 1分
+static const uint8_t  HIST_MAX_PER_FRAME = 20;     // 6 + 20×9 + 2 = 188B ≤ E220パケット長200B
+struct MinuteRec {
+    uint16_t lux[3];   // 赤・黄・緑の1分間max [lux]
+    uint16_t cur;      // 1分間の平均RMS [0.01A]
+    uint8_t  flags;    // bit0=パトライト有効, bit1=電流有効, 0=未記録
+};
+static MinuteRec g_hist[HIST_MINUTES] = {};
+static uint16_t  g_hist_head    = 0;   // 次に確定するスロット位置
+static uint32_t  g_hist_slot_ms = 0;   // 集計中スロットの開始時刻 (millis)
+
+// 集計中スロット（Core1ローカル）
+static float    g_slot_lux[3]  = {};
+static bool     g_slot_lux_ok  = false;
+static float    g_slot_cur_sum = 0.0f;
+static uint32_t g_slot_cur_n   = 0;
+
 // ===== Pin Assignment (CLAUDE.md 準拠) =====
 static const uint8_t PIN_LORA_M0   =  2;
 static const uint8_t PIN_LORA_M1   =  3;
@@ -165,8 +188,8 @@ static const uint8_t PIN_LED_D1    = 28;
 
 // ===== Firmware Version =====
 static const uint8_t FW_MAJOR = 1;
-static const uint8_t FW_MINOR = 6;
-static const uint8_t FW_PATCH = 2;
+static const uint8_t FW_MINOR = 8;
+static const uint8_t FW_PATCH = 0;
 
 // ===== Error Codes =====
 static const uint8_t ERR_SENSOR_FAIL = 0x01;
@@ -437,7 +460,7 @@ static void hexDump(const char *label, const uint8_t *data, int len) {
 // ===== GWへのレスポンス送信 =====
 static void sendToGW(const uint8_t *payload, uint8_t len) {
     uint8_t header[3] = {0x00, 0x00, g_e220.channel};
-    uint8_t full[35];
+    uint8_t full[3 + 200];  // ヘッダ + E220最大パケット長（'B'バルク応答で最大188B）
     memcpy(full, header, 3);
     memcpy(full + 3, payload, len);
     hexDump("[TX]", full, 3 + len);
@@ -492,6 +515,42 @@ static void updatePatliteMax(uint8_t ch, float lux) {
     }
 }
 
+// ===== 分単位履歴: 集計・スロット確定（Core1から呼ぶ） =====
+static void histAddLux(uint8_t ch, float lux) {
+    if (lux > g_slot_lux[ch]) g_slot_lux[ch] = lux;
+    g_slot_lux_ok = true;
+}
+
+static void histAddCurrent(float rms) {
+    g_slot_cur_sum += rms;
+    g_slot_cur_n++;
+}
+
+static void histTick() {
+    uint32_t now = millis();
+    if (now - g_hist_slot_ms < HIST_SLOT_MS) return;
+
+    MinuteRec rec = {};
+    if (g_slot_lux_ok) {
+        rec.flags |= 0x01;
+        for (uint8_t ch = 0; ch < 3; ch++) rec.lux[ch] = luxToU16(g_slot_lux[ch]);
+    }
+    if (g_slot_cur_n > 0) {
+        rec.flags |= 0x02;
+        rec.cur = (uint16_t)(g_slot_cur_sum / (float)g_slot_cur_n * 100.0f);  // 0.01A単位
+    }
+    mutex_enter_blocking(&g_mutex);
+    g_hist[g_hist_head] = rec;
+    g_hist_head    = (g_hist_head + 1) % HIST_MINUTES;
+    g_hist_slot_ms = now;
+    mutex_exit(&g_mutex);
+
+    g_slot_lux[0] = g_slot_lux[1] = g_slot_lux[2] = 0.0f;
+    g_slot_lux_ok  = false;
+    g_slot_cur_sum = 0.0f;
+    g_slot_cur_n   = 0;
+}
+
 // ===== TSL2561 初期化（setup()内のCore0から呼ぶ） =====
 // USB差し込み時は電源立ち上がりが遅くタイミングによって初期化に失敗することがある。
 // 各チャンネルを最大3回リトライして確実に初期化する。
@@ -646,6 +705,93 @@ static void cmdCurrent() {
     Serial.printf("[C] Current: %.2f A\n", rms);
 }
 
+// 兼務ユニット用: lux×3 + 電流を1フレームで返す
+// FLAGS: bit0=パトライト値有効, bit1=電流値有効（無効側の値は0）
+static void cmdAll() {
+    if (!(g_unit_type & (UNIT_PATLITE | UNIT_CURRENT))) {
+        cmdError(ERR_SENSOR_FAIL);
+        return;
+    }
+    float local_max[3];
+    float rms;
+    bool  sensor_err;
+    mutex_enter_blocking(&g_mutex);
+    local_max[0] = g_shared.patlite_max[0];
+    local_max[1] = g_shared.patlite_max[1];
+    local_max[2] = g_shared.patlite_max[2];
+    rms          = g_shared.current_rms;
+    sensor_err   = g_shared.sensor_error;
+    mutex_exit(&g_mutex);
+
+    uint8_t  flags = 0;
+    uint16_t red = 0, yel = 0, grn = 0, cur = 0;
+    if ((g_unit_type & UNIT_PATLITE) && !sensor_err) {
+        flags |= 0x01;
+        red = luxToU16(local_max[0]);
+        yel = luxToU16(local_max[1]);
+        grn = luxToU16(local_max[2]);
+    }
+    if (g_unit_type & UNIT_CURRENT) {
+        flags |= 0x02;
+        cur = (uint16_t)(rms * 100.0f);  // 0.01A単位
+    }
+    if (flags == 0) { cmdError(ERR_SENSOR_FAIL); return; }
+
+    uint8_t resp[] = {
+        g_e220.addH, g_e220.addL, 'A', flags,
+        (uint8_t)(red >> 8), (uint8_t)(red & 0xFF),
+        (uint8_t)(yel >> 8), (uint8_t)(yel & 0xFF),
+        (uint8_t)(grn >> 8), (uint8_t)(grn & 0xFF),
+        (uint8_t)(cur >> 8), (uint8_t)(cur & 0xFF),
+        '\r', '\n'
+    };
+    sendToGW(resp, sizeof(resp));
+    onRxSuccess();
+    Serial.printf("[A] flags=0x%02X red=%.1f yel=%.1f grn=%.1f lux, %.2f A\n",
+                  flags, local_max[0], local_max[1], local_max[2], rms);
+}
+
+// 分単位履歴の一括読み出し
+// 要求: ['B'][AGO][COUNT]['\r']['\n']  AGO=1 が直前に確定した分、COUNT件を AGO から古い方向へ
+// 応答: [ADDR_H][ADDR_L]['B'][ELAPSED_S][AGO][N] + N×[R_H][R_L][Y_H][Y_L][G_H][G_L][CUR_H][CUR_L][FLAGS] + CRLF
+//   ELAPSED_S: 集計中スロットの経過秒（GWが各分の実時刻を逆算するため）
+static void cmdBulk(const uint8_t *buf, int len) {
+    if (len < 3) { cmdError(ERR_UNKNOWN_CMD); return; }
+    uint8_t ago   = buf[1];
+    uint8_t count = buf[2];
+    if (ago == 0 || ago > HIST_MINUTES) { cmdError(ERR_UNKNOWN_CMD); return; }
+    if (count > HIST_MAX_PER_FRAME)   count = HIST_MAX_PER_FRAME;
+    if (count > HIST_MINUTES - ago + 1) count = HIST_MINUTES - ago + 1;
+
+    uint8_t resp[6 + HIST_MAX_PER_FRAME * 9 + 2];
+    int     n = 0;
+    resp[n++] = g_e220.addH;
+    resp[n++] = g_e220.addL;
+    resp[n++] = 'B';
+    mutex_enter_blocking(&g_mutex);
+    uint32_t elapsed = (millis() - g_hist_slot_ms) / 1000;
+    resp[n++] = (uint8_t)(elapsed > 255 ? 255 : elapsed);
+    resp[n++] = ago;
+    resp[n++] = count;
+    for (uint8_t i = 0; i < count; i++) {
+        uint16_t idx = (g_hist_head + HIST_MINUTES - ago - i) % HIST_MINUTES;
+        const MinuteRec &rec = g_hist[idx];
+        for (uint8_t ch = 0; ch < 3; ch++) {
+            resp[n++] = (uint8_t)(rec.lux[ch] >> 8);
+            resp[n++] = (uint8_t)(rec.lux[ch] & 0xFF);
+        }
+        resp[n++] = (uint8_t)(rec.cur >> 8);
+        resp[n++] = (uint8_t)(rec.cur & 0xFF);
+        resp[n++] = rec.flags;
+    }
+    mutex_exit(&g_mutex);
+    resp[n++] = '\r';
+    resp[n++] = '\n';
+    sendToGW(resp, (uint8_t)n);
+    onRxSuccess();
+    Serial.printf("[B] Bulk: ago=%d count=%d (%d bytes)\n", ago, count, n);
+}
+
 // ===== OTA CRC ユーティリティ =====
 static uint16_t crc16_ccitt(const uint8_t *data, uint16_t len) {
     uint16_t crc = 0xFFFF;
@@ -1016,6 +1162,11 @@ static void processCommand() {
         if (Serial2.available()) {
             uint8_t b = Serial2.read();
             buf[len++] = b;
+            // 'B' 要求は AGO/COUNT がバイナリのため固定長(5B)で終了（CRLF誤検出を避ける）
+            if (buf[0] == 'B') {
+                if (len >= 5) break;
+                continue;
+            }
             // 先頭2バイト確定後にOTA DATAパケットを識別してタイムアウト延長
             if (len == 2 && buf[0] == 'U' && buf[1] == 'D') {
                 timeout      = 250;  // OTA DATAパケット用に延長
@@ -1047,6 +1198,8 @@ static void processCommand() {
         case 'H': cmdHwInfo();             break;
         case 'P': cmdPatlite();            break;
         case 'C': cmdCurrent();            break;
+        case 'A': cmdAll();                break;
+        case 'B': cmdBulk(buf, len);       break;
         case 'U': {
             if (len < 2) { cmdError(ERR_UNKNOWN_CMD); return; }
             char sub = (char)buf[1];
@@ -1778,6 +1931,7 @@ void setup1() {
     while (!g_setup_done) {
         tight_loop_contents();  // tud_task を呼ばない
     }
+    g_hist_slot_ms = millis();
 }
 
 void loop1() {
@@ -1801,6 +1955,7 @@ void loop1() {
             delay(2);
             g_tsl[ch]->getEvent(&event);
             updatePatliteMax(ch, event.light);
+            histAddLux(ch, event.light);
         }
         mutex_enter_blocking(&g_mutex);
         g_shared.patlite_max[0] = g_patlite_local_max[0];
@@ -1833,6 +1988,7 @@ void loop1() {
                 mutex_enter_blocking(&g_mutex);
                 g_shared.current_rms = current_rms;
                 mutex_exit(&g_mutex);
+                histAddCurrent(current_rms);
             }
             g_current_sum_sq       = 0;
             g_current_count        = 0;
@@ -1869,6 +2025,9 @@ void loop1() {
         // 兼務の場合: パトライトブロックでHB更新済み・TSL2561がレート制限(~45ms/cycle)
     }
 
+    // === 分単位履歴のスロット確定 ===
+    histTick();
+
     // === DIP未設定フォールバック ===
     if (!did_heartbeat) {
         mutex_enter_blocking(&g_mutex);
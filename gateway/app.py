@@ -1,36 +1,74 @@
-from flask import Flask, render_template, abort, send_file, redirect, url_for, jsonify, request
+from flask import (Flask, render_template, abort, send_file, redirect, url_for, jsonify,
+                   request, Response, make_response, stream_with_context, stream_template,
+                   g as flask_g)
 import csv
 import os
+import sys
 import struct
 import zlib
-import logging
-import logging.handlers
 import atexit
-from datetime import datetime, timedelta, time
+from datetime import datetime, timedelta, time, timezone
 import time as _time
 import threading
 import queue
 import uuid
+import re
+import json
+import hmac
+import hashlib
+import bisect
+import functools
+import gzip
+import io
+import shutil
+import zipfile
+import sqlite3
+import cProfile
+import pstats
+
+from gwlog import setup_logger
 
 try:
     import yaml
     HAS_YAML = True
 except ImportError:
     HAS_YAML = False
-    print("[config] pyyaml がインストールされていません。config.yaml は読み込まれません。")
 
 try:
     import serial
     HAS_SERIAL = True
 except ImportError:
     HAS_SERIAL = False
-    print("[E220] pyserial がインストールされていません。ポーリングを無効化します。")
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+try:
+    import brotli
+    HAS_BROTLI = True
+except ImportError:
+    HAS_BROTLI = False
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
 
 import matplotlib
 matplotlib.use('Agg')
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.font_manager as fm
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from calendar import monthrange
 
 
@@ -47,6 +85,22 @@ THRESHOLDS = {
 CURRENT_THRESHOLD = 3.0
 
 
+# ===== ログ設定 =====
+# 書き込みは gwlog のキュー経由（バックグラウンドスレッド）で行い、呼び出し側をブロックしない。
+
+LOG_DIR  = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+LOG_FILE = os.path.join(LOG_DIR, 'app.log')
+
+logger, _fh = setup_logger('gwapp', LOG_FILE)
+
+logger.info('アプリ起動')
+atexit.register(lambda: logger.info('アプリ終了'))
+if not HAS_YAML:
+    logger.warning('[config] pyyaml がインストールされていません。config.yaml は読み込まれません。')
+if not HAS_SERIAL:
+    logger.warning('[E220] pyserial がインストールされていません。ポーリングを無効化します。')
+
+
 # ===== 設定ロード =====
 
 def _parse_addr(v):
@@ -58,82 +112,363 @@ def _parse_addr(v):
     return int(str(v), 16)
 
 
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
+
+
+def _default_config():
+    return {
+        'serial_port': '/dev/ttyUSB0',
+        'serial_baud': 9600,
+        'gw_channel': 2,
+        'gw_addr': 0x0000,
+        'poll_interval_sec': 60,
+        'machines': []
+    }
+
+
+def _is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def read_config(path=CONFIG_PATH):
+    """
+    config.yaml を読んでアドレスを数値にし、検証する。
+    不正な箇所があれば ValueError（メッセージに問題点をすべて並べる）。
+    """
+    with open(path) as f:
+        cfg = yaml.safe_load(f)
+    if not isinstance(cfg, dict):
+        raise ValueError('トップレベルがマッピングではありません')
+    errors = []
+    try:
+        cfg['gw_addr'] = _parse_addr(cfg['gw_addr'])
+    except (KeyError, TypeError, ValueError):
+        errors.append('gw_addr がないか不正です')
+    if not _is_number(cfg.get('poll_interval_sec', 60)) or cfg.get('poll_interval_sec', 60) <= 0:
+        errors.append('poll_interval_sec は正の数にしてください')
+    machines = cfg.get('machines') or []
+    if not isinstance(machines, list):
+        errors.append('machines はリストにしてください')
+        machines = []
+    cfg['machines'] = machines
+    names, owners = set(), {}        # owners: {アドレス: 機械名}（兼務ユニットは同じ機械の中でだけ共有できる）
+    for i, m in enumerate(machines, start=1):
+        if not isinstance(m, dict) or not m.get('name'):
+            errors.append(f'machines の {i} 件目: name がありません')
+            continue
+        label = f"機械 {m['name']}"
+        if m['name'] in names:
+            errors.append(f'{label}: 名前が重複しています')
+        names.add(m['name'])
+        for key in ('patlite_addr', 'current_addr'):
+            try:
+                m[key] = _parse_addr(m[key])
+            except (KeyError, TypeError, ValueError):
+                errors.append(f'{label}: {key} がないか不正です')
+                continue
+            owner = owners.setdefault(m[key], m['name'])
+            if owner != m['name']:
+                errors.append(f'{label}: {key} 0x{m[key]:04X} が機械 {owner} のユニットと重複しています')
+        th = m.get('patlite_thresholds')
+        if th is not None and (not isinstance(th, dict) or set(th) != set(THRESHOLDS)
+                               or not all(_is_number(v) for v in th.values())):
+            errors.append(f'{label}: patlite_thresholds は red / yellow / green の数値にしてください')
+        if m.get('current_threshold') is not None and not _is_number(m['current_threshold']):
+            errors.append(f'{label}: current_threshold は数値にしてください')
+    if errors:
+        raise ValueError(' / '.join(errors))
+    return cfg
+
+
 def load_config(path=None):
+    """起動時の読み込み。ファイルがない・読めないときは既定値（機械なし）で起動する。"""
     if path is None:
-        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
+        path = CONFIG_PATH
     if not HAS_YAML or not os.path.exists(path):
-        return {
-            'serial_port': '/dev/ttyUSB0',
-            'serial_baud': 9600,
-            'gw_channel': 2,
-            'gw_addr': 0x0000,
-            'poll_interval_sec': 60,
-            'machines': []
-        }
+        return _default_config()
     try:
-        with open(path) as f:
-            cfg = yaml.safe_load(f)
-        for m in cfg.get('machines', []):
-            m['patlite_addr'] = _parse_addr(m['patlite_addr'])
-            m['current_addr']  = _parse_addr(m['current_addr'])
-        cfg['gw_addr'] = _parse_addr(cfg['gw_addr'])
-        return cfg
+        return read_config(path)
     except Exception as e:
-        print(f"[config] 設定ファイル読み込みエラー: {e}")
-        return {
-            'serial_port': '/dev/ttyUSB0',
-            'serial_baud': 9600,
-            'gw_channel': 2,
-            'gw_addr': 0x0000,
-            'poll_interval_sec': 60,
-            'machines': []
-        }
+        logger.error(f'[config] 設定ファイル読み込みエラー: {e}')
+        return _default_config()
 
 
 config = load_config()
 
 
-# ===== ログ設定 =====
+# ===== メトリクス =====
+# Prometheus テキスト形式で /metrics に公開する（外部ライブラリ不要の最小実装）。
+# ラベルはキーワード引数で渡す: metric_inc('gw_unit_timeouts_total', machine='A214', cmd='P')
 
-LOG_DIR  = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
-LOG_FILE = os.path.join(LOG_DIR, 'app.log')
-os.makedirs(LOG_DIR, exist_ok=True)
-
-_fh = logging.handlers.RotatingFileHandler(
-    LOG_FILE, maxBytes=2 * 1024 * 1024, backupCount=5, encoding='utf-8')
-_fh.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
-_ch = logging.StreamHandler()
-_ch.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
-logger = logging.getLogger('gwapp')
-logger.setLevel(logging.INFO)
-logger.addHandler(_fh)
-logger.addHandler(_ch)
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+POLL_CYCLE_BUCKETS = (1, 2, 5, 10, 20, 30, 40, 45, 50, 55, 60, 90, 120)
 
-logger.info('アプリ起動')
-atexit.register(lambda: logger.info('アプリ終了'))
+g_metrics      = {}   # {name: {'type', 'help', 'buckets', 'series': {labels: 値 or ヒストグラム}}}
+g_metrics_lock = threading.Lock()
+
+
+def metric_define(name, mtype, help_text, buckets=None):
+    """mtype: 'counter' / 'gauge' / 'histogram'"""
+    g_metrics[name] = {'type': mtype, 'help': help_text,
+                       'buckets': tuple(buckets or METRIC_BUCKETS), 'series': {}}
+
+
+def _metric_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def metric_inc(name, value=1, **labels):
+    key = _metric_key(labels)
+    with g_metrics_lock:
+        series = g_metrics[name]['series']
+        series[key] = series.get(key, 0) + value
+
+
+def metric_set(name, value, **labels):
+    key = _metric_key(labels)
+    with g_metrics_lock:
+        g_metrics[name]['series'][key] = value
+
+
+def metric_observe(name, value, **labels):
+    key = _metric_key(labels)
+    with g_metrics_lock:
+        m = g_metrics[name]
+        h = m['series'].get(key)
+        if h is None:
+            h = m['series'][key] = {'buckets': [0] * len(m['buckets']), 'sum': 0.0, 'count': 0}
+        # バケットは累積（le 以下の件数）で保持する
+        for i, le in enumerate(m['buckets']):
+            if value <= le:
+                h['buckets'][i] += 1
+        h['sum']   += value
+        h['count'] += 1
+
+
+def metrics_take():
+    """
+    counter / histogram の値を取り出して 0 に戻す（プロセスプールのワーカーで、親へ送る増分を作る）。
+    gauge はプロセスごとの値なので対象外。
+    """
+    with g_metrics_lock:
+        taken = {}
+        for name, m in g_metrics.items():
+            if m['type'] != 'gauge' and m['series']:
+                taken[name], m['series'] = m['series'], {}
+        return taken
+
+
+def metrics_merge(taken):
+    """metrics_take() の結果を足し込む"""
+    with g_metrics_lock:
+        for name, series in taken.items():
+            m = g_metrics[name]
+            for key, v in series.items():
+                if m['type'] != 'histogram':
+                    m['series'][key] = m['series'].get(key, 0) + v
+                    continue
+                h = m['series'].get(key)
+                if h is None:
+                    h = m['series'][key] = {'buckets': [0] * len(m['buckets']), 'sum': 0.0, 'count': 0}
+                h['buckets'] = [a + b for a, b in zip(h['buckets'], v['buckets'])]
+                h['sum']   += v['sum']
+                h['count'] += v['count']
+
+
+def _metric_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    esc = lambda v: v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in items) + '}'
+
+
+def render_metrics():
+    lines = []
+    with g_metrics_lock:
+        for name, m in g_metrics.items():
+            lines.append(f"# HELP {name} {m['help']}")
+            lines.append(f"# TYPE {name} {m['type']}")
+            for key, v in sorted(m['series'].items()):
+                if m['type'] != 'histogram':
+                    lines.append(f"{name}{_metric_labels(key)} {v}")
+                    continue
+                for le, cnt in zip(m['buckets'], v['buckets']):
+                    lines.append(f"{name}_bucket{_metric_labels(key, [('le', str(le))])} {cnt}")
+                lines.append(f"{name}_bucket{_metric_labels(key, [('le', '+Inf')])} {v['count']}")
+                lines.append(f"{name}_sum{_metric_labels(key)} {v['sum']:.6f}")
+                lines.append(f"{name}_count{_metric_labels(key)} {v['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+metric_define('gw_poll_cycle_seconds', 'histogram',
+              '1ポーリング周期（全機械）の所要時間', POLL_CYCLE_BUCKETS)
+metric_define('gw_poll_cycle_last_seconds', 'gauge', '直近のポーリング周期の所要時間')
+metric_define('gw_poll_interval_seconds', 'gauge', 'ポーリング周期の予算（poll_interval_sec）')
+metric_define('gw_unit_rtt_seconds', 'histogram', 'ユニットへのコマンド送信から応答受信までの時間')
+metric_define('gw_unit_timeouts_total', 'counter', 'ユニット応答タイムアウト回数')
+metric_define('gw_serial_tx_bytes_total', 'counter', 'E220へ書き込んだバイト数')
+metric_define('gw_serial_rx_bytes_total', 'counter', 'E220から読み込んだバイト数')
+metric_define('gw_cmd_queue_depth', 'gauge', 'メンテコマンドキュー（g_cmd_q）の滞留数')
+metric_define('gw_ota_bytes_total', 'counter', 'OTAで送信したファームウェアのバイト数')
+metric_define('gw_ota_throughput_bytes_per_second', 'gauge', '直近OTAジョブの実効スループット')
+metric_define('gw_render_seconds', 'histogram', 'matplotlib による画像1枚の描画時間')
+metric_define('gw_http_request_duration_seconds', 'histogram', 'ルートごとのリクエスト処理時間')
+metric_define('gw_sse_clients', 'gauge', '状態配信（SSE）の接続クライアント数')
+metric_define('gw_backfill_minutes_total', 'counter', 'エッジの履歴から回収した欠測分の数')
+metric_define('gw_backfill_pending_minutes', 'gauge', 'バックフィル待ちの欠測分の数')
+
+
+# ===== プロファイリング =====
+# config.yaml の profiling セクションで有効化する（既定は無効）。
+#   enabled: true  → 全リクエストを計測し slow_ms 超過分だけ保存
+#   secret 設定時  → ?profile=<profile_signature(path)> 付きのリクエストは常に保存
+#   poll: true     → ポーリング周期も計測し slow_ms 超過分を保存
+# 保存先は logs/profiles/（keep 件を超えた古いものから削除）。
+
+PROFILE_DIR = os.path.join(LOG_DIR, 'profiles')
+
+
+def _profiling_cfg():
+    return config.get('profiling') or {}
+
+
+def profile_signature(path):
+    """リクエストパスに対する署名（?profile= に渡す値）"""
+    secret = str(_profiling_cfg().get('secret', ''))
+    return hmac.new(secret.encode(), path.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def start_profile():
+    """cProfile を開始する。他の計測が動作中などで開始できない場合は None。"""
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError:
+        return None
+    return prof
+
+
+def save_profile(prof, kind, label, elapsed_sec, forced=False):
+    """計測を止め、slow_ms 以上（または forced）のときだけ .prof とメタ情報を保存する。"""
+    prof.disable()
+    cfg = _profiling_cfg()
+    elapsed_ms = int(elapsed_sec * 1000)
+    if not forced and elapsed_ms < int(cfg.get('slow_ms', 500)):
+        return None
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    safe  = re.sub(r'[^A-Za-z0-9_-]+', '_', label).strip('_')[:80] or 'root'
+    fname = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}_{kind}_{safe}.prof"
+    path  = os.path.join(PROFILE_DIR, fname)
+    prof.dump_stats(path)
+    with open(path + '.json', 'w', encoding='utf-8') as f:
+        json.dump({'kind': kind, 'label': label, 'elapsed_ms': elapsed_ms,
+                   'ts': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, f, ensure_ascii=False)
+
+    # 保存件数の上限管理
+    keep  = int(cfg.get('keep', 50))
+    profs = sorted(fn for fn in os.listdir(PROFILE_DIR) if fn.endswith('.prof'))
+    for old in profs[:-keep] if keep > 0 else profs:
+        for p in (old, old + '.json'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, p))
+            except FileNotFoundError:
+                pass
+    logger.info(f'プロファイル保存: {fname} ({elapsed_ms}ms)')
+    return fname
+
+
+def profile_top_functions(fname, limit=15):
+    """保存済みプロファイルを累積時間の降順で要約する。"""
+    st = pstats.Stats(os.path.join(PROFILE_DIR, fname))
+    rows = []
+    for (filename, lineno, func), (cc, nc, tt, ct, _) in st.stats.items():
+        rows.append({'func': f'{os.path.basename(filename)}:{lineno}({func})',
+                     'ncalls': nc, 'tottime': round(tt, 4), 'cumtime': round(ct, 4)})
+    rows.sort(key=lambda r: r['cumtime'], reverse=True)
+    return rows[:limit]
+
+
+# ===== 同時実行の一本化（single-flight） =====
+# 複数の画面が同じ月ページを同時に開いたときなどに、同じ画像・集計を並行して作らないようにする。
+# 同じ key の計算が実行中なら、後から来たスレッドはその完了を待って同じ結果（または例外）を受け取る。
+
+g_inflight      = {}   # {key: {'event': threading.Event, 'result', 'error'}}
+g_inflight_lock = threading.Lock()
+
+metric_define('gw_singleflight_shared_total', 'counter', '実行中の同じ計算の結果を待って共有した回数')
+
+
+def single_flight(key, fn, *args, **kwargs):
+    """key（先頭要素が種別のタプル）ごとに fn を1本だけ実行し、その結果を待機中の呼び出しと共有する"""
+    with g_inflight_lock:
+        call = g_inflight.get(key)
+        leader = call is None
+        if leader:
+            call = g_inflight[key] = {'event': threading.Event(), 'result': None, 'error': None}
+    if not leader:
+        metric_inc('gw_singleflight_shared_total', kind=key[0])
+        call['event'].wait()
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+    try:
+        call['result'] = fn(*args, **kwargs)
+        return call['result']
+    except BaseException as e:
+        call['error'] = e
+        raise
+    finally:
+        with g_inflight_lock:
+            del g_inflight[key]
+        call['event'].set()
 
 
 # ===== E220ドライバ =====
 
-def e220_send(ser, dest_addr, channel, cmd_char):
+def e220_send(ser, dest_addr, channel, cmd_char, args=b''):
     pkt = bytes([(dest_addr >> 8) & 0xFF, dest_addr & 0xFF,
-                 channel, ord(cmd_char), 0x0D, 0x0A])
+                 channel, ord(cmd_char)]) + bytes(args) + b'\r\n'
     ser.reset_input_buffer()
     ser.write(pkt)
+    metric_inc('gw_serial_tx_bytes_total', len(pkt))
 
 
-def e220_recv(ser, timeout_sec=2.5):
+def e220_recv(ser, timeout_sec=2.5, frame_len=None):
+    """
+    応答1フレームを受信する。通常は CRLF 終端で判定するが、バイナリ本体に CRLF が
+    現れ得る応答（'B'）は frame_len(buf) → 全長 or None（未確定）で長さ判定する。
+    """
     deadline = _time.time() + timeout_sec
     buf = bytearray()
     while _time.time() < deadline:
         if ser.in_waiting:
-            buf += ser.read(ser.in_waiting)
-            if len(buf) >= 3 and buf[-2] == 0x0D and buf[-1] == 0x0A:
+            chunk = ser.read(ser.in_waiting)
+            metric_inc('gw_serial_rx_bytes_total', len(chunk))
+            buf += chunk
+            if frame_len is not None:
+                n = frame_len(buf)
+                if n is not None and len(buf) >= n:
+                    return bytes(buf[:n])
+            elif len(buf) >= 3 and buf[-2] == 0x0D and buf[-1] == 0x0A:
                 return bytes(buf)
         _time.sleep(0.005)
     return None
 
 
+def e220_transact(ser, addr, cmd_char, machine_name, timeout_sec=2.5, args=b'', frame_len=None):
+    """1コマンド送信 → 応答受信。RTT とタイムアウト回数をメトリクスに記録する。"""
+    labels = {'machine': machine_name, 'addr': f'0x{addr:04X}', 'cmd': cmd_char}
+    t0 = _time.perf_counter()
+    e220_send(ser, addr, config['gw_channel'], cmd_char, args)
+    data = e220_recv(ser, timeout_sec=timeout_sec, frame_len=frame_len)
+    if data is None:
+        metric_inc('gw_unit_timeouts_total', **labels)
+    else:
+        metric_observe('gw_unit_rtt_seconds', _time.perf_counter() - t0, **labels)
+    return data
+
+
 def crc16_ccitt(data: bytes) -> int:
     """CRC16-CCITT (poly=0x1021, init=0xFFFF)"""
     crc = 0xFFFF
@@ -150,6 +485,7 @@ def e220_send_payload(ser, addr: int, ch: int, payload: bytes):
     addrL = addr & 0xFF
     packet = bytes([addrH, addrL, ch]) + payload
     ser.write(packet)
+    metric_inc('gw_serial_tx_bytes_total', len(packet))
     # AUX HIGH 待ち相当（200msポーリング）
     deadline = _time.time() + 2.0
     while _time.time() < deadline:
@@ -174,15 +510,1313 @@ def parse_current(data):
     return None
 
 
-# ===== CSV書き込み =====
+def parse_all(data):
+    # [ADDR_H][ADDR_L]['A'][FLAGS][R_H][R_L][Y_H][Y_L][G_H][G_L][CUR_H][CUR_L][CR][LF]
+    # FLAGS: bit0=パトライト値有効, bit1=電流値有効 → (lux or None, current or None)
+    if data and len(data) >= 12 and data[2] == ord('A'):
+        flags = data[3]
+        lux = ((data[4] << 8) | data[5],
+               (data[6] << 8) | data[7],
+               (data[8] << 8) | data[9]) if flags & 0x01 else None
+        amp = ((data[10] << 8) | data[11]) / 100.0 if flags & 0x02 else None
+        return lux, amp
+    return None
+
+
+def is_edge_error(data, code=None):
+    # [ADDR_H][ADDR_L]['E'][ERROR_CODE][CR][LF]
+    if not data or len(data) < 4 or data[2] != ord('E'):
+        return False
+    return code is None or data[3] == code
+
+
+EDGE_ERR_UNKNOWN_CMD = 0x02
+
+BULK_ENTRY_LEN = 9      # [R_H][R_L][Y_H][Y_L][G_H][G_L][CUR_H][CUR_L][FLAGS]
+BULK_MAX_COUNT = 20     # エッジ側 HIST_MAX_PER_FRAME（E220パケット長200B以内）
+BULK_HIST_MINUTES = 240 # エッジ側 HIST_MINUTES（これより古い欠測は回収不能）
+
+
+def bulk_frame_len(buf):
+    """'B' 応答の全長（ヘッダ6B + N×9B + CRLF）。エラー応答は6B固定。"""
+    if len(buf) < 3:
+        return None
+    if buf[2] == ord('E'):
+        return 6
+    if len(buf) < 6:
+        return None
+    return 6 + buf[5] * BULK_ENTRY_LEN + 2
+
 
-def write_sensor_csv(machine_name, red, yellow, green, current):
-    now  = datetime.now()
+def parse_bulk(data):
+    # [ADDR_H][ADDR_L]['B'][ELAPSED_S][AGO][N] + N×[R_H][R_L][Y_H][Y_L][G_H][G_L][CUR_H][CUR_L][FLAGS] + CRLF
+    # → (elapsed_s, ago, [(lux or None, current or None), ...])  entries[i] は (ago + i) 分前
+    if not data or len(data) < 6 or data[2] != ord('B'):
+        return None
+    elapsed, ago, n = data[3], data[4], data[5]
+    if len(data) < 6 + n * BULK_ENTRY_LEN:
+        return None
+    entries = []
+    for i in range(n):
+        e = data[6 + i * BULK_ENTRY_LEN: 6 + (i + 1) * BULK_ENTRY_LEN]
+        flags = e[8]
+        lux = ((e[0] << 8) | e[1], (e[2] << 8) | e[3], (e[4] << 8) | e[5]) if flags & 0x01 else None
+        amp = ((e[6] << 8) | e[7]) / 100.0 if flags & 0x02 else None
+        entries.append((lux, amp))
+    return elapsed, ago, entries
+
+
+# ===== センサーCSV =====
+# 1行 = 1分: HH:MM:SS,red,yellow,green,current,mask
+#   mask: bit0=パトライト値有効, bit1=電流値有効（無効側の値は空欄）
+#   旧形式（mask列なしの5列）は全値有効として扱う
+#
+# 差分記録（storage.delta.enabled）: 新しい日のファイルを先頭行 "#delta,<周期秒>,<キーフレーム分>" で始め、
+# 直前に書いた行と値・mask がすべて同じ分は書かない（末尾の "#poll,HH:MM:SS" 行だけ書き換える）。
+# 補った行は記録した値そのものなので、判定閾値を後から変えても全行書いた場合と同じ判定になる。欠測を含む分・keyframe_min 分ごと・ポーリング時刻が周期から
+# ずれた分は必ず書く。書いた行の7列目は、その前に書かなかった分の数（0 なら省略）。
+#   HH:MM:SS,red,yellow,green,current,mask[,省いた分の数]
+#   #poll,HH:MM:SS          （最後の行のあとに書かなかった分があるときだけ。最後のポーリング時刻）
+# 読み出し（_sensor_file_rows）は省いた分を直前の行で補い、1分ごとの行に戻す。ファイル末尾の省いた分は
+# #poll 行の時刻までの周期数で補うので、GW が止まっていた時間を埋めることはない。
+# ファイルの mtime には意味を持たせない（バックフィルの置き換え・書庫への移動で変わってよい）。
+#   storage:
+#     delta:
+#       enabled: false
+#       keyframe_min: 10
+
+VALID_PATLITE = 0x01
+VALID_CURRENT = 0x02
+VALID_ALL     = VALID_PATLITE | VALID_CURRENT
+
+DELTA_HEADER   = '#delta'
+DELTA_POLL     = '#poll'
+DELTA_POLL_LEN = len(f'{DELTA_POLL},00:00:00\r\n')    # csv.writer の行末は CRLF
+
+g_delta      = {}           # {machine_name: {'path', 'params', 'last', 'last_t', 'skipped'}}
+g_delta_lock = threading.Lock()
+
+metric_define('gw_sensor_rows_suppressed_total', 'counter', '差分記録で書かなかった分の数')
+
+
+def _csv_value(v):
+    return '' if v is None else v
+
+
+def _delta_cfg():
+    """差分記録のキーフレーム分。無効なら None。"""
+    c = _storage_cfg().get('delta') or {}
+    if not c.get('enabled', False):
+        return None
+    return max(1, int(c.get('keyframe_min', 10)))
+
+
+def _delta_header(row):
+    """ヘッダー行なら (周期秒, キーフレーム分)、そうでなければ None"""
+    if not row or row[0] != DELTA_HEADER:
+        return None
+    try:
+        return int(row[1]), int(row[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def _delta_tail(last_t, until, params):
+    """最後に書いた行のあと、until（最後のポーリング時刻）までに省いた分の数"""
+    interval, keyframe_min = params
+    n = round((until - last_t).total_seconds() / interval)
+    return max(0, min(keyframe_min - 1, n))
+
+
+def _delta_state(machine_name, path, create):
+    """
+    呼び出し側で g_delta_lock を保持すること。日付が変わればファイルの形式を確認し直す。
+    差分記録のファイルが新しくできるときはヘッダー行を create に加える。
+    """
+    st = g_delta.get(machine_name)
+    if st is not None and st['path'] == path:
+        return st
+    st = g_delta[machine_name] = {'path': path, 'params': None, 'last': None,
+                                  'last_t': None, 'skipped': 0}
+    try:
+        with open(path, newline='', encoding='utf-8') as f:
+            rows = list(csv.reader(f))
+    except FileNotFoundError:
+        cfg = _delta_cfg()
+        if cfg is not None:
+            st['params'] = (config.get('poll_interval_sec', 60), cfg)
+            create.append([DELTA_HEADER, st['params'][0], st['params'][1]])
+        return st
+    st['params'] = _delta_header(rows[0]) if rows else None
+    if st['params'] and len(rows) > 2 and rows[-1] and rows[-1][0] == DELTA_POLL:
+        # 再起動: 前回最後に書いた行のあと省いた分を、次に書く行の7列目に引き継ぐ
+        date_str = os.path.basename(path)[:-4]
+        try:
+            last_t = datetime.strptime(date_str + " " + rows[-2][0], "%Y-%m-%d %H:%M:%S")
+            polled = datetime.strptime(date_str + " " + rows[-1][1], "%Y-%m-%d %H:%M:%S")
+            st['skipped'] = _delta_tail(last_t, polled, st['params'])
+        except (IndexError, ValueError):
+            pass
+    return st
+
+
+def _delta_must_write(st, vals, now):
+    """差分記録で vals の分（時刻 now）を書く必要があるか"""
+    interval, keyframe_min = st['params']
+    if st['last'] is None or st['skipped'] + 1 >= keyframe_min:
+        return True
+    expected = st['last_t'] + timedelta(seconds=interval * (st['skipped'] + 1))
+    if abs((now - expected).total_seconds()) >= interval / 2:
+        return True                      # 周期からずれた（読み出し時に別の分に補ってしまう）
+    if vals[4] != VALID_ALL:
+        return True                      # 欠測はバックフィルで行を置き換えるので必ず書く
+    return vals != st['last']
+
+
+def _delta_append(path, rows, polled):
+    """
+    差分記録のファイルへ追記する。末尾に #poll 行があれば外してから rows を書き、
+    polled（書かなかった分のポーリング時刻）を渡したときは #poll 行を付け直す。
+    """
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    if polled is not None:
+        buf.write(f"{DELTA_POLL},{polled.strftime('%H:%M:%S')}\r\n")
+    data = buf.getvalue().encode('utf-8')
+    try:
+        f = open(path, 'r+b')
+    except FileNotFoundError:
+        f = open(path, 'wb')
+    with f:
+        end = f.seek(0, os.SEEK_END)
+        if end >= DELTA_POLL_LEN:
+            f.seek(end - DELTA_POLL_LEN)
+            if f.read(DELTA_POLL_LEN).startswith(f'{DELTA_POLL},'.encode()):
+                end -= DELTA_POLL_LEN
+        f.seek(end)
+        f.write(data)
+        f.truncate()
+
+
+def write_sensor_csv(machine_name, red, yellow, green, current, now=None):
+    """
+    1分ぶんの値を追記する。応答がなかった値は None で渡す（空欄 + mask で記録）。
+    差分記録のファイルでは、直前に書いた行と変わらない分は書かずに末尾の #poll 行だけ書き換える。
+    """
+    if now is None:
+        now = datetime.now()
+    mask = (VALID_PATLITE if red is not None else 0) | (VALID_CURRENT if current is not None else 0)
     dirp = os.path.join(DATA_DIR, machine_name)
     os.makedirs(dirp, exist_ok=True)
     path = os.path.join(dirp, f"{now.strftime('%Y-%m-%d')}.csv")
-    with open(path, 'a', newline='', encoding='utf-8') as f:
-        csv.writer(f).writerow([now.strftime('%H:%M:%S'), red, yellow, green, current])
+    vals = (red, yellow, green, current, mask)
+    # リング → CSV の順に書く（CSV の mtime が変わった時点でリングには行がある。日別キャッシュの検証用）
+    ring_append(machine_name, now, red, yellow, green, current, mask)
+    rows = []
+    with g_delta_lock:
+        st = _delta_state(machine_name, path, rows)
+        delta = st['params'] is not None
+        write = not delta or _delta_must_write(st, vals, now)
+        if write:
+            row = [now.strftime('%H:%M:%S'), _csv_value(red), _csv_value(yellow),
+                   _csv_value(green), _csv_value(current), mask]
+            if delta and st['skipped']:
+                row.append(st['skipped'])
+            rows.append(row)
+            st['last'], st['last_t'], st['skipped'] = vals, now, 0
+        else:
+            st['skipped'] += 1
+    if delta:
+        _delta_append(path, rows, None if write else now)
+    elif rows:
+        with open(path, 'a', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows(rows)
+    if not write:
+        metric_inc('gw_sensor_rows_suppressed_total')
+    day_index_note_write(machine_name, now.strftime('%Y-%m-%d'), mask, path)
+    if sqlite_recording():
+        sqlite_queue_row(machine_name, now, red, yellow, green, current, mask)
+
+
+def _parse_sensor_row(row):
+    """CSV 1行 → (red, yellow, green, current, mask)。無効値は None。壊れた行は None。"""
+    if len(row) < 5:
+        return None
+    try:
+        mask = int(row[5]) if len(row) > 5 and row[5] != '' else VALID_ALL
+        if mask & VALID_PATLITE:
+            red, yellow, green = float(row[1]), float(row[2]), float(row[3])
+        else:
+            red = yellow = green = None
+        current = float(row[4]) if mask & VALID_CURRENT else None
+    except ValueError:
+        return None
+    return red, yellow, green, current, mask
+
+
+def iter_sensor_rows(machine_name, date_str, start_dt=None, end_dt=None):
+    """
+    センサーデータ 1日分を (datetime, red, yellow, green, current, mask) で順に返す。
+    start_dt/end_dt を渡すと [start_dt, end_dt) の行だけ返す。データがなければ何も返さない。
+    1日分をデコードした結果は日別キャッシュ（day_rows）に持つ。キャッシュにない日は、直近24時間は
+    リングバッファ（共有メモリ）から、それより前は storage.backend が sqlite なら DB から読む
+    （その日が未取り込みなら CSV）。
+    """
+    rows = day_rows(machine_name, date_str)
+    if start_dt is None and end_dt is None:
+        return iter(rows)
+    return (r for r in rows if not ((start_dt and r[0] < start_dt) or (end_dt and r[0] >= end_dt)))
+
+
+def _iter_sensor_rows_disk(machine_name, date_str, start_dt=None, end_dt=None):
+    if sqlite_enabled():
+        return _iter_sensor_rows_db(machine_name, date_str, start_dt, end_dt)
+    return _iter_sensor_rows_csv(machine_name, date_str, start_dt, end_dt)
+
+
+def open_sensor_day(machine_name, date_str):
+    """その日のセンサーCSVをテキストで開く（アーカイブ済みなら書庫から）。なければ None。"""
+    try:
+        return open(os.path.join(DATA_DIR, machine_name, f"{date_str}.csv"),
+                    newline='', encoding='utf-8')
+    except FileNotFoundError:
+        return archive_open_day(machine_name, date_str)
+
+
+def sensor_day_mtime(machine_name, date_str):
+    """その日のセンサーCSVの mtime（アーカイブ済みなら書庫内の記録時刻）。なければ None。"""
+    try:
+        return os.path.getmtime(os.path.join(DATA_DIR, machine_name, f"{date_str}.csv"))
+    except OSError:
+        return archive_days(machine_name).get(date_str)
+
+
+def _sensor_file_rows(f, date_str):
+    """
+    開いたセンサーCSVを (datetime, red, yellow, green, current, mask) で順に返す。
+    差分記録のファイルは省いた分を直前の行で補う（末尾は #poll 行の時刻まで）。
+    """
+    params, prev, polled = None, None, None
+    for row in csv.reader(f):
+        if prev is None and params is None and _delta_header(row):
+            params = _delta_header(row)
+            continue
+        if params and row and row[0] == DELTA_POLL:
+            try:
+                polled = datetime.strptime(date_str + " " + row[1], "%Y-%m-%d %H:%M:%S")
+            except (IndexError, ValueError):
+                pass
+            continue
+        vals = _parse_sensor_row(row)
+        if vals is None:
+            continue
+        try:
+            t = datetime.strptime(date_str + " " + row[0], "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            continue
+        if params and prev and len(row) > 6 and row[6].isdigit():
+            yield from _delta_fill(prev, int(row[6]), params[0])
+        prev, polled = (t,) + vals, None
+        yield prev
+    if params and prev and polled is not None:
+        yield from _delta_fill(prev, _delta_tail(prev[0], polled, params), params[0])
+
+
+def _delta_fill(prev, count, interval):
+    """prev の行を周期ごとに count 分複製する（日付をまたぐ分は返さない）"""
+    step = timedelta(seconds=interval)
+    t = prev[0]
+    for _ in range(count):
+        t += step
+        if t.date() != prev[0].date():
+            break
+        yield (t,) + prev[1:]
+
+
+def _iter_sensor_rows_csv(machine_name, date_str, start_dt=None, end_dt=None):
+    f = open_sensor_day(machine_name, date_str)
+    if f is None:
+        return
+    with f:
+        for row in _sensor_file_rows(f, date_str):
+            t = row[0]
+            if (start_dt and t < start_dt) or (end_dt and t >= end_dt):
+                continue
+            yield row
+
+
+def sensor_day_exists(machine_name, date_str):
+    try:
+        d = datetime.strptime(date_str, "%Y-%m-%d").date()
+    except ValueError:
+        return False
+    with g_day_index_lock:
+        bits = _day_index(machine_name)['bits'].get(d.year, 0)
+    return bool(bits >> _day_bit(d) & 1)
+
+
+def rewrite_sensor_row(machine_name, ts, red=None, yellow=None, green=None, current=None):
+    """
+    ts の時刻で書き込み済みの行を後から埋める（バックフィル用）。None の値は元のまま。
+    一時ファイル → os.replace で置き換えるため、読み取り側が書きかけの行を見ることはない。
+    """
+    path = os.path.join(DATA_DIR, machine_name, f"{ts.strftime('%Y-%m-%d')}.csv")
+    key = ts.strftime('%H:%M:%S')
+    try:
+        with open(path, newline='', encoding='utf-8') as f:
+            rows = list(csv.reader(f))
+    except FileNotFoundError:
+        return False
+    for row in rows:
+        if row and row[0] == key and len(row) >= 5:
+            mask = int(row[5]) if len(row) > 5 and row[5] != '' else VALID_ALL
+            if red is not None:
+                row[1], row[2], row[3] = red, yellow, green
+                mask |= VALID_PATLITE
+            if current is not None:
+                row[4] = current
+                mask |= VALID_CURRENT
+            row[5:6] = [mask]
+            break
+    else:
+        return False
+    vals = _parse_sensor_row([str(v) for v in row])
+    if vals is not None:
+        ring_put(machine_name, ts, *vals)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerows(rows)
+    os.replace(tmp, path)
+    if vals is not None and sqlite_recording():
+        sqlite_queue_row(machine_name, ts, *vals)
+    return True
+
+# ===== 日別データ索引 =====
+# 機械ごとに「データのある日」をメモリに保持し、カレンダー・月ページで listdir/exists を繰り返さない。
+#   days: {date_str: [行数, 全値有効の行数, ファイル mtime]}
+#   bits: {年: int}  ビット (元日からの日数) が立っていればその日のファイルがある
+# write_sensor_csv が追記のたびに更新し、ディレクトリの mtime が変わったとき（日付の追加・
+# バックフィルの置き換え）だけ listdir して変わったファイルを数え直す。
+# アーカイブ済みの日（data/archive/<機械名>.zip）も書庫の更新時にその目録から拾う。
+# 再起動時に全ファイルを読み直さないよう data/index/<機械名>.json に保存する。
+
+DAY_INDEX_DIR      = "data/index"
+DAY_PARTIAL_RATIO  = 0.95   # 期待行数に対する全値有効行の割合がこれ未満なら「一部欠測」
+
+g_day_index      = {}       # {machine_name: {'dir_mtime', 'arc_mtime', 'days', 'bits'}}
+g_day_index_lock = threading.Lock()
+
+
+def _day_bit(d):
+    return d.timetuple().tm_yday - 1
+
+
+def _count_sensor_rows(machine_name, date_str):
+    if sensor_day_mtime(machine_name, date_str) is None:
+        return None
+    rows = complete = 0
+    for row in _iter_sensor_rows_csv(machine_name, date_str):
+        rows += 1
+        if row[5] == VALID_ALL:
+            complete += 1
+    return rows, complete
+
+
+def _day_index_set_bit(entry, date_str, on=True):
+    d = datetime.strptime(date_str, "%Y-%m-%d").date()
+    bits = entry['bits'].get(d.year, 0)
+    entry['bits'][d.year] = bits | (1 << _day_bit(d)) if on else bits & ~(1 << _day_bit(d))
+
+
+def _day_index_load(machine_name):
+    entry = {'dir_mtime': None, 'arc_mtime': None, 'days': {}, 'bits': {}}
+    try:
+        with open(os.path.join(DAY_INDEX_DIR, f"{machine_name}.json"), encoding='utf-8') as f:
+            saved = json.load(f)
+        entry['days'] = {k: list(v) for k, v in saved.get('days', {}).items()}
+    except (OSError, ValueError):
+        pass
+    for date_str in entry['days']:
+        _day_index_set_bit(entry, date_str)
+    return entry
+
+
+def _day_index_save(machine_name, entry):
+    os.makedirs(DAY_INDEX_DIR, exist_ok=True)
+    path = os.path.join(DAY_INDEX_DIR, f"{machine_name}.json")
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'days': entry['days']}, f)
+    os.replace(tmp, path)
+
+
+def _day_index_refresh(machine_name, entry):
+    """ディレクトリ・書庫の mtime が変わっていれば、増減・更新のあったファイルだけ数え直す。"""
+    dirp = os.path.join(DATA_DIR, machine_name)
+    try:
+        dir_mtime = os.path.getmtime(dirp)
+    except OSError:
+        dir_mtime = None
+    try:
+        arc_mtime = os.path.getmtime(archive_path(machine_name))
+    except OSError:
+        arc_mtime = None
+    today = datetime.now().strftime("%Y-%m-%d")
+    if dir_mtime == entry['dir_mtime'] and arc_mtime == entry.get('arc_mtime'):
+        # 当日分は他プロセスが追記することもあるので mtime だけ確認する
+        info = entry['days'].get(today)
+        if info is None:
+            return
+        try:
+            if os.path.getmtime(os.path.join(dirp, f"{today}.csv")) == info[2]:
+                return
+        except OSError:
+            pass
+    entry['dir_mtime'] = dir_mtime
+    entry['arc_mtime'] = arc_mtime
+
+    files = dict(archive_days(machine_name)) if arc_mtime is not None else {}
+    for fn in (os.listdir(dirp) if dir_mtime is not None else []):
+        if not fn.endswith('.csv'):
+            continue
+        date_str = fn[:-4]
+        try:
+            datetime.strptime(date_str, "%Y-%m-%d")
+        except ValueError:
+            continue
+        files[date_str] = os.path.getmtime(os.path.join(dirp, fn))
+
+    seen, changed = set(files), False
+    for date_str, mtime in files.items():
+        info = entry['days'].get(date_str)
+        if info is not None and info[2] == mtime:
+            continue
+        counts = _count_sensor_rows(machine_name, date_str)
+        if counts is None:
+            continue
+        entry['days'][date_str] = [counts[0], counts[1], mtime]
+        _day_index_set_bit(entry, date_str)
+        changed = True
+    for date_str in [d for d in entry['days'] if d not in seen]:
+        del entry['days'][date_str]
+        _day_index_set_bit(entry, date_str, on=False)
+        changed = True
+    if changed:
+        _day_index_save(machine_name, entry)
+
+
+def _day_index(machine_name):
+    """呼び出し側で g_day_index_lock を保持すること"""
+    entry = g_day_index.get(machine_name)
+    if entry is None:
+        entry = g_day_index[machine_name] = _day_index_load(machine_name)
+    _day_index_refresh(machine_name, entry)
+    return entry
+
+
+def day_index_note_write(machine_name, date_str, mask, path):
+    """write_sensor_csv からの通知: 1行追記分をその場で反映する"""
+    with g_day_index_lock:
+        entry = g_day_index.get(machine_name)
+        if entry is None:
+            return
+        info = entry['days'].get(date_str)
+        if info is None:
+            return                       # 新しい日付はディレクトリ mtime の変化で拾う
+        info[0] += 1
+        if mask == VALID_ALL:
+            info[1] += 1
+        info[2] = os.path.getmtime(path)
+
+
+def sensor_days(machine_name, start_date=None, end_date=None):
+    """データのある日付（昇順の date のリスト）。start_date/end_date は両端を含む。"""
+    with g_day_index_lock:
+        bits = dict(_day_index(machine_name)['bits'])
+    days = []
+    for year in sorted(bits):
+        if (start_date and year < start_date.year) or (end_date and year > end_date.year):
+            continue
+        b, base = bits[year], datetime(year, 1, 1).date()
+        while b:
+            low = b & -b
+            d = base + timedelta(days=low.bit_length() - 1)
+            b ^= low
+            if (start_date and d < start_date) or (end_date and d > end_date):
+                continue
+            days.append(d)
+    return days
+
+
+def sensor_day_info(machine_name, date_str):
+    """
+    その日のデータ状況。ファイルがなければ None。
+    {'rows', 'complete_rows', 'expected', 'ratio', 'partial'}（当日は現在時刻までを期待行数とする）
+    """
+    with g_day_index_lock:
+        info = _day_index(machine_name)['days'].get(date_str)
+        if info is None:
+            return None
+        rows, complete = info[0], info[1]
+    interval = config.get('poll_interval_sec', 60)
+    now = datetime.now()
+    if date_str == now.strftime("%Y-%m-%d"):
+        elapsed = (now - now.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
+    else:
+        elapsed = 86400
+    expected = max(1, int(elapsed // interval))
+    ratio = min(1.0, complete / expected)
+    return {'rows': rows, 'complete_rows': complete, 'expected': expected,
+            'ratio': round(ratio, 3), 'partial': ratio < DAY_PARTIAL_RATIO}
+
+# ===== センサーデータのアーカイブ =====
+# 終わった月のセンサーCSVを機械ごとに1つの ZIP 書庫（data/archive/<機械名>.zip、1日 = 1メンバー）へ
+# 移し、元の CSV を消す。ZIP の中央ディレクトリが「日付 → 位置」の索引になるので、1日分だけを
+# 取り出して読める（open_sensor_day は CSV がなければ書庫から開く）。メンバーの時刻は元の CSV の mtime。
+# 書庫は一時ファイルにコピーしてから追記し os.replace で置き換えるので、読み取り側は常に完全な書庫を見る。
+# 合わせて static/ の生成PNG のうち png_keep_days より前に描いたものを消す（必要になれば描き直す）。
+#   archive:
+#     enabled: true
+#     keep_months: 1       # 当月に加えて CSV のまま残す月数
+#     run_at: "03:30"
+#     png_keep_days: 90    # 0: PNG を消さない
+
+ARCHIVE_DIR = "data/archive"
+
+g_archive      = {}         # {machine_name: (書庫 mtime, ZipFile, {date_str: mtime})}
+g_archive_lock = threading.Lock()
+
+metric_define('gw_archive_days_total', 'counter', '書庫へ移したセンサーCSVの日数')
+metric_define('gw_static_pruned_total', 'counter', '保持期間を過ぎて削除した生成PNGの数')
+
+
+def _archive_cfg():
+    c = config.get('archive') or {}
+    return (bool(c.get('enabled', True)), int(c.get('keep_months', 1)),
+            str(c.get('run_at', '03:30')), int(c.get('png_keep_days', 90)))
+
+
+def archive_path(machine_name):
+    return os.path.join(ARCHIVE_DIR, f"{machine_name}.zip")
+
+
+def _archive(machine_name):
+    """(ZipFile or None, {date_str: mtime})。書庫が置き換わっていれば開き直す。"""
+    path = archive_path(machine_name)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None, {}
+    with g_archive_lock:
+        cached = g_archive.get(machine_name)
+        if cached and cached[0] == mtime:
+            return cached[1], cached[2]
+        # 古い ZipFile は読み取り中のスレッドがあるかもしれないので閉じない（参照が切れれば閉じる）
+        zf = zipfile.ZipFile(path)
+        days = {zi.filename[:-4]: _time.mktime(zi.date_time + (0, 0, -1))
+                for zi in zf.infolist() if zi.filename.endswith('.csv')}
+        g_archive[machine_name] = (mtime, zf, days)
+        return zf, days
+
+
+def archive_days(machine_name):
+    """アーカイブ済みの日 {date_str: 元の CSV の mtime}"""
+    return _archive(machine_name)[1]
+
+
+def archive_open_day(machine_name, date_str):
+    """書庫から1日分をテキストで開く。なければ None。"""
+    zf, days = _archive(machine_name)
+    if date_str not in days:
+        return None
+    return io.TextIOWrapper(zf.open(f"{date_str}.csv"), encoding='utf-8', newline='')
+
+
+def archive_machine(machine_name, before):
+    """before（date）より前の日のセンサーCSVを書庫へ移す。移した日数を返す。"""
+    dirp = os.path.join(DATA_DIR, machine_name)
+    try:
+        names = sorted(fn for fn in os.listdir(dirp)
+                       if fn.endswith('.csv') and fn[:-4] < before.strftime("%Y-%m-%d"))
+    except FileNotFoundError:
+        return 0
+    names = [fn for fn in names if re.fullmatch(r'\d{4}-\d{2}-\d{2}\.csv', fn)]
+    if not names:
+        return 0
+
+    path = archive_path(machine_name)
+    tmp = path + '.tmp'
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    if os.path.exists(path):
+        shutil.copyfile(path, tmp)
+    elif os.path.exists(tmp):
+        os.remove(tmp)
+    with zipfile.ZipFile(tmp, 'a', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
+        existing = set(zf.namelist())
+        for fn in names:
+            src = os.path.join(dirp, fn)
+            if fn in existing:
+                # 前回、置き換え後・削除前に止まった日。同じ内容なら追記しない
+                with open(src, 'rb') as f:
+                    if zf.read(fn) == f.read():
+                        continue
+            zf.write(src, fn)
+    with zipfile.ZipFile(tmp) as zf:
+        for fn in names:
+            with open(os.path.join(dirp, fn), 'rb') as f:
+                if zf.read(fn) != f.read():
+                    raise IOError(f"書庫の内容が元の CSV と一致しません: {machine_name}/{fn}")
+    os.replace(tmp, path)
+
+    # 日別索引の数え直し（listdir）と削除が交差しないよう索引のロック中に消す
+    with g_day_index_lock:
+        for fn in names:
+            os.remove(os.path.join(dirp, fn))
+    metric_inc('gw_archive_days_total', len(names))
+    return len(names)
+
+
+def prune_static_images(keep_days):
+    """static/ の生成PNG のうち keep_days 日より前に描いたものを消す。消した数を返す。"""
+    if keep_days <= 0 or not os.path.isdir("static"):
+        return 0
+    limit = _time.time() - keep_days * 86400
+    removed = 0
+    for fn in os.listdir("static"):
+        if not fn.endswith('.png'):
+            continue
+        p = os.path.join("static", fn)
+        try:
+            if os.path.getmtime(p) < limit:
+                os.remove(p)
+                removed += 1
+        except OSError:
+            pass
+    metric_inc('gw_static_pruned_total', removed)
+    return removed
+
+
+def archive_run():
+    """全機械の終わった月（keep_months より前）を書庫へ移し、古い生成PNG を消す"""
+    _, keep_months, _, png_keep_days = _archive_cfg()
+    first = datetime.now().date().replace(day=1)
+    for _ in range(max(0, keep_months)):
+        first = (first - timedelta(days=1)).replace(day=1)
+    t0 = _time.time()
+    total = 0
+    for m in config.get('machines', []):
+        try:
+            n = archive_machine(m['name'], first)
+        except Exception as e:
+            logger.error(f'[archive] 書庫への移動失敗: {e}', extra={'machine': m['name']})
+            continue
+        if n:
+            logger.info(f'[archive] {n} 日分を書庫へ移動（{first} より前）', extra={'machine': m['name']})
+        total += n
+    pruned = prune_static_images(png_keep_days)
+    logger.info(f'[archive] {total} 日分を書庫へ移動、生成PNG {pruned} 件を削除 {_time.time() - t0:.1f}s')
+    return total, pruned
+
+
+def archive_loop():
+    """毎日 run_at にアーカイブと生成PNGの整理を行う"""
+    while True:
+        hh, mm = _archive_cfg()[2].split(':')
+        now = datetime.now()
+        at = now.replace(hour=int(hh), minute=int(mm), second=0, microsecond=0)
+        if at <= now:
+            at += timedelta(days=1)
+        _time.sleep((at - now).total_seconds())
+        if _archive_cfg()[0]:
+            archive_run()
+
+# ===== SQLite バックエンド =====
+# storage.backend を sqlite にすると、センサーデータの読み出しを 1つの SQLite DB（WAL）から行う。
+# CSV は従来どおり書き続ける（サーバーへのコピー・日別索引・キャッシュの検証子は CSV 基準のまま）。
+#   storage:
+#     backend: csv                 # csv / sqlite
+#     sqlite_path: data/sensor.db
+# 書き込みはポーリング1周期分をまとめて1トランザクション（sqlite_flush）。
+# DB ファイルがあれば backend が csv のままでも書く（import してから backend を切り替えるまでの分を落とさない）。
+# 既存の data/sensor/ は tools/sensor_db.py import で取り込む。
+# 読み出しは1日分の行数が日別索引（CSV）より少なければ、その日は CSV から読む（取り込み漏れ・書き込み前の分）。
+# sensor は (machine, ts) を主キーにした WITHOUT ROWID 表なので、機械×時刻範囲の読み出しは
+# 主キーの B-tree だけで完結する（状態判定に使う列をすべて含む = カバリング）。
+# DB は CSV より後（sqlite_flush）で書かれるので、CSV の mtime だけではキャッシュを検証できない。
+# day_gen に日ごとの書き込み世代を持ち、日別キャッシュ・ETag は CSV の mtime と世代の両方で検証する。
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sensor (
+    machine TEXT    NOT NULL,
+    ts      TEXT    NOT NULL,     -- YYYY-MM-DD HH:MM:SS（ローカル時刻）
+    red     REAL,
+    yellow  REAL,
+    green   REAL,
+    current REAL,
+    mask    INTEGER NOT NULL,
+    PRIMARY KEY (machine, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS day_gen (
+    machine TEXT    NOT NULL,
+    date    TEXT    NOT NULL,     -- YYYY-MM-DD
+    gen     INTEGER NOT NULL,     -- その日の行を書き換えるたびに +1（キャッシュ・ETag の検証用）
+    PRIMARY KEY (machine, date)
+) WITHOUT ROWID;
+"""
+
+g_sqlite_local   = threading.local()   # スレッドごとの接続（WAL なので読み出しは並行できる）
+g_sqlite_pending = []                  # 次の sqlite_flush で書く行
+g_sqlite_lock    = threading.Lock()
+
+metric_define('gw_sqlite_flush_rows', 'histogram', '1トランザクションで書いた行数',
+              buckets=(1, 5, 10, 25, 50, 100, 250, 1000))
+
+
+def _storage_cfg():
+    return config.get('storage') or {}
+
+
+def sqlite_enabled():
+    return _storage_cfg().get('backend', 'csv') == 'sqlite'
+
+
+def sqlite_recording():
+    """ポーリングした行を DB にも書くか（backend が sqlite、または DB ファイルがある）"""
+    return sqlite_enabled() or os.path.exists(_storage_cfg().get('sqlite_path', 'data/sensor.db'))
+
+
+def sqlite_conn():
+    path = _storage_cfg().get('sqlite_path', 'data/sensor.db')
+    conn = getattr(g_sqlite_local, 'conn', None)
+    if conn is None or g_sqlite_local.path != path:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = sqlite3.connect(path, timeout=10.0)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SQLITE_SCHEMA)
+        g_sqlite_local.conn, g_sqlite_local.path = conn, path
+    return conn
+
+
+def sqlite_queue_row(machine_name, ts, red, yellow, green, current, mask):
+    with g_sqlite_lock:
+        g_sqlite_pending.append((machine_name, ts.strftime(EVENT_TS_FMT),
+                                 red, yellow, green, current, mask))
+
+
+def _sqlite_write(rows):
+    """行を書き、書いた日の世代を同じトランザクションで進める"""
+    days = sorted({(row[0], row[1][:10]) for row in rows})
+    conn = sqlite_conn()
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO sensor VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        conn.executemany('INSERT INTO day_gen VALUES (?, ?, 1) '
+                         'ON CONFLICT (machine, date) DO UPDATE SET gen = gen + 1', days)
+
+
+def sqlite_generation(machine_name, prefix):
+    """date が prefix（日付・年月）で始まる日の世代の合計。DB から読まない設定なら 0。"""
+    if not sqlite_enabled():
+        return 0
+    row = sqlite_conn().execute('SELECT sum(gen) FROM day_gen WHERE machine = ? AND date LIKE ?',
+                                (machine_name, prefix + '%')).fetchone()
+    return row[0] or 0
+
+
+def sqlite_flush():
+    """溜まった行を1トランザクションで書く（ポーリング周期の終わり・バックフィル後に呼ぶ）"""
+    with g_sqlite_lock:
+        rows = g_sqlite_pending[:]
+        del g_sqlite_pending[:]
+    if not rows:
+        return 0
+    _sqlite_write(rows)
+    metric_observe('gw_sqlite_flush_rows', len(rows))
+    return len(rows)
+
+
+def sqlite_import_day(machine_name, date_str):
+    """CSV 1日分を DB に取り込む（同じ時刻の行は置き換え）。取り込んだ行数を返す。"""
+    rows = [(machine_name, t.strftime(EVENT_TS_FMT), r, y, g, c, mask)
+            for t, r, y, g, c, mask in _iter_sensor_rows_csv(machine_name, date_str)]
+    _sqlite_write(rows)
+    return len(rows)
+
+
+def _iter_sensor_rows_db(machine_name, date_str, start_dt=None, end_dt=None):
+    """
+    1日分を DB から読む。DB の行数が日別索引（CSV の行数）より少なければ、その日は CSV から読む。
+    範囲指定でも1日分を数えて比べる（最大 1440 行なので範囲で絞るのはその後）。
+    """
+    day_start, day_end = _day_range(date_str)
+    rows = sqlite_conn().execute(
+        'SELECT ts, red, yellow, green, current, mask FROM sensor '
+        'WHERE machine = ? AND ts >= ? AND ts < ? ORDER BY ts',
+        (machine_name, day_start.strftime(EVENT_TS_FMT), day_end.strftime(EVENT_TS_FMT))).fetchall()
+    with g_day_index_lock:
+        info = _day_index(machine_name)['days'].get(date_str)
+    if not rows or (info is not None and len(rows) < info[0]):
+        yield from _iter_sensor_rows_csv(machine_name, date_str, start_dt, end_dt)
+        return
+    for ts, r, y, g, c, mask in rows:
+        t = datetime.fromisoformat(ts)
+        if (start_dt and t < start_dt) or (end_dt and t >= end_dt):
+            continue
+        yield (t, r, y, g, c, mask)
+
+
+# ===== 直近24時間リングバッファ =====
+# 機械ごとに直近24時間の1分値を固定長のリングに持ち、当日（と前日の直近分）の読み出しで CSV を開かない。
+# multiprocessing.shared_memory 上に置くので、同じデータディレクトリの GW を別プロセス（Web ワーカー等）で
+# 動かしても読める。書くのはポーリング担当の1プロセスだけ（data/poller.lock を fcntl で排他）。
+#   ヘッダー: seq, count（通算書き込み数）, slots, valid_from（epoch 秒。これ以降はリングに全行ある）
+#   スロット: n（通算番号）, ts（epoch 秒）, red, yellow, green, current（無効値は NaN）, mask
+# 読み手は seq が奇数（書き込み中）か、読む前後で変わっていれば読み直す（seqlock）。
+# ポーリング担当はポーリング開始前に当日・前日の CSV から直近24時間を詰め、それから valid_from を設定する。
+#   storage:
+#     ring_buffer: true
+
+RING_HEADER      = struct.Struct('<QQQd')
+RING_SLOT        = struct.Struct('<Qd4dB7x')
+RING_HOURS       = 24
+RING_READ_TRIES  = 100
+POLLER_LOCK_PATH = "data/poller.lock"
+
+g_ring       = {}           # {machine_name: SharedMemory}
+g_ring_lock  = threading.Lock()
+g_ring_owner = False        # このプロセスがリングに書く（ポーリング担当）
+g_poller_lock_file = None
+
+metric_define('gw_ring_reads_total', 'counter', '直近24時間の読み出し（source=ring/disk）')
+
+
+def ring_enabled():
+    return bool(_storage_cfg().get('ring_buffer', True))
+
+
+def acquire_poller_lock():
+    """このプロセスがポーリング担当になれれば True（別プロセスが担当中なら False）"""
+    global g_poller_lock_file
+    if not HAS_FCNTL:
+        return True
+    os.makedirs(os.path.dirname(POLLER_LOCK_PATH), exist_ok=True)
+    f = open(POLLER_LOCK_PATH, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    g_poller_lock_file = f
+    return True
+
+
+def _ring_name(machine_name):
+    # 同じ機械名の別 GW（別ディレクトリ）と混ざらないよう、データディレクトリのハッシュを付ける
+    base = hashlib.sha1(os.path.abspath(DATA_DIR).encode()).hexdigest()[:8]
+    return f"gw{base}_{re.sub(r'[^0-9A-Za-z_]', '_', machine_name)}"
+
+
+def _ring_slots():
+    return int(RING_HOURS * 3600 / config.get('poll_interval_sec', 60) * 1.1) + 1
+
+
+def _ring_attach(machine_name, create=False):
+    """機械のリングを開く（create=True: ポーリング担当が作り直す）。開けなければ None。"""
+    with g_ring_lock:
+        shm = g_ring.get(machine_name)
+        if shm is not None and not create:
+            return shm
+        name, slots = _ring_name(machine_name), _ring_slots()
+        size = RING_HEADER.size + slots * RING_SLOT.size
+        try:
+            if create:
+                try:
+                    shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+                    seq = 0
+                except FileExistsError:
+                    # 前回のポーリング担当が残したもの。読み手が開いたままなので同じ領域を初期化して使う
+                    shm = shared_memory.SharedMemory(name=name)
+                    if shm.size < size:
+                        shm.close()
+                        shm.unlink()
+                        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+                        seq = 0
+                    else:
+                        seq = RING_HEADER.unpack_from(shm.buf, 0)[0]
+                        seq += 2 - (seq & 1)
+                RING_HEADER.pack_into(shm.buf, 0, seq, 0, slots, 0.0)
+            else:
+                shm = shared_memory.SharedMemory(name=name)
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        # プロセス終了時に resource_tracker が unlink しないようにする（ほかのプロセスが読んでいる）
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        g_ring[machine_name] = shm
+        return shm
+
+
+def _ring_pack(buf, n, slots, ts, red, yellow, green, current, mask):
+    nan = float('nan')
+    RING_SLOT.pack_into(buf, RING_HEADER.size + (n % slots) * RING_SLOT.size, n, ts,
+                        nan if red is None else red, nan if yellow is None else yellow,
+                        nan if green is None else green, nan if current is None else current, mask)
+
+
+def ring_append(machine_name, ts, red, yellow, green, current, mask):
+    """ポーリング担当: 1分ぶんをリングに追加する"""
+    shm = g_ring.get(machine_name) if g_ring_owner else None
+    if shm is None:
+        return
+    buf = shm.buf
+    with g_ring_lock:
+        seq, count, slots, valid_from = RING_HEADER.unpack_from(buf, 0)
+        RING_HEADER.pack_into(buf, 0, seq + 1, count, slots, valid_from)
+        _ring_pack(buf, count, slots, ts.replace(microsecond=0).timestamp(),
+                   red, yellow, green, current, mask)
+        RING_HEADER.pack_into(buf, 0, seq + 2, count + 1, slots, valid_from)
+
+
+def ring_put(machine_name, ts, red, yellow, green, current, mask):
+    """ポーリング担当: 時刻 ts の行を置き換える（バックフィル用）。リングになければ何もしない。"""
+    shm = g_ring.get(machine_name) if g_ring_owner else None
+    if shm is None:
+        return
+    buf = shm.buf
+    key = ts.replace(microsecond=0).timestamp()
+    with g_ring_lock:
+        seq, count, slots, valid_from = RING_HEADER.unpack_from(buf, 0)
+        for n in range(count - 1, max(0, count - slots) - 1, -1):
+            if RING_SLOT.unpack_from(buf, RING_HEADER.size + (n % slots) * RING_SLOT.size)[1] == key:
+                RING_HEADER.pack_into(buf, 0, seq + 1, count, slots, valid_from)
+                _ring_pack(buf, n, slots, key, red, yellow, green, current, mask)
+                RING_HEADER.pack_into(buf, 0, seq + 2, count, slots, valid_from)
+                return
+
+
+def _ring_snapshot(shm):
+    """(count, slots, valid_from, スロット領域の bytes)。書き込みと重なり続けたら None。"""
+    buf = shm.buf
+    for _ in range(RING_READ_TRIES):
+        seq, count, slots, valid_from = RING_HEADER.unpack_from(buf, 0)
+        if seq & 1:
+            _time.sleep(0)
+            continue
+        data = bytes(buf[RING_HEADER.size:RING_HEADER.size + slots * RING_SLOT.size])
+        if RING_HEADER.unpack_from(buf, 0)[0] == seq:
+            return count, slots, valid_from, data
+    return None
+
+
+def ring_rows(machine_name, date_str, start_dt=None, end_dt=None):
+    """
+    iter_sensor_rows と同じ行のリスト。リングが範囲の最初から持っていなければ None（ディスクから読む）。
+    """
+    if not ring_enabled():
+        return None
+    day_start, day_end = _day_range(date_str)
+    lo = max(start_dt, day_start) if start_dt else day_start
+    hi = min(end_dt, day_end) if end_dt else day_end
+    if lo < datetime.now() - timedelta(hours=RING_HOURS):
+        return None
+    shm = g_ring.get(machine_name) or _ring_attach(machine_name)
+    snap = _ring_snapshot(shm) if shm is not None else None
+    if snap is None or not snap[2]:
+        metric_inc('gw_ring_reads_total', source='disk')
+        return None
+    count, slots, valid_from, data = snap
+    first = max(0, count - slots)
+    if count > slots:
+        valid_from = max(valid_from, RING_SLOT.unpack_from(data, (first % slots) * RING_SLOT.size)[1])
+    lo_ts, hi_ts = lo.timestamp(), hi.timestamp()
+    if lo_ts < valid_from:
+        metric_inc('gw_ring_reads_total', source='disk')
+        return None
+    rows = []
+    for n in range(first, count):
+        _, ts, r, y, g, c, mask = RING_SLOT.unpack_from(data, (n % slots) * RING_SLOT.size)
+        if ts < lo_ts or ts >= hi_ts:
+            continue
+        pat = mask & VALID_PATLITE
+        rows.append((datetime.fromtimestamp(ts), r if pat else None, y if pat else None,
+                     g if pat else None, c if mask & VALID_CURRENT else None, mask))
+    metric_inc('gw_ring_reads_total', source='ring')
+    return rows
+
+
+def ring_latest(machine_name):
+    """最後に追加された1分（iter_sensor_rows と同じ形）。リングがない・空なら None。"""
+    if not ring_enabled():
+        return None
+    shm = g_ring.get(machine_name) or _ring_attach(machine_name)
+    if shm is None:
+        return None
+    buf = shm.buf
+    for _ in range(RING_READ_TRIES):
+        seq, count, slots, _ = RING_HEADER.unpack_from(buf, 0)
+        if seq & 1:
+            _time.sleep(0)
+            continue
+        if not count:
+            return None
+        _, ts, r, y, g, c, mask = RING_SLOT.unpack_from(
+            buf, RING_HEADER.size + ((count - 1) % slots) * RING_SLOT.size)
+        if RING_HEADER.unpack_from(buf, 0)[0] != seq:
+            continue
+        pat = mask & VALID_PATLITE
+        return (datetime.fromtimestamp(ts), r if pat else None, y if pat else None,
+                g if pat else None, c if mask & VALID_CURRENT else None, mask)
+    return None
+
+
+def ring_seed(name):
+    """ポーリング担当: 機械のリングを作り、直近24時間を CSV（または DB）から詰める"""
+    if not ring_enabled() or not g_ring_owner:
+        return
+    since = datetime.now().replace(microsecond=0) - timedelta(hours=RING_HOURS)
+    shm = _ring_attach(name, create=True)
+    if shm is None:
+        return
+    for d in (since.date(), since.date() + timedelta(days=1)):
+        for row in _iter_sensor_rows_disk(name, d.strftime("%Y-%m-%d"), since):
+            ring_append(name, *row)
+    with g_ring_lock:
+        seq, count, slots, _ = RING_HEADER.unpack_from(shm.buf, 0)
+        RING_HEADER.pack_into(shm.buf, 0, seq + 2, count, slots, since.timestamp())
+
+
+def ring_seed_all():
+    """ポーリング担当: 全機械のリングを作り、直近24時間を CSV（または DB）から詰める"""
+    global g_ring_owner
+    if not ring_enabled():
+        return
+    g_ring_owner = True
+    for m in config.get('machines', []):
+        ring_seed(m['name'])
+    logger.info(f'[ring] 直近{RING_HOURS}時間を共有メモリに保持（{len(g_ring)} 台）')
+
+# ===== 日別デコードキャッシュ =====
+# 1日分をデコードした行（iter_sensor_rows の行のリスト）と、判定閾値ごとの状態判定結果を
+# プロセス内に LRU で持ち、同じ日を何度も CSV から読み直さない（日別・月別ページ、集計、グラフ）。
+# 検証は sensor_day_mtime: 当日のファイルは追記のたびに mtime が変わるので読み直す。
+# backend: sqlite では DB の書き込み世代（sqlite_generation）も合わせて見る（DB は CSV より後に書かれる）。
+# 合計サイズ（行・判定結果の Python オブジェクトの大きさの見積もり）が memory_mb を超えたら古い日から捨てる。
+#   day_cache:
+#     memory_mb: 64        # 0: キャッシュしない
+
+g_day_cache      = OrderedDict()   # {(machine_name, date_str): {'version', 'rows', 'states', 'size'}}
+g_day_cache_size = 0
+g_day_cache_lock = threading.Lock()
+
+metric_define('gw_day_cache_hits_total', 'counter', '日別デコードキャッシュのヒット数（kind=rows/states）')
+metric_define('gw_day_cache_misses_total', 'counter', '日別デコードキャッシュのミス数（kind=rows/states）')
+metric_define('gw_day_cache_bytes', 'gauge', '日別デコードキャッシュの推定サイズ')
+
+
+def _day_cache_limit():
+    return int(float((config.get('day_cache') or {}).get('memory_mb', 64)) * 1024 * 1024)
+
+
+def _rows_size(rows):
+    """行リストの推定メモリ量（None・小さい int は共有なので数えない）"""
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row) + sys.getsizeof(row[0])
+        size += sum(sys.getsizeof(v) for v in row[1:5] if v is not None)
+    return size
+
+
+def _day_cache_evict():
+    """呼び出し側で g_day_cache_lock を保持すること"""
+    global g_day_cache_size
+    limit = _day_cache_limit()
+    while g_day_cache and g_day_cache_size > limit:
+        _, entry = g_day_cache.popitem(last=False)
+        g_day_cache_size -= entry['size']
+    metric_set('gw_day_cache_bytes', g_day_cache_size)
+
+
+def _day_load(machine_name, date_str):
+    rows = ring_rows(machine_name, date_str)
+    return rows if rows is not None else list(_iter_sensor_rows_disk(machine_name, date_str))
+
+
+def _day_entry(machine_name, date_str):
+    """キャッシュの項目（なければデコードして入れる）。データのない日は None。"""
+    global g_day_cache_size
+    mtime = sensor_day_mtime(machine_name, date_str)
+    if mtime is None:
+        return None
+    version = (mtime, sqlite_generation(machine_name, date_str))
+    key = (machine_name, date_str)
+    with g_day_cache_lock:
+        entry = g_day_cache.get(key)
+        if entry is not None and entry['version'] == version:
+            g_day_cache.move_to_end(key)
+            metric_inc('gw_day_cache_hits_total', kind='rows')
+            return entry
+    metric_inc('gw_day_cache_misses_total', kind='rows')
+    # mtime・世代を取ってから読むので、読んだ行は少なくともその時点のもの（その後の書き込みは変化で拾う）
+    rows = single_flight(('day', machine_name, date_str, version), _day_load, machine_name, date_str)
+    entry = {'version': version, 'rows': rows, 'states': {}, 'size': _rows_size(rows)}
+    if entry['size'] > _day_cache_limit():
+        return entry
+    with g_day_cache_lock:
+        old = g_day_cache.pop(key, None)
+        if old is not None:
+            g_day_cache_size -= old['size']
+        g_day_cache[key] = entry
+        g_day_cache_size += entry['size']
+        _day_cache_evict()
+    return entry
+
+
+def _states_size(states):
+    return sys.getsizeof(states) + len(states) * sys.getsizeof(('', ''))
+
+
+def day_cache_drop_states(machine_name):
+    """機械の状態判定結果をすべて捨てる（判定閾値が変わったとき。デコード済みの行は残す）"""
+    global g_day_cache_size
+    with g_day_cache_lock:
+        for (name, _), entry in g_day_cache.items():
+            if name != machine_name:
+                continue
+            size = sum(_states_size(st) for st in entry['states'].values())
+            entry['states'] = {}
+            entry['size'] -= size
+            g_day_cache_size -= size
+        metric_set('gw_day_cache_bytes', g_day_cache_size)
+
+
+def day_rows(machine_name, date_str):
+    """その日の全行（iter_sensor_rows と同じ形のリスト。変更しないこと）"""
+    entry = _day_entry(machine_name, date_str)
+    return entry['rows'] if entry is not None else []
+
+
+def day_states(machine_name, date_str, thresholds=None, current_threshold=None):
+    """
+    その日の全行と、行ごとの (state, color) のリスト（閾値ごとにキャッシュ）。
+    データのない日は ([], [])。
+    """
+    global g_day_cache_size
+    entry = _day_entry(machine_name, date_str)
+    if entry is None:
+        return [], []
+    fp = (repr(thresholds), current_threshold)
+    states = entry['states'].get(fp)
+    if states is not None:
+        metric_inc('gw_day_cache_hits_total', kind='states')
+        return entry['rows'], states
+    metric_inc('gw_day_cache_misses_total', kind='states')
+    states = [tuple(classify_reading(r, y, g, c, mask, thresholds=thresholds,
+                                     current_threshold=current_threshold)[2:])
+              for _, r, y, g, c, mask in entry['rows']]
+    size = _states_size(states)
+    with g_day_cache_lock:
+        entry['states'][fp] = states
+        if g_day_cache.get((machine_name, date_str)) is entry:
+            entry['size'] += size
+            g_day_cache_size += size
+            _day_cache_evict()
+    return entry['rows'], states
+
+
+def day_states_between(machine_name, date_str, start_dt=None, end_dt=None,
+                       thresholds=None, current_threshold=None):
+    """day_states の [start_dt, end_dt) の分を (datetime, state, color) で順に返す"""
+    rows, states = day_states(machine_name, date_str, thresholds, current_threshold)
+    for row, (state, color) in zip(rows, states):
+        t = row[0]
+        if (start_dt and t < start_dt) or (end_dt and t >= end_dt):
+            continue
+        yield t, state, color
+
+# ===== 点灯・状態判定 =====
+
+def get_light_status(red, yellow, green, current,
+                     thresholds=None, current_threshold=None):
+    if thresholds is None:
+        thresholds = THRESHOLDS
+    if current_threshold is None:
+        current_threshold = CURRENT_THRESHOLD
+
+    def is_on(color, value):
+        return value >= thresholds[color]
+
+    status = {
+        "red":    "点灯" if is_on("red",    red)    else "消灯",
+        "yellow": "点灯" if is_on("yellow", yellow) else "消灯",
+        "green":  "点灯" if is_on("green",  green)  else "消灯"
+    }
+
+    machine_action = "加工中" if current >= current_threshold else "加工なし"
+
+    state, color = "停止", "gray"
+    r, y, g, m = status["red"], status["yellow"], status["green"], machine_action
+
+    if r == "消灯" and y == "消灯" and g == "消灯" and m == "加工なし":
+        state, color = "停止", "gray"
+    elif r == "消灯" and y == "消灯" and g == "点灯" and m == "加工なし":
+        state, color = "自動加工中", "green"
+    elif r == "消灯" and y == "点灯" and g == "消灯" and m == "加工なし":
+        state, color = "加工完了", "yellow"
+    elif r == "消灯" and y == "点灯" and g == "点灯" and m == "加工なし":
+        state, color = "自動加工中", "green"
+    elif r == "点灯" and y == "消灯" and g == "消灯" and m == "加工なし":
+        state, color = "アラーム", "red"
+    elif r == "点灯" and y == "消灯" and g == "点灯" and m == "加工なし":
+        state, color = "自動加工中", "green"
+    elif r == "点灯" and y == "点灯" and g == "消灯" and m == "加工なし":
+        state, color = "加工完了", "yellow"
+    elif r == "点灯" and y == "点灯" and g == "点灯" and m == "加工なし":
+        state, color = "自動加工中", "green"
+    elif r == "消灯" and y == "消灯" and g == "消灯" and m == "加工中":
+        state, color = "手動加工中", "blue"
+    elif r == "消灯" and y == "消灯" and g == "点灯" and m == "加工中":
+        state, color = "自動加工中", "green"
+    elif r == "消灯" and y == "点灯" and g == "消灯" and m == "加工中":
+        state, color = "手動加工中", "blue"
+    elif r == "消灯" and y == "点灯" and g == "点灯" and m == "加工中":
+        state, color = "自動加工中", "green"
+    elif r == "点灯" and y == "消灯" and g == "消灯" and m == "加工中":
+        state, color = "手動加工中", "blue"
+    elif r == "点灯" and y == "消灯" and g == "点灯" and m == "加工中":
+        state, color = "自動加工中", "green"
+    elif r == "点灯" and y == "点灯" and g == "消灯" and m == "加工中":
+        state, color = "手動加工中", "blue"
+    elif r == "点灯" and y == "点灯" and g == "点灯" and m == "加工中":
+        state, color = "自動加工中", "green"
+
+    return status, machine_action, state, color
+
+
+STATES = ["自動加工中", "手動加工中", "加工完了", "アラーム", "停止", "未取得"]
+WORKING_STATES = ["自動加工中", "手動加工中", "加工完了"]
+
+
+def classify_reading(red, yellow, green, current, mask=VALID_ALL,
+                     thresholds=None, current_threshold=None):
+    """
+    get_light_status の欠測対応版。mask で無効な値がある分は状態を 未取得 とする。
+    ただし緑点灯は電流値によらず 自動加工中 なので、パトライト値だけで判定できる。
+    """
+    if mask & VALID_ALL == VALID_ALL:
+        return get_light_status(red, yellow, green, current,
+                                thresholds=thresholds, current_threshold=current_threshold)
+    lights = {"red": "不明", "yellow": "不明", "green": "不明"}
+    machine_action = "不明"
+    if mask & VALID_PATLITE:
+        lights, _, state, color = get_light_status(red, yellow, green, 0.0,
+                                                   thresholds=thresholds,
+                                                   current_threshold=current_threshold)
+        if lights["green"] == "点灯":
+            return lights, machine_action, state, color
+    if mask & VALID_CURRENT:
+        _, machine_action, _, _ = get_light_status(0.0, 0.0, 0.0, current,
+                                                   thresholds=thresholds,
+                                                   current_threshold=current_threshold)
+    return lights, machine_action, "未取得", "white"
 
 
 # ===== ポーリングスレッド =====
@@ -191,6 +1825,10 @@ g_cmd_q     = queue.Queue()
 g_results   = {}               # {req_id: {'status': 'pending'|'done', ...}}
 g_res_lock  = threading.Lock()
 g_maint_event = threading.Event()  # Flaskがコマンドを積んだらセット → polling_loopが早期起床
+g_no_combined = set()          # 'A'コマンド非対応（旧ファーム）と判明したユニットアドレス
+g_no_bulk     = set()          # 'B'コマンド非対応（旧ファーム）と判明したユニットアドレス
+g_gaps        = {}             # {machine_name: {datetime: 欠測マスク(bit0=パトライト, bit1=電流)}}
+g_gaps_lock   = threading.Lock()
 
 # ===== OTA グローバル =====
 serial_lock  = threading.Lock()   # ポーリングスレッドとOTAワーカーの排他制御
@@ -198,33 +1836,121 @@ g_ota_jobs   = {}                  # {job_id: {status, progress, message, fw_byt
 g_ota_lock   = threading.Lock()
 g_serial_obj = None                # polling_loop が開いているシリアルオブジェクト（OTA共用）
 
+# ===== 状態配信（SSE）グローバル =====
+# ポーリング担当のプロセスは poll_machine の直後に配信する。ほかの Web プロセスは最初の購読時に
+# status_follow_loop を起動し、リングバッファ（なければ当日の CSV）の最新行が変わったら配信する。
+STATUS_FOLLOW_SEC = 2.0            # ポーリング担当以外のプロセスが最新行を確認する間隔
+
+g_latest_status = {}               # {machine_name: 直近ポーリング結果（publish_machine_status 参照）}
+g_status_subs   = []               # SSE購読クライアントごとの queue.Queue
+g_status_lock   = threading.Lock()
+g_status_follow = False            # status_follow_loop を起動済みか
+
+
+def publish_machine_status(machine, red, yellow, green, current, now):
+    """poll_machine 完了直後の状態を g_latest_status に保存し、SSE購読者へ配信する。"""
+    thresholds  = machine.get('patlite_thresholds', THRESHOLDS)
+    curr_thresh = machine.get('current_threshold', CURRENT_THRESHOLD)
+    mask = (VALID_PATLITE if red is not None else 0) | (VALID_CURRENT if current is not None else 0)
+    lights, machine_action, state, color = classify_reading(
+        red, yellow, green, current, mask,
+        thresholds=thresholds, current_threshold=curr_thresh)
+    status = {
+        'name':      machine['name'],
+        'red':       red, 'yellow': yellow, 'green': green, 'current': current,
+        'mask':      mask,
+        'lights':    lights,
+        'state':     state,
+        'color':     color,
+        'timestamp': now.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    with g_status_lock:
+        g_latest_status[machine['name']] = status
+        subs = list(g_status_subs)
+    for q in subs:
+        try:
+            q.put_nowait(status)
+        except queue.Full:
+            pass   # 受信が滞っているクライアントは取りこぼしを許容
+    return status
+
+
+def status_follow_loop():
+    """ポーリング担当以外のプロセス: 各機械の最新行が変わったら publish_machine_status で配信する"""
+    published = {}                 # {machine_name: 配信した行の時刻}
+    mtimes = {}                    # リングがないとき: {machine_name: 当日 CSV の mtime}
+    while True:
+        _time.sleep(STATUS_FOLLOW_SEC)
+        with g_status_lock:
+            if not g_status_subs:
+                continue
+        now = datetime.now()
+        for machine in config.get('machines', []):
+            name = machine['name']
+            try:
+                row = ring_latest(name)
+                if row is None:
+                    mtime = sensor_day_mtime(name, now.strftime("%Y-%m-%d"))
+                    if mtime is None or mtime == mtimes.get(name):
+                        continue
+                    mtimes[name] = mtime
+                    row = _latest_row(name, now)
+                if row is None or row[0] == published.get(name):
+                    continue
+                published[name] = row[0]
+                publish_machine_status(machine, *row[1:5], row[0])
+            except Exception as e:
+                logger.error(f'[SSE] 最新行の確認エラー: {e}', extra={'machine': name})
+
+
+def _poll_combined(ser, machine):
+    """
+    兼務ユニットに 'A' を1回送り (lux, current) を返す。
+    旧ファームが未対応コマンドエラーを返したら g_no_combined に登録し、None（P/Cへフォールバック）を返す。
+    """
+    addr = machine['patlite_addr']
+    data = e220_transact(ser, addr, 'A', machine['name'])
+    if is_edge_error(data, EDGE_ERR_UNKNOWN_CMD):
+        g_no_combined.add(addr)
+        logger.info('Aコマンド非対応のため P/C に切替',
+                    extra={'machine': machine['name'], 'addr': addr, 'cmd': 'A'})
+        return None
+    return parse_all(data) or (None, None)
+
 
 def poll_machine(ser, machine):
-    ch = config['gw_channel']
     red = yellow = green = current = None
-    e220_send(ser, machine['patlite_addr'], ch, 'P')
-    lux = parse_patlite(e220_recv(ser))
+    lux = amp = None
+    shared = (machine['patlite_addr'] == machine['current_addr']
+              and machine['patlite_addr'] not in g_no_combined)
+    combined = _poll_combined(ser, machine) if shared else None
+    if combined is not None:
+        lux, amp = combined
+    else:
+        lux = parse_patlite(e220_transact(ser, machine['patlite_addr'], 'P', machine['name']))
+        amp = parse_current(e220_transact(ser, machine['current_addr'], 'C', machine['name']))
     if lux:
         red, yellow, green = lux
-    e220_send(ser, machine['current_addr'], ch, 'C')
-    amp = parse_current(e220_recv(ser))
     if amp is not None:
         current = amp
-    write_sensor_csv(machine['name'],
-                     red or 0.0, yellow or 0.0,
-                     green or 0.0, current or 0.0)
+    now = datetime.now()
+    missing = (0 if lux else 0x01) | (0 if amp is not None else 0x02)
+    if missing:
+        with g_gaps_lock:
+            g_gaps.setdefault(machine['name'], {})[now] = missing
+    write_sensor_csv(machine['name'], red, yellow, green, current, now=now)
+    status = publish_machine_status(machine, red, yellow, green, current, now)
+    track_event(machine['name'], now, status['state'])
 
 
 def _handle_maint(ser, req):
     req_id = req['req_id']
     cmd    = req['cmd']   # 'K' / 'V' / 'H' / 'P' / 'C'
     addr   = req['addr']  # int
-    ch     = config['gw_channel']
     machine = req['machine']
     unit    = req['unit']
 
-    e220_send(ser, addr, ch, cmd)
-    data = e220_recv(ser)
+    data = e220_transact(ser, addr, cmd, machine)
     _time.sleep(0.3)  # E220が受信待ち状態から抜けるのを待つ（連続送信時のタイムアウト誤検知防止）
 
     if data is None:
@@ -268,10 +1994,12 @@ def _handle_maint(ser, req):
     else:
         result = {'ok': False, 'error': 'unknown cmd'}
 
+    fields = {'machine': machine, 'unit': unit, 'addr': addr, 'cmd': cmd}
     if result.get('ok'):
-        logger.info(f'MAINT {cmd} → 0x{addr:04X} ({machine}/{unit}): OK')
+        logger.info(f'MAINT {cmd} → 0x{addr:04X} ({machine}/{unit}): OK', extra=fields)
     else:
-        logger.warning(f'MAINT {cmd} → 0x{addr:04X} ({machine}/{unit}): {result.get("error")}')
+        logger.warning(f'MAINT {cmd} → 0x{addr:04X} ({machine}/{unit}): {result.get("error")}',
+                       extra=fields)
 
     with g_res_lock:
         g_results[req_id] = {'status': 'done', 'result': result,
@@ -279,20 +2007,380 @@ def _handle_maint(ser, req):
                               'cmd': cmd, 'ts': _time.time()}
 
 
+# ===== 状態遷移イベントログ =====
+# 分単位の状態列を「同じ状態が続いた区間」にまとめ、機械ごと・月ごとに追記する。
+#   data/events/<機械名>/YYYY-MM.csv : start,end,state,sec（開始時刻順・日付境界で分割）
+#   data/events/<機械名>/meta.json   : 判定閾値のフィンガープリント（変わったら全再構築）
+# 継続中の区間はメモリ（g_event_open）にだけ持ち、状態が変わった時点で確定して書き出す。
+
+EVENT_DIR     = "data/events"
+EVENT_GAP_SEC = 150     # 行の間隔がこれを超えたら連続とみなさない（GW停止など）
+EVENT_TS_FMT  = "%Y-%m-%d %H:%M:%S"
+
+g_event_open    = {}    # {machine_name: [start, last_t, state]}
+g_event_pending = {}    # 起動時の追いつき処理が終わるまでに届いた (t, state)
+g_event_lock    = threading.Lock()
+g_event_cache   = {}    # {path: (mtime, [(start, end, state, sec), ...])}
+
+
+def thresholds_fingerprint(machine, cfg=None):
+    """状態判定に効く設定のフィンガープリント（派生データの再計算要否の判定用）。cfg 省略時は現在の設定。"""
+    key = json.dumps({'t': machine.get('patlite_thresholds', THRESHOLDS),
+                      'c': machine.get('current_threshold', CURRENT_THRESHOLD),
+                      'i': (cfg or config).get('poll_interval_sec', 60)}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def _event_path(machine_name, ym):
+    return os.path.join(EVENT_DIR, machine_name, f"{ym}.csv")
+
+
+def _run_end(start, last_t):
+    """途切れた区間の終了時刻: 最終行 + ポーリング周期（日付境界で打ち切り）"""
+    midnight = datetime.combine(start.date() + timedelta(days=1), time(0, 0))
+    return min(last_t + timedelta(seconds=config.get('poll_interval_sec', 60)), midnight)
+
+
+def _event_step(run, t, state, emit):
+    """区間 run=[start, last_t, state] に1行を加える。区間が確定したら emit(start, end, state)。"""
+    if run is not None:
+        start, last_t, cur = run
+        contiguous = (t - last_t).total_seconds() <= EVENT_GAP_SEC and t.date() == start.date()
+        if contiguous and state == cur:
+            run[1] = t
+            return run
+        emit(start, t if contiguous else _run_end(start, last_t), cur)
+    return [t, t, state]
+
+
+def _append_event(machine_name, start, end, state):
+    path = _event_path(machine_name, start.strftime("%Y-%m"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerow([start.strftime(EVENT_TS_FMT), end.strftime(EVENT_TS_FMT), state,
+                                int((end - start).total_seconds())])
+
+
+def _classified_rows(machine, date_str, start_dt=None):
+    thresholds  = machine.get('patlite_thresholds', THRESHOLDS)
+    curr_thresh = machine.get('current_threshold', CURRENT_THRESHOLD)
+    for t, state, _ in day_states_between(machine['name'], date_str, start_dt, None,
+                                          thresholds, curr_thresh):
+        yield t, state
+
+
+def _derive_day_events(machine, date_str):
+    """1日分の行から区間を導出する → (確定区間のリスト, 最後の区間)"""
+    events, run = [], None
+    emit = lambda s_, e_, st: events.append((s_, e_, st))
+    for t, state in _classified_rows(machine, date_str):
+        run = _event_step(run, t, state, emit)
+    return events, run
+
+
+def _read_event_file(path):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return []
+    cached = g_event_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    events = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if len(row) < 4:
+                continue
+            try:
+                events.append((datetime.strptime(row[0], EVENT_TS_FMT),
+                               datetime.strptime(row[1], EVENT_TS_FMT), row[2], int(row[3])))
+            except ValueError:
+                continue
+    events.sort(key=lambda e: e[0])
+    g_event_cache[path] = (mtime, events)
+    return events
+
+
+def _write_event_file(path, events):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', newline='', encoding='utf-8') as f:
+        w = csv.writer(f)
+        for s_, e_, st, _ in sorted(events, key=lambda e: e[0]):
+            w.writerow([s_.strftime(EVENT_TS_FMT), e_.strftime(EVENT_TS_FMT), st,
+                        int((e_ - s_).total_seconds())])
+    os.replace(tmp, path)
+
+
+def _events_catch_up(machine):
+    """
+    起動時: 最後に記録した区間の終わり以降のセンサー行から区間を導出して追記し、継続中の区間を復元する。
+    閾値が変わっていればイベントログを作り直す。
+    """
+    name = machine['name']
+    mdir = os.path.join(EVENT_DIR, name)
+    meta_path = os.path.join(mdir, 'meta.json')
+    fp = thresholds_fingerprint(machine)
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            stored = json.load(f).get('fingerprint')
+    except (OSError, ValueError):
+        stored = None
+    if stored != fp and os.path.isdir(mdir):
+        for fn in os.listdir(mdir):
+            if fn.endswith('.csv'):
+                os.remove(os.path.join(mdir, fn))
+    os.makedirs(mdir, exist_ok=True)
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump({'fingerprint': fp}, f)
+
+    months = sorted(fn[:-4] for fn in os.listdir(mdir) if fn.endswith('.csv'))
+    last = _read_event_file(_event_path(name, months[-1]))[-1] if months else None
+    resume = last[1] if last else None
+
+    days = [d.strftime("%Y-%m-%d") for d in sensor_days(name)]
+    run = None
+    emit = lambda s_, e_, st: _append_event(name, s_, e_, st)
+    for date_str in days:
+        if resume and date_str < resume.strftime("%Y-%m-%d"):
+            continue
+        for t, state in _classified_rows(machine, date_str, resume):
+            run = _event_step(run, t, state, emit)
+
+    with g_event_lock:
+        for t, state in g_event_pending.pop(name, []):
+            if run is None or t > run[1]:
+                run = _event_step(run, t, state, emit)
+        g_event_open[name] = run
+
+
+def events_catch_up_all(machines=None):
+    """起動時は全機械、設定の再読み込み後は追加・閾値変更のあった機械（machines）について追いつき処理を行う"""
+    for machine in (config.get('machines', []) if machines is None else machines):
+        try:
+            _events_catch_up(machine)
+        except Exception as e:
+            logger.error(f'イベントログ追いつき処理エラー: {e}', extra={'machine': machine['name']})
+            with g_event_lock:
+                g_event_pending.pop(machine['name'], None)
+                g_event_open.setdefault(machine['name'], None)
+
+
+def track_event(machine_name, t, state):
+    """poll_machine から1行ごとに呼ぶ。状態が変わったら直前の区間を確定して追記する。"""
+    with g_event_lock:
+        if machine_name not in g_event_open:
+            g_event_pending.setdefault(machine_name, []).append((t, state))
+            return
+        g_event_open[machine_name] = _event_step(
+            g_event_open[machine_name], t, state,
+            lambda s_, e_, st: _append_event(machine_name, s_, e_, st))
+
+
+def rebuild_day_events(machine, date_str):
+    """バックフィル等で過去の行が書き換わった日の区間を導出し直す。"""
+    name = machine['name']
+    events, run = _derive_day_events(machine, date_str)
+    with g_event_lock:
+        open_run = g_event_open.get(name)
+        if open_run and open_run[0].strftime("%Y-%m-%d") == date_str:
+            g_event_open[name] = run          # 当日分は最後の区間を継続中として持ち直す
+        elif run is not None:
+            events.append((run[0], _run_end(run[0], run[1]), run[2]))
+        path = _event_path(name, date_str[:7])
+        kept = [e for e in _read_event_file(path) if e[0].strftime("%Y-%m-%d") != date_str]
+        _write_event_file(path, kept + [(s_, e_, st, 0) for s_, e_, st in events])
+
+
+def load_events(machine_name, start_dt, end_dt, include_open=True):
+    """[start_dt, end_dt) と重なる区間を開始時刻順に返す（月ファイルを二分探索）。"""
+    out = []
+    ym = datetime(start_dt.year, start_dt.month, 1)
+    while ym < end_dt:
+        events = _read_event_file(_event_path(machine_name, ym.strftime("%Y-%m")))
+        starts = [e[0] for e in events]
+        # 区間は日付境界で分割済み → start_dt の1日前以降に始まる区間だけ見ればよい
+        i = bisect.bisect_left(starts, start_dt - timedelta(days=1))
+        j = bisect.bisect_left(starts, end_dt)
+        out.extend(e for e in events[i:j] if e[1] > start_dt)
+        ym = (ym + timedelta(days=32)).replace(day=1)
+    if include_open:
+        with g_event_lock:
+            run = g_event_open.get(machine_name)
+        if run is not None:
+            end = _run_end(run[0], run[1])
+            if run[0] < end_dt and end > start_dt:
+                out.append((run[0], end, run[2], int((end - run[0]).total_seconds())))
+    return out
+
+
+def merge_events(events):
+    """日付境界で分割された同じ状態の区間をつなぐ。"""
+    merged = []
+    for s_, e_, st, _ in events:
+        if merged and merged[-1][2] == st and (s_ - merged[-1][1]).total_seconds() <= EVENT_GAP_SEC:
+            merged[-1][1] = max(merged[-1][1], e_)
+        else:
+            merged.append([s_, e_, st])
+    return [(s_, e_, st, int((e_ - s_).total_seconds())) for s_, e_, st in merged]
+
+
+def event_stats(events, start_dt, end_dt):
+    """
+    状態ごとの件数・合計秒（範囲でクリップ）、アラームの MTBF/MTTR、最長の停止・アラーム。
+    MTBF = 稼働（自動・手動・完了）合計秒 / アラーム件数
+    """
+    merged = merge_events(events)
+    counts = {s: 0 for s in STATES}
+    secs   = {s: 0 for s in STATES}
+    longest = {}
+    for s_, e_, st, _ in merged:
+        clipped = (min(e_, end_dt) - max(s_, start_dt)).total_seconds()
+        if clipped <= 0:
+            continue
+        counts[st] += 1
+        secs[st] += int(clipped)
+        if st in ("停止", "アラーム") and clipped > longest.get(st, {}).get('sec', 0):
+            longest[st] = {'start': s_.strftime(EVENT_TS_FMT), 'end': e_.strftime(EVENT_TS_FMT),
+                           'sec': int(clipped)}
+    alarms  = counts["アラーム"]
+    working = sum(secs[s] for s in WORKING_STATES)
+    return {
+        'counts':   counts,
+        'seconds':  secs,
+        'mtbf_sec': round(working / alarms) if alarms else None,
+        'mttr_sec': round(secs["アラーム"] / alarms) if alarms else None,
+        'longest':  longest,
+    }
+
+
+# ===== 欠測バックフィル =====
+# poll_machine で応答が得られなかった分（g_gaps）を、ポーリング周期の空き時間に
+# エッジの分単位リングバッファ（'B'コマンド）から回収して CSV の該当行を書き換える。
+#   backfill:
+#     enabled: true
+#     max_age_min: 235   # これより古い欠測は諦める（エッジ側の保持は240分）
+
+BULK_TIMEOUT_SEC       = 4.0    # 最大188Bの応答を待つため通常コマンドより長め
+BACKFILL_MIN_IDLE_SEC  = 8.0    # 残り時間がこれ未満の周期ではバックフィルしない
+
+
+def _clear_gap(machine_name, ts, bits):
+    with g_gaps_lock:
+        gaps = g_gaps.get(machine_name)
+        if not gaps or ts not in gaps:
+            return
+        gaps[ts] &= ~bits
+        if not gaps[ts]:
+            del gaps[ts]
+        if not gaps:
+            del g_gaps[machine_name]
+
+
+def _backfill_unit(ser, machine, addr, targets):
+    """
+    1ユニット分の欠測時刻 targets（古い順）を 'B' 1往復で回収し {ts: (lux, amp)} を返す。
+    エッジ側の分スロット境界は GW の時計と揃っていないため、応答の経過秒から各分の実時刻を逆算する。
+    """
+    now = datetime.now()
+    k_max = int((now - targets[0]).total_seconds() // 60) + 1
+    ago   = max(1, k_max - BULK_MAX_COUNT + 1)
+    count = k_max - ago + 1
+    data = e220_transact(ser, addr, 'B', machine['name'], timeout_sec=BULK_TIMEOUT_SEC,
+                         args=bytes([ago, count]), frame_len=bulk_frame_len)
+    if is_edge_error(data, EDGE_ERR_UNKNOWN_CMD):
+        g_no_bulk.add(addr)
+        logger.info('Bコマンド非対応のためバックフィル対象外',
+                    extra={'machine': machine['name'], 'addr': addr, 'cmd': 'B'})
+        return None
+    parsed = parse_bulk(data)
+    if parsed is None:
+        return {}
+    elapsed, ago, entries = parsed
+    slot_start = datetime.now() - timedelta(seconds=elapsed)   # 集計中スロットの開始時刻
+    filled = {}
+    for ts in targets:
+        k = int((slot_start - ts).total_seconds() // 60) + 1
+        if ago <= k < ago + len(entries):
+            filled[ts] = entries[k - ago]
+    return filled
+
+
+def backfill_gaps(ser, deadline):
+    """deadline（time.time()）までの空き時間で g_gaps を回収する。メンテコマンドが来たら中断。"""
+    cfg = config.get('backfill') or {}
+    if not cfg.get('enabled', True):
+        return
+    max_age = timedelta(minutes=min(cfg.get('max_age_min', BULK_HIST_MINUTES - 5),
+                                    BULK_HIST_MINUTES - 1))
+    now = datetime.now()
+    machines = {m['name']: m for m in config.get('machines', [])}
+    with g_gaps_lock:
+        for name in list(g_gaps):
+            gaps = g_gaps[name]
+            for ts in [ts for ts in gaps if now - ts > max_age or name not in machines]:
+                del gaps[ts]
+            if not gaps:
+                del g_gaps[name]
+        work = {name: dict(gaps) for name, gaps in g_gaps.items()}
+    metric_set('gw_backfill_pending_minutes', sum(len(g) for g in work.values()))
+
+    for name, gaps in work.items():
+        machine = machines[name]
+        units = {}
+        units[machine['patlite_addr']] = 0x01
+        units[machine['current_addr']] = units.get(machine['current_addr'], 0) | 0x02
+        for addr, bits in units.items():
+            targets = sorted(ts for ts, m in gaps.items() if m & bits)
+            if not targets:
+                continue
+            if addr in g_no_bulk:
+                for ts in targets:
+                    _clear_gap(name, ts, bits)
+                continue
+            if _time.time() + BULK_TIMEOUT_SEC > deadline or not g_cmd_q.empty():
+                return
+            filled = _backfill_unit(ser, machine, addr, targets)
+            if filled is None:   # 旧ファーム: 以降は回収しない
+                for ts in targets:
+                    _clear_gap(name, ts, bits)
+                continue
+            for ts, (lux, amp) in filled.items():
+                got = 0
+                red = yellow = green = current = None
+                if bits & 0x01 and lux:
+                    red, yellow, green = lux
+                    got |= 0x01
+                if bits & 0x02 and amp is not None:
+                    current = amp
+                    got |= 0x02
+                if got and rewrite_sensor_row(name, ts, red, yellow, green, current):
+                    _clear_gap(name, ts, got)
+                    metric_inc('gw_backfill_minutes_total', machine=name)
+                if bits & ~got:
+                    # 応答の範囲内だがエッジ側にも値がない（flags のビットなし）: 次の周期で再要求しない
+                    _clear_gap(name, ts, bits & ~got)
+            for date_str in sorted({ts.strftime("%Y-%m-%d") for ts in filled}):
+                rebuild_day_events(machine, date_str)
+            if filled:
+                logger.info(f'欠測バックフィル: {len(filled)}分',
+                            extra={'machine': name, 'addr': addr, 'cmd': 'B'})
+
+
 def polling_loop():
     global g_serial_obj
     if not HAS_SERIAL:
-        print("[E220] pyserial がインストールされていません。ポーリングを無効化します。")
-        return
+        return   # 起動時に警告済み
     if not config.get('machines'):
-        print("[E220] machines が設定されていません。ポーリングを無効化します。")
-        return
+        logger.warning('[E220] machines が設定されていません。設定されるまでポーリングを待ちます。')
+        while not config.get('machines'):
+            _time.sleep(5)
+    ring_seed_all()
     while True:
         try:
             with serial.Serial(config['serial_port'],
                                config['serial_baud'], timeout=0.1) as ser:
                 logger.info(f'E220接続: {config["serial_port"]}')
-                print(f"[E220] {config['serial_port']} 接続")
                 g_serial_obj = ser
                 while True:
                     # OTAワーカーが動作中はポーリングをスキップ
@@ -300,6 +2388,7 @@ def polling_loop():
                         _time.sleep(1.0)
                         continue
                     t0 = _time.time()
+                    prof = start_profile() if _profiling_cfg().get('poll') else None
                     with serial_lock:
                         # メンテコマンドを優先処理（ポーリング前）
                         while True:
@@ -312,29 +2401,58 @@ def polling_loop():
                             try:
                                 poll_machine(ser, machine)
                             except Exception as e:
-                                print(f"[E220] poll_machine({machine['name']}) エラー: {e}")
+                                logger.error(f'[E220] poll_machine({machine["name"]}) エラー: {e}',
+                                             extra={'machine': machine['name']})
                         # ポーリング中に積まれたコマンドも処理
                         while True:
                             try:
                                 _handle_maint(ser, g_cmd_q.get_nowait())
                             except queue.Empty:
                                 break
+                    if sqlite_recording():
+                        try:
+                            sqlite_flush()
+                        except sqlite3.Error as e:
+                            logger.error(f'[sqlite] 書き込みエラー: {e}')
+                    cycle_sec = _time.time() - t0
+                    if prof is not None:
+                        save_profile(prof, 'poll', 'poll_cycle', cycle_sec)
+                    metric_observe('gw_poll_cycle_seconds', cycle_sec)
+                    metric_set('gw_poll_cycle_last_seconds', cycle_sec)
+                    metric_set('gw_poll_interval_seconds', config['poll_interval_sec'])
                     # 残り時間スリープ（1秒ごとにキューを確認して早期起床）
                     remaining = config['poll_interval_sec'] - (_time.time() - t0)
                     deadline = _time.time() + max(0, remaining)
+                    # 空き時間があれば欠測をバックフィル（OTA開始済みなら見送る）
+                    if g_gaps and remaining > BACKFILL_MIN_IDLE_SEC and serial_lock.acquire(blocking=False):
+                        try:
+                            backfill_gaps(ser, deadline - 1.0)
+                            if sqlite_recording():
+                                sqlite_flush()
+                        except Exception as e:
+                            logger.error(f'[E220] バックフィルエラー: {e}')
+                        finally:
+                            serial_lock.release()
                     while _time.time() < deadline:
                         g_maint_event.clear()
                         g_maint_event.wait(timeout=min(1.0, max(0, deadline - _time.time())))
                         if not g_cmd_q.empty():
                             break
         except Exception as e:
-            logger.warning(f'E220切断/エラー: {e}')
-            print(f"[E220] {e}  5秒後に再接続…")
+            logger.warning(f'E220切断/エラー: {e}  5秒後に再接続…')
             g_serial_obj = None
             _time.sleep(5)
 
 
-threading.Thread(target=polling_loop, daemon=True).start()
+# GW_DISABLE_POLLING=1: ツール（tools/sensor_db.py 等）から import するときはスレッドを起動しない
+# 同じデータディレクトリで複数プロセス（Web ワーカー等）が動く場合、ポーリングと定時処理は
+# data/poller.lock を取れた1プロセスだけが行う。ほかのプロセスは直近分をリングバッファから読む。
+BACKGROUND_ENABLED = (os.environ.get('GW_DISABLE_POLLING') != '1') and acquire_poller_lock()
+if BACKGROUND_ENABLED:
+    threading.Thread(target=events_catch_up_all, daemon=True).start()
+    threading.Thread(target=polling_loop, daemon=True).start()
+elif os.environ.get('GW_DISABLE_POLLING') != '1':
+    logger.info('別プロセスがポーリング中のため、このプロセスは読み出しのみ行います')
 
 
 # ===== 機械設定ヘルパー =====
@@ -343,107 +2461,73 @@ def _get_machine_or_404(machine_name):
     for m in config['machines']:
         if m['name'] == machine_name:
             return m
-    abort(404, description=f"機械 '{machine_name}' が見つかりません。")
-
-
-def _first_machine_name():
-    """後方互換リダイレクト用の最初の機械名"""
-    if config['machines']:
-        return config['machines'][0]['name']
-    return 'default'
-
-
-# ===== 点灯・状態判定 =====
-
-def get_light_status(red, yellow, green, current,
-                     thresholds=None, current_threshold=None):
-    if thresholds is None:
-        thresholds = THRESHOLDS
-    if current_threshold is None:
-        current_threshold = CURRENT_THRESHOLD
-
-    def is_on(color, value):
-        return value >= thresholds[color]
-
-    status = {
-        "red":    "点灯" if is_on("red",    red)    else "消灯",
-        "yellow": "点灯" if is_on("yellow", yellow) else "消灯",
-        "green":  "点灯" if is_on("green",  green)  else "消灯"
-    }
-
-    machine_action = "加工中" if current >= current_threshold else "加工なし"
-
-    state, color = "停止", "gray"
-    r, y, g, m = status["red"], status["yellow"], status["green"], machine_action
+    abort(404, description=f"機械 '{machine_name}' が見つかりません。")
 
-    if r == "消灯" and y == "消灯" and g == "消灯" and m == "加工なし":
-        state, color = "停止", "gray"
-    elif r == "消灯" and y == "消灯" and g == "点灯" and m == "加工なし":
-        state, color = "自動加工中", "green"
-    elif r == "消灯" and y == "点灯" and g == "消灯" and m == "加工なし":
-        state, color = "加工完了", "yellow"
-    elif r == "消灯" and y == "点灯" and g == "点灯" and m == "加工なし":
-        state, color = "自動加工中", "green"
-    elif r == "点灯" and y == "消灯" and g == "消灯" and m == "加工なし":
-        state, color = "アラーム", "red"
-    elif r == "点灯" and y == "消灯" and g == "点灯" and m == "加工なし":
-        state, color = "自動加工中", "green"
-    elif r == "点灯" and y == "点灯" and g == "消灯" and m == "加工なし":
-        state, color = "加工完了", "yellow"
-    elif r == "点灯" and y == "点灯" and g == "点灯" and m == "加工なし":
-        state, color = "自動加工中", "green"
-    elif r == "消灯" and y == "消灯" and g == "消灯" and m == "加工中":
-        state, color = "手動加工中", "blue"
-    elif r == "消灯" and y == "消灯" and g == "点灯" and m == "加工中":
-        state, color = "自動加工中", "green"
-    elif r == "消灯" and y == "点灯" and g == "消灯" and m == "加工中":
-        state, color = "手動加工中", "blue"
-    elif r == "消灯" and y == "点灯" and g == "点灯" and m == "加工中":
-        state, color = "自動加工中", "green"
-    elif r == "点灯" and y == "消灯" and g == "消灯" and m == "加工中":
-        state, color = "手動加工中", "blue"
-    elif r == "点灯" and y == "消灯" and g == "点灯" and m == "加工中":
-        state, color = "自動加工中", "green"
-    elif r == "点灯" and y == "点灯" and g == "消灯" and m == "加工中":
-        state, color = "手動加工中", "blue"
-    elif r == "点灯" and y == "点灯" and g == "点灯" and m == "加工中":
-        state, color = "自動加工中", "green"
 
-    return status, machine_action, state, color
+def _first_machine_name():
+    """後方互換リダイレクト用の最初の機械名"""
+    if config['machines']:
+        return config['machines'][0]['name']
+    return 'default'
 
 
 # ===== 最新データ取得 =====
 
-def get_latest_data(machine_name):
+def _latest_from_memory(machine_name, max_age=timedelta(minutes=5)):
+    """ポーリングスレッドが保持する直近値（5分以内）を get_latest_data と同じ形で返す。"""
+    with g_status_lock:
+        st = g_latest_status.get(machine_name)
+    if st is None:
+        return None
+    ts = datetime.strptime(st['timestamp'], "%Y-%m-%d %H:%M:%S")
+    if datetime.now() - ts > max_age:
+        return None
+    return {
+        "time":      st['timestamp'][11:],
+        "red":       st['red'],
+        "yellow":    st['yellow'],
+        "green":     st['green'],
+        "current":   st['current'],
+        "mask":      st['mask'],
+        "timestamp": st['timestamp']
+    }
+
+
+def _latest_row(machine_name, now):
+    threshold = now - timedelta(minutes=5)
+    # ポーリング担当でないプロセスでも、リングバッファにあれば CSV を開かない
+    rows = ring_rows(machine_name, now.strftime("%Y-%m-%d"), threshold, now + timedelta(seconds=1))
+    if rows:
+        return rows[-1]
     dirpath = os.path.join(DATA_DIR, machine_name)
     if not os.path.isdir(dirpath):
         return None
-    now = datetime.now()
-    threshold = now - timedelta(minutes=5)
     for filename in sorted(os.listdir(dirpath), reverse=True):
         if not filename.endswith(".csv"):
             continue
-        filepath = os.path.join(dirpath, filename)
-        with open(filepath, newline='', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            for row in reversed(list(reader)):
-                try:
-                    row_time = datetime.strptime(
-                        f"{filename[:-4]} {row[0]}", "%Y-%m-%d %H:%M:%S")
-                except Exception:
-                    continue
-                if threshold <= row_time <= now:
-                    return {
-                        "time":      row[0],
-                        "red":       float(row[1]),
-                        "yellow":    float(row[2]),
-                        "green":     float(row[3]),
-                        "current":   float(row[4]),
-                        "timestamp": row_time.strftime("%Y-%m-%d %H:%M:%S")
-                    }
+        rows = list(iter_sensor_rows(machine_name, filename[:-4]))
+        for row in reversed(rows):
+            if threshold <= row[0] <= now:
+                return row
     return None
 
 
+def get_latest_data(machine_name):
+    row = _latest_row(machine_name, datetime.now())
+    if row is None:
+        return None
+    row_time, red, yellow, green, current, mask = row
+    return {
+        "time":      row_time.strftime("%H:%M:%S"),
+        "red":       red,
+        "yellow":    yellow,
+        "green":     green,
+        "current":   current,
+        "mask":      mask,
+        "timestamp": row_time.strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+
 def read_hinmoku_csv(date_str, hinmoku_prefix=None):
     """
     品目CSV: data/hinmoku/<prefix>_YYYYMMDD.csv を読み、(headers, rows, filename) を返す。
@@ -481,11 +2565,34 @@ def read_hinmoku_csv(date_str, hinmoku_prefix=None):
     return headers, records, expected_name
 
 
+_font_checked = False
+
+
 def set_japanese_font():
-    """日本語フォント設定（存在すれば適用）"""
+    """日本語フォント設定（存在すれば適用）。rcParams は共有なので最初の1回だけ書き換える。"""
+    global _font_checked
+    if _font_checked:
+        return
     font_path = "/usr/share/fonts/truetype/vlgothic/VL-Gothic-Regular.ttf"
     if os.path.exists(font_path):
-        plt.rcParams['font.family'] = fm.FontProperties(fname=font_path).get_name()
+        matplotlib.rcParams['font.family'] = fm.FontProperties(fname=font_path).get_name()
+    _font_checked = True
+
+
+def new_figure(**kwargs):
+    """pyplot のグローバル状態を使わない Figure（スレッドごとに独立して描画できる）"""
+    set_japanese_font()
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def save_figure(fig, out_png_path):
+    """一時ファイルに書いてから置き換える（読み取り側・同時描画で書きかけのPNGを見ない）"""
+    os.makedirs(os.path.dirname(out_png_path) or ".", exist_ok=True)
+    tmp = f"{out_png_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    fig.savefig(tmp, format='png')
+    os.replace(tmp, out_png_path)
 
 
 def _day_range(date_str):
@@ -499,53 +2606,36 @@ def _load_minute_colors(date_str, machine_name, start_dt=None, end_dt=None,
                         include_gray=True, thresholds=None, current_threshold=None):
     """
     data/sensor/<machine_name>/<date_str>.csv を読み、分単位の色辞書 {datetime: color} を返す。
+    未取得の分は white（背景と同色 = 描画なし）になる。
     """
-    csv_path = os.path.join(DATA_DIR, machine_name, f"{date_str}.csv")
-    if not os.path.exists(csv_path):
+    if not sensor_day_exists(machine_name, date_str):
         return None
 
-    day_start, day_end = _day_range(date_str)
-    s = max(start_dt, day_start) if start_dt else day_start
-    e = min(end_dt,   day_end)   if end_dt   else day_end
-
     minute_color = {}
-    with open(csv_path, newline='', encoding='utf-8') as f:
-        for row in csv.reader(f):
-            if len(row) < 5:
-                continue
-            try:
-                t = datetime.strptime(date_str + " " + row[0], "%Y-%m-%d %H:%M:%S")
-            except Exception:
-                continue
-            if not (s <= t < e):
-                continue
-            try:
-                r, y, g, c = float(row[1]), float(row[2]), float(row[3]), float(row[4])
-                _, _, _, color = get_light_status(r, y, g, c,
-                                                  thresholds=thresholds,
-                                                  current_threshold=current_threshold)
-                if color == "gray" and not include_gray:
-                    continue
-                minute_color[t] = color
-            except Exception:
-                continue
+    for t, _, color in day_states_between(machine_name, date_str, start_dt, end_dt,
+                                          thresholds, current_threshold):
+        if color == "gray" and not include_gray:
+            continue
+        minute_color[t] = color
 
     return minute_color
 
 
 def _render_day_timeline(date_str, minute_color, out_png_path, title):
     """1日横棒を描画。minute_color に入っている分だけ色を塗る。"""
-    set_japanese_font()
+    t0 = _time.perf_counter()
     day_start, day_end = _day_range(date_str)
 
-    plt.figure(figsize=(14, 2))
-    current = day_start
-    while current < day_end:
-        color = minute_color.get(current)
-        if color:
-            left = (current - day_start).total_seconds()
-            plt.barh(0, 60, left=left, height=0.5, color=color)
-        current += timedelta(minutes=1)
+    fig = new_figure(figsize=(14, 2))
+    ax = fig.add_subplot()
+    # 行の時刻（秒付き）そのままの位置に1分幅で塗る
+    lefts, colors = [], []
+    for t, color in sorted(minute_color.items()):
+        if color and day_start <= t < day_end:
+            lefts.append((t - day_start).total_seconds())
+            colors.append(color)
+    if lefts:
+        ax.barh([0] * len(lefts), 60, left=lefts, height=0.5, color=colors)
 
     xticks, xticklabels = [], []
     hour = day_start
@@ -554,17 +2644,14 @@ def _render_day_timeline(date_str, minute_color, out_png_path, title):
         xticklabels.append("24:00" if hour == day_end else hour.strftime("%H:%M"))
         hour += timedelta(hours=1)
 
-    plt.xticks(xticks, xticklabels)
-    plt.yticks([])
-    plt.xlim(0, (day_end - day_start).total_seconds())
-    plt.title(title)
-    plt.tight_layout()
+    ax.set_xticks(xticks, xticklabels)
+    ax.set_yticks([])
+    ax.set_xlim(0, (day_end - day_start).total_seconds())
+    ax.set_title(title)
+    fig.tight_layout()
 
-    os.makedirs("static", exist_ok=True)
-    if os.path.exists(out_png_path):
-        os.remove(out_png_path)
-    plt.savefig(out_png_path)
-    plt.close()
+    save_figure(fig, out_png_path)
+    metric_observe('gw_render_seconds', _time.perf_counter() - t0, kind='day_timeline')
 
 
 def generate_graph_image_unified(
@@ -583,18 +2670,26 @@ def generate_graph_image_unified(
     - 日全体: start_dt/end_dt を渡さない
     - 区間のみ: start_dt/end_dt を渡す（[start_dt, end_dt)）
     - out_png_path 未指定時はデイリーの既定パスを使う
+    同じ出力先への描画が実行中なら、その完了を待って結果を共有する。
     """
-    csv_path = os.path.join(DATA_DIR, machine_name, f"{date_str}.csv")
-    if not os.path.exists(csv_path):
-        return False
-
     if out_png_path is None:
         image_filename = f"{machine_name}_{date_str}_graph.png"
         out_png_path = os.path.join("static", image_filename)
+    return single_flight(
+        ('graph', out_png_path), _generate_graph_image,
+        date_str, machine_name, start_dt, end_dt, out_png_path,
+        include_gray, skip_if_up_to_date, thresholds, current_threshold)
+
+
+def _generate_graph_image(date_str, machine_name, start_dt, end_dt, out_png_path,
+                          include_gray, skip_if_up_to_date, thresholds, current_threshold):
+    csv_mtime = sensor_day_mtime(machine_name, date_str)
+    if csv_mtime is None:
+        return False
 
     is_full_day = (start_dt is None and end_dt is None)
     if skip_if_up_to_date and is_full_day and os.path.exists(out_png_path):
-        if os.path.getmtime(csv_path) <= os.path.getmtime(out_png_path):
+        if csv_mtime <= os.path.getmtime(out_png_path):
             return True
 
     minute_color = _load_minute_colors(
@@ -636,7 +2731,11 @@ def generate_graph_image_for_intervals(date_str, intervals, out_png_path, machin
     """複数区間の合成グラフを1枚に描画。"""
     if not intervals:
         return False
+    return single_flight(('graph', out_png_path), _generate_graph_image_for_intervals,
+                         date_str, intervals, out_png_path, machine_name)
 
+
+def _generate_graph_image_for_intervals(date_str, intervals, out_png_path, machine_name):
     merged = {}
     for s_dt, e_dt in intervals:
         mc = _load_minute_colors(date_str, machine_name,
@@ -806,80 +2905,997 @@ def get_current_processing_items(now=None, machine_config=None):
 
 def summarize_states_for_interval(date_str, start_dt, end_dt, machine_name,
                                    thresholds=None, current_threshold=None):
-    csv_path = os.path.join(DATA_DIR, machine_name, f"{date_str}.csv")
-    if not os.path.exists(csv_path):
-        return None
+    key = ('summary', machine_name, date_str, start_dt, end_dt,
+           repr(thresholds), current_threshold)
+    result = single_flight(key, _summarize_states_for_interval, date_str, start_dt, end_dt,
+                           machine_name, thresholds, current_threshold)
+    return dict(result) if result is not None else None
 
-    base_date = datetime.strptime(date_str, "%Y-%m-%d")
-    day_start = datetime.combine(base_date, datetime.strptime("00:00:00", "%H:%M:%S").time())
-    day_end   = day_start + timedelta(days=1)
 
+def _summarize_states_for_interval(date_str, start_dt, end_dt, machine_name,
+                                   thresholds, current_threshold):
+    if not sensor_day_exists(machine_name, date_str):
+        return None
+
+    day_start, day_end = _day_range(date_str)
     s = max(start_dt, day_start)
     e = min(end_dt,   day_end)
+    secs = {state: 0 for state in STATES}
     if not (s < e):
-        return {k: 0 for k in ["自動加工中", "手動加工中", "加工完了", "アラーム", "停止"]}
+        return secs
 
-    states = ["自動加工中", "手動加工中", "加工完了", "アラーム", "停止"]
-    secs = {state: 0 for state in states}
+    for _, state, _ in day_states_between(machine_name, date_str, s, e,
+                                          thresholds, current_threshold):
+        secs[state] += 60
 
-    with open(csv_path, newline="", encoding="utf-8") as f:
-        for row in csv.reader(f):
-            if len(row) < 5:
-                continue
+    return secs
+
+
+def summarize_states_for_intervals(date_str, intervals, machine_name,
+                                    thresholds=None, current_threshold=None):
+    total = {k: 0 for k in STATES}
+    if not intervals:
+        return total
+    for s_dt, e_dt in intervals:
+        secs = summarize_states_for_interval(date_str, s_dt, e_dt, machine_name,
+                                              thresholds=thresholds,
+                                              current_threshold=current_threshold)
+        if secs is None:
+            continue
+        for k, v in secs.items():
+            total[k] += v
+    return total
+
+
+def summarize_states_full_day_hours(date_str, machine_name,
+                                     thresholds=None, current_threshold=None):
+    key = ('summary', machine_name, date_str, 'hours', repr(thresholds), current_threshold)
+    result = single_flight(key, _summarize_states_full_day_hours, date_str, machine_name,
+                           thresholds, current_threshold)
+    return dict(result) if result is not None else None
+
+
+def _summarize_states_full_day_hours(date_str, machine_name, thresholds, current_threshold):
+    if not sensor_day_exists(machine_name, date_str):
+        return None
+    secs = {s: 0 for s in STATES}
+    for state, _ in day_states(machine_name, date_str, thresholds, current_threshold)[1]:
+        secs[state] += 60
+    return {k: round(v / 3600.0, 2) for k, v in secs.items()}
+
+
+# ===== ロールアップ（時・日・週の集計ピラミッド） =====
+# 分単位の生データとは別に、時・日・週単位の集計を保持して長期間の推移を少ない行数で読む。
+#   data/rollup/<機械名>/hour/YYYY-MM.csv  月ごと
+#   data/rollup/<機械名>/day/YYYY.csv      年ごと
+#   data/rollup/<機械名>/week/YYYY.csv     週（月曜始まり）の月曜日の年ごと
+#   data/rollup/<機械名>/meta.json         {fingerprint: 判定閾値, days: {日付: 集計元CSVのmtime}}
+# 1行: start, n_patlite, n_current, 状態別秒数×6（STATES順）, 赤/黄/緑の min,max,mean, 電流 mean,max
+# 集計は読み出し時に必要な日だけ作り直す（集計元CSVの mtime か判定閾値が変わった日）。
+
+ROLLUP_DIR = "data/rollup"
+ROLLUP_RES = {'minute': 60, 'hour': 3600, 'day': 86400, 'week': 7 * 86400}   # 粒度 → 秒
+ROLLUP_START_FMT = {'hour': "%Y-%m-%d %H:%M", 'day': "%Y-%m-%d", 'week': "%Y-%m-%d"}
+LUX_KEYS = ('red', 'yellow', 'green')
+
+g_rollup_lock  = threading.Lock()
+g_rollup_cache = {}   # {path: (mtime, [agg, ...])}
+
+
+def _rollup_new(start):
+    return {'start': start, 'n_patlite': 0, 'n_current': 0,
+            'sec': {s: 0 for s in STATES},
+            'lux': {c: [None, None, 0.0] for c in LUX_KEYS},   # [min, max, 合計]
+            'cur': [0.0, None]}                                # [合計, max]
+
+
+def _rollup_add(agg, values, mask, state, sec):
+    agg['sec'][state] += sec
+    if mask & VALID_PATLITE:
+        agg['n_patlite'] += 1
+        for c, v in zip(LUX_KEYS, values[:3]):
+            mn, mx, total = agg['lux'][c]
+            agg['lux'][c] = [v if mn is None else min(mn, v), v if mx is None else max(mx, v), total + v]
+    if mask & VALID_CURRENT:
+        agg['n_current'] += 1
+        v = values[3]
+        agg['cur'] = [agg['cur'][0] + v, v if agg['cur'][1] is None else max(agg['cur'][1], v)]
+
+
+def _rollup_merge(dst, src):
+    for s_ in STATES:
+        dst['sec'][s_] += src['sec'][s_]
+    for c in LUX_KEYS:
+        a, b = dst['lux'][c], src['lux'][c]
+        dst['lux'][c] = [b[0] if a[0] is None else (a[0] if b[0] is None else min(a[0], b[0])),
+                         b[1] if a[1] is None else (a[1] if b[1] is None else max(a[1], b[1])),
+                         a[2] + b[2]]
+    a, b = dst['cur'], src['cur']
+    dst['cur'] = [a[0] + b[0], b[1] if a[1] is None else (a[1] if b[1] is None else max(a[1], b[1]))]
+    dst['n_patlite'] += src['n_patlite']
+    dst['n_current'] += src['n_current']
+    return dst
+
+
+def _rollup_to_row(agg, res):
+    def num(v):
+        return '' if v is None else round(v, 2)
+    row = [agg['start'].strftime(ROLLUP_START_FMT[res]), agg['n_patlite'], agg['n_current']]
+    row += [agg['sec'][s_] for s_ in STATES]
+    for c in LUX_KEYS:
+        mn, mx, total = agg['lux'][c]
+        row += [num(mn), num(mx), num(total / agg['n_patlite'] if agg['n_patlite'] else None)]
+    total, mx = agg['cur']
+    row += [num(total / agg['n_current'] if agg['n_current'] else None), num(mx)]
+    return row
+
+
+def _rollup_from_row(row, res):
+    def num(v):
+        return None if v == '' else float(v)
+    agg = _rollup_new(datetime.strptime(row[0], ROLLUP_START_FMT[res]))
+    agg['n_patlite'], agg['n_current'] = int(row[1]), int(row[2])
+    agg['sec'] = {s_: int(v) for s_, v in zip(STATES, row[3:3 + len(STATES)])}
+    i = 3 + len(STATES)
+    for c in LUX_KEYS:
+        mn, mx, mean = num(row[i]), num(row[i + 1]), num(row[i + 2])
+        agg['lux'][c] = [mn, mx, (mean or 0.0) * agg['n_patlite']]
+        i += 3
+    mean, mx = num(row[i]), num(row[i + 1])
+    agg['cur'] = [(mean or 0.0) * agg['n_current'], mx]
+    return agg
+
+
+def rollup_public(agg, res):
+    """API・テンプレート向けの辞書（平均値を計算し、状態は時間単位）"""
+    n_p, n_c = agg['n_patlite'], agg['n_current']
+    return {
+        'start':   agg['start'].strftime(ROLLUP_START_FMT.get(res, EVENT_TS_FMT)),
+        'hours':   {s_: round(v / 3600.0, 2) for s_, v in agg['sec'].items()},
+        'lux':     {c: {'min': agg['lux'][c][0], 'max': agg['lux'][c][1],
+                        'mean': round(agg['lux'][c][2] / n_p, 1) if n_p else None}
+                    for c in LUX_KEYS},
+        'current': {'mean': round(agg['cur'][0] / n_c, 2) if n_c else None, 'max': agg['cur'][1]},
+    }
+
+
+def _rollup_path(machine_name, res, key):
+    return os.path.join(ROLLUP_DIR, machine_name, res, f"{key}.csv")
+
+
+def _rollup_read(path, res):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return []
+    cached = g_rollup_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, newline='', encoding='utf-8') as f:
+        aggs = [_rollup_from_row(row, res) for row in csv.reader(f) if row]
+    g_rollup_cache[path] = (mtime, aggs)
+    return aggs
+
+
+def _rollup_replace(path, res, drop, new_aggs):
+    """集計ファイルから drop(start) が真の行を除き new_aggs を加えて書き直す（一時ファイル → os.replace）。"""
+    kept = [a for a in _rollup_read(path, res) if not drop(a['start'])]
+    aggs = sorted(kept + new_aggs, key=lambda a: a['start'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerows(_rollup_to_row(a, res) for a in aggs)
+    os.replace(tmp, path)
+
+
+def _rollup_day_hours(machine, date_str):
+    """1日分の生データ → 時単位の集計リスト"""
+    thresholds  = machine.get('patlite_thresholds', THRESHOLDS)
+    curr_thresh = machine.get('current_threshold', CURRENT_THRESHOLD)
+    sec = config.get('poll_interval_sec', 60)
+    hours = {}
+    for t, r_, y, g_, c, mask in iter_sensor_rows(machine['name'], date_str):
+        _, _, state, _ = classify_reading(r_, y, g_, c, mask, thresholds=thresholds,
+                                          current_threshold=curr_thresh)
+        h = t.replace(minute=0, second=0)
+        if h not in hours:
+            hours[h] = _rollup_new(h)
+        _rollup_add(hours[h], (r_, y, g_, c), mask, state, sec)
+    return [hours[h] for h in sorted(hours)]
+
+
+def ensure_rollups(machine, start_date, end_date):
+    """[start_date, end_date] の各日について、集計が古ければ時・日・週の集計を作り直す。"""
+    name = machine['name']
+    meta_path = os.path.join(ROLLUP_DIR, name, 'meta.json')
+    with g_rollup_lock:
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        fp = thresholds_fingerprint(machine)
+        if meta.get('fingerprint') != fp:
+            meta = {'fingerprint': fp, 'days': {}}   # 閾値が変わった → 全日を作り直す
+
+        dirty = {}
+        d = start_date
+        while d <= end_date:
+            ds = d.strftime("%Y-%m-%d")
+            mtime = sensor_day_mtime(name, ds)
+            if mtime is not None and meta['days'].get(ds) != mtime:
+                dirty[ds] = mtime
+            d += timedelta(days=1)
+        if not dirty:
+            return
+
+        hours_by_month, days_by_year = {}, {}
+        for ds in dirty:
+            hours = _rollup_day_hours(machine, ds)
+            hours_by_month.setdefault(ds[:7], []).extend(hours)
+            day = _rollup_new(datetime.strptime(ds, "%Y-%m-%d"))
+            for h in hours:
+                _rollup_merge(day, h)
+            days_by_year.setdefault(ds[:4], []).append(day)
+        dirty_days = {datetime.strptime(ds, "%Y-%m-%d").date() for ds in dirty}
+        for ym, aggs in hours_by_month.items():
+            _rollup_replace(_rollup_path(name, 'hour', ym), 'hour',
+                            lambda t: t.date() in dirty_days, aggs)
+        for y, aggs in days_by_year.items():
+            _rollup_replace(_rollup_path(name, 'day', y), 'day',
+                            lambda t: t.date() in dirty_days, aggs)
+
+        # 週: 作り直した日を含む週を日集計から再計算
+        mondays = {d_ - timedelta(days=d_.weekday()) for d_ in dirty_days}
+        weeks_by_year = {}
+        for mon in mondays:
+            week = _rollup_new(datetime.combine(mon, time(0, 0)))
+            sun = mon + timedelta(days=6)
+            for y in {mon.year, sun.year}:
+                for a in _rollup_read(_rollup_path(name, 'day', y), 'day'):
+                    if mon <= a['start'].date() <= sun:
+                        _rollup_merge(week, a)
+            weeks_by_year.setdefault(mon.year, []).append(week)
+        for y, aggs in weeks_by_year.items():
+            _rollup_replace(_rollup_path(name, 'week', y), 'week',
+                            lambda t: t.date() in mondays, aggs)
+
+        meta['days'].update(dirty)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+
+def pick_resolution(start_dt, end_dt, width_px):
+    """1ピクセルあたりの時間に収まる、最も粗い粒度を選ぶ。"""
+    per_px = (end_dt - start_dt).total_seconds() / max(1, width_px)
+    best = 'minute'
+    for res, sec in ROLLUP_RES.items():
+        if sec <= per_px:
+            best = res
+    return best
+
+
+def query_rollup(machine, start_dt, end_dt, res=None, width_px=800):
+    """
+    [start_dt, end_dt) の集計を (粒度, [agg, ...]) で返す。res 未指定時は width_px から自動選択。
+    週・日・時の集計は境界が範囲からはみ出る場合がある（バケット単位で返す）。
+    """
+    if res is None:
+        res = pick_resolution(start_dt, end_dt, width_px)
+    name = machine['name']
+    last_day = (end_dt - timedelta(microseconds=1)).date()
+
+    if res == 'minute':
+        sec = config.get('poll_interval_sec', 60)
+        thresholds  = machine.get('patlite_thresholds', THRESHOLDS)
+        curr_thresh = machine.get('current_threshold', CURRENT_THRESHOLD)
+        out = []
+        d = start_dt.date()
+        while d <= last_day:
+            for t, r_, y, g_, c, mask in iter_sensor_rows(name, d.strftime("%Y-%m-%d"),
+                                                          start_dt, end_dt):
+                _, _, state, _ = classify_reading(r_, y, g_, c, mask, thresholds=thresholds,
+                                                  current_threshold=curr_thresh)
+                agg = _rollup_new(t)
+                _rollup_add(agg, (r_, y, g_, c), mask, state, sec)
+                out.append(agg)
+            d += timedelta(days=1)
+        return res, out
+
+    first = start_dt.date() - timedelta(days=start_dt.weekday()) if res == 'week' else start_dt.date()
+    ensure_rollups(machine, first, last_day)
+    if res == 'hour':
+        keys, k = [], datetime(start_dt.year, start_dt.month, 1)
+        while k.date() <= last_day:
+            keys.append(k.strftime("%Y-%m"))
+            k = (k + timedelta(days=32)).replace(day=1)
+    else:
+        keys = [str(y) for y in range(first.year, last_day.year + 1)]
+    span = timedelta(seconds=ROLLUP_RES[res])
+    out = []
+    for key in keys:
+        out.extend(a for a in _rollup_read(_rollup_path(name, res, key), res)
+                   if a['start'] < end_dt and a['start'] + span > start_dt)
+    return res, out
+
+
+# ===== ページキャッシュ =====
+# 終わった日・月のページ（HTML）を ETag をキーにメモリと data/pagecache/ に保持し、matplotlib を含む
+# 描画を丸ごと省く。ETag には元CSVの mtime と判定閾値が入っているので、バックフィル・閾値変更・
+# デプロイで自動的に別キーになる（古いものは LRU で追い出される）。
+# 参照している生成PNGが消えていたらキャッシュを使わず描き直す。
+#   page_cache:
+#     enabled: true
+#     memory_mb: 16
+#     disk_mb: 200
+#     warm_at: "00:05"   # 前日分のページを先に描いておく時刻
+
+PAGE_CACHE_DIR = "data/pagecache"
+PAGE_STATIC_RE = re.compile(rb'/static/([^"?]+)')
+
+g_page_mem      = OrderedDict()     # {etag: bytes}
+g_page_mem_size = 0
+g_page_disk     = None              # {etag: size}（起動後の初回アクセスで読み込む）
+g_page_lock     = threading.Lock()
+
+metric_define('gw_page_cache_hits_total', 'counter', 'ページキャッシュのヒット数（tier=memory/disk）')
+metric_define('gw_page_cache_misses_total', 'counter', 'ページキャッシュのミス数')
+
+
+def _page_cache_cfg():
+    cfg = config.get('page_cache') or {}
+    return (cfg.get('enabled', True),
+            int(cfg.get('memory_mb', 16) * 1024 * 1024),
+            int(cfg.get('disk_mb', 200) * 1024 * 1024))
+
+
+def _page_statics_exist(body):
+    return all(os.path.exists(os.path.join("static", fn.decode()))
+               for fn in PAGE_STATIC_RE.findall(body))
+
+
+def _page_mem_put(etag, body, mem_limit):
+    """呼び出し側で g_page_lock を保持すること"""
+    global g_page_mem_size
+    if etag in g_page_mem:
+        g_page_mem_size -= len(g_page_mem.pop(etag))
+    g_page_mem[etag] = body
+    g_page_mem_size += len(body)
+    while g_page_mem_size > mem_limit and g_page_mem:
+        _, old = g_page_mem.popitem(last=False)
+        g_page_mem_size -= len(old)
+
+
+def _page_disk_index():
+    """呼び出し側で g_page_lock を保持すること"""
+    global g_page_disk
+    if g_page_disk is None:
+        g_page_disk = {}
+        if os.path.isdir(PAGE_CACHE_DIR):
+            files = [(os.path.getmtime(os.path.join(PAGE_CACHE_DIR, fn)), fn)
+                     for fn in os.listdir(PAGE_CACHE_DIR) if fn.endswith('.html')]
+            for _, fn in sorted(files):      # 古い順 = 追い出し順
+                g_page_disk[fn[:-5]] = os.path.getsize(os.path.join(PAGE_CACHE_DIR, fn))
+    return g_page_disk
+
+
+def page_cache_get(etag):
+    enabled, mem_limit, _ = _page_cache_cfg()
+    if not enabled:
+        return None
+    with g_page_lock:
+        body = g_page_mem.get(etag)
+        if body is not None:
+            g_page_mem.move_to_end(etag)
+        tier = 'memory'
+        if body is None and etag in _page_disk_index():
             try:
-                t = datetime.strptime(date_str + " " + row[0], "%Y-%m-%d %H:%M:%S")
-            except Exception:
-                continue
-            if not (s <= t < e):
-                continue
+                path = os.path.join(PAGE_CACHE_DIR, f"{etag}.html")
+                with open(path, 'rb') as f:
+                    body = f.read()
+                os.utime(path)
+                g_page_disk[etag] = g_page_disk.pop(etag)
+                _page_mem_put(etag, body, mem_limit)
+                tier = 'disk'
+            except OSError:
+                g_page_disk.pop(etag, None)
+    if body is None or not _page_statics_exist(body):
+        metric_inc('gw_page_cache_misses_total')
+        return None
+    metric_inc('gw_page_cache_hits_total', tier=tier)
+    return body
+
+
+def page_cache_put(etag, body):
+    enabled, mem_limit, disk_limit = _page_cache_cfg()
+    if not enabled:
+        return
+    os.makedirs(PAGE_CACHE_DIR, exist_ok=True)
+    path = os.path.join(PAGE_CACHE_DIR, f"{etag}.html")
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(body)
+    os.replace(tmp, path)
+    with g_page_lock:
+        _page_mem_put(etag, body, mem_limit)
+        disk = _page_disk_index()
+        disk.pop(etag, None)
+        disk[etag] = len(body)
+        total = sum(disk.values())
+        for old in list(disk):
+            if total <= disk_limit:
+                break
+            total -= disk.pop(old)
             try:
-                r, y, g, c = float(row[1]), float(row[2]), float(row[3]), float(row[4])
-                _, _, state, _ = get_light_status(r, y, g, c,
-                                                  thresholds=thresholds,
-                                                  current_threshold=current_threshold)
-                secs[state] += 60
-            except Exception:
+                os.remove(os.path.join(PAGE_CACHE_DIR, f"{old}.html"))
+            except FileNotFoundError:
+                pass
+
+
+def page_cache_warm_loop():
+    """毎日 warm_at に前日分（月末なら前月分も）のページを描いてキャッシュに入れる"""
+    while True:
+        hh, mm = str((config.get('page_cache') or {}).get('warm_at', '00:05')).split(':')
+        now = datetime.now()
+        at = now.replace(hour=int(hh), minute=int(mm), second=0, microsecond=0)
+        if at <= now:
+            at += timedelta(days=1)
+        _time.sleep((at - now).total_seconds())
+        if not _page_cache_cfg()[0]:
+            continue
+        yday = (datetime.now() - timedelta(days=1)).date()
+        paths = []
+        for m in config.get('machines', []):
+            base = f"/machine/{m['name']}/date/{yday}"
+            paths += [f"{base}/overview", f"{base}/summary", f"{base}/hinmoku"]
+            if (yday + timedelta(days=1)).day == 1:
+                mbase = f"/machine/{m['name']}/month/{yday.strftime('%Y-%m')}"
+                paths += [f"{mbase}/overview", f"{mbase}/summary"]
+        t0 = _time.time()
+        client = app.test_client()
+        for p in paths:
+            try:
+                client.get(p, headers={'X-GW-Sync': '1'})
+            except Exception as e:
+                logger.warning(f'[pagecache] 事前描画失敗 {p}: {e}')
+        logger.info(f'[pagecache] 事前描画 {len(paths)} ページ {_time.time() - t0:.1f}s')
+
+
+# ===== バックグラウンドジョブ =====
+# 時間のかかる処理（全機械レポート・描画の重いページ）を OTA と同じ「ジョブ」としてスレッドで実行し、
+# ブラウザは進捗ページ（/jobs/<id>）をポーリングして、終われば結果へ移動する。
+# 同時実行は jobs.workers 件まで（超えた分は queued で待つ）。同じ kind + key の実行中ジョブがあれば
+# それを返して二重に走らせない。状態と結果は data/jobs/ に保存し、ttl_hours を過ぎたら消す。
+# 処理側は job_progress() で進捗を報告し、キャンセル要求があればそこで JobCancelled が送出される。
+# Web ワーカーが複数プロセスのときは、別プロセスの進捗ページが data/jobs/<id>.json を読む。
+# 実行開始時と JOB_SAVE_SEC ごとの進捗で保存し、実行プロセスの pid が生きていれば実行中として扱う。
+# 別プロセスからのキャンセルは data/jobs/<id>.cancel を置き、実行側が進捗の保存時に拾う。
+#   jobs:
+#     workers: 2
+#     ttl_hours: 24
+#     pages: true                # 月ページ・品目の多い日別概要を描くときはジョブにして進捗ページへ
+#     heavy_hinmoku_rows: 20     # 日別概要をジョブにする品目行数
+
+JOB_DIR = "data/jobs"
+JOB_ID_RE = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+JOB_ACTIVE = ('queued', 'running')
+JOB_SAVE_SEC = 2.0          # 実行中の進捗を data/jobs/ に保存する間隔
+JOB_PRIVATE = ('cancel', 'saved')
+
+g_jobs      = {}            # {job_id: {kind, key, title, status, progress, message, ts, pid, cancel, saved, ...}}
+g_jobs_lock = threading.Lock()
+g_job_slots = None          # threading.BoundedSemaphore（最初の投入時に jobs.workers で作る）
+g_job_local = threading.local()     # ジョブ実行中のスレッドの job_id
+
+metric_define('gw_jobs_total', 'counter', '終了したバックグラウンドジョブの数（kind, status）')
+metric_define('gw_jobs_active', 'gauge', '実行中・待ち中のバックグラウンドジョブ数')
+
+
+class JobCancelled(Exception):
+    """job_progress() でキャンセル要求を検出した"""
+
+
+@app.errorhandler(JobCancelled)
+def _job_cancelled(e):
+    return 'キャンセルしました', 409
+
+
+def _jobs_cfg():
+    cfg = config.get('jobs') or {}
+    return (max(1, int(cfg.get('workers', 2))),
+            float(cfg.get('ttl_hours', 24)) * 3600,
+            cfg.get('pages', True),
+            int(cfg.get('heavy_hinmoku_rows', 20)))
+
+
+def _job_public(job):
+    return {k: v for k, v in job.items() if k not in JOB_PRIVATE}
+
+
+def _job_save(job_id, job):
+    """呼び出し側で g_jobs_lock を保持すること"""
+    os.makedirs(JOB_DIR, exist_ok=True)
+    path = os.path.join(JOB_DIR, f"{job_id}.json")
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(_job_public(job), f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+    job['saved'] = _time.time()
+
+
+def _job_cancel_path(job_id):
+    return os.path.join(JOB_DIR, f"{job_id}.cancel")
+
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _job_update(job_id, save=False, **fields):
+    with g_jobs_lock:
+        job = g_jobs[job_id]
+        job.update(fields)
+        if save:
+            _job_save(job_id, job)
+        metric_set('gw_jobs_active', sum(1 for j in g_jobs.values() if j['status'] in JOB_ACTIVE))
+
+
+def job_get(job_id):
+    """ジョブの状態（メモリになければ data/jobs/ から）。見つからなければ None。"""
+    if not JOB_ID_RE.fullmatch(job_id):
+        return None
+    with g_jobs_lock:
+        job = g_jobs.get(job_id)
+        if job is not None:
+            return _job_public(job)
+    try:
+        with open(os.path.join(JOB_DIR, f"{job_id}.json"), encoding='utf-8') as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if job.get('status') in JOB_ACTIVE and not _pid_alive(job.get('pid')):   # 実行中に GW が止まった
+        job.update({'status': 'failed', 'message': 'GW の再起動で中断しました'})
+    return job
+
+
+def jobs_cleanup():
+    """終わってから ttl_hours を過ぎたジョブを、メモリと data/jobs/ から消す"""
+    ttl = _jobs_cfg()[1]
+    now = _time.time()
+    with g_jobs_lock:
+        for jid in [j for j, v in g_jobs.items()
+                    if v['status'] not in JOB_ACTIVE and now - v['ts'] > ttl]:
+            del g_jobs[jid]
+        if not os.path.isdir(JOB_DIR):
+            return
+        for fn in os.listdir(JOB_DIR):
+            path = os.path.join(JOB_DIR, fn)
+            if fn.split('.')[0] in g_jobs:
                 continue
+            try:
+                if now - os.path.getmtime(path) > ttl:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def job_check_cancel():
+    """ジョブ内でキャンセル要求があれば JobCancelled を送出する"""
+    job_id = getattr(g_job_local, 'job_id', None)
+    if job_id is not None:
+        with g_jobs_lock:
+            if g_jobs[job_id]['cancel']:
+                raise JobCancelled()
+
+
+def job_progress(progress, message=''):
+    """
+    ジョブ内から進捗を報告する（ジョブ外では何もしない）。キャンセル要求があれば JobCancelled。
+    JOB_SAVE_SEC ごとに data/jobs/ へ保存し、別プロセスからのキャンセル要求（<id>.cancel）を確認する。
+    """
+    job_id = getattr(g_job_local, 'job_id', None)
+    if job_id is None:
+        return
+    with g_jobs_lock:
+        job = g_jobs[job_id]
+        job.update({'progress': progress, 'message': message})
+        if _time.time() - job.get('saved', 0) >= JOB_SAVE_SEC:
+            if os.path.exists(_job_cancel_path(job_id)):
+                job['cancel'] = True
+            _job_save(job_id, job)
+        if job['cancel']:
+            raise JobCancelled()
+
+
+def in_job():
+    return getattr(g_job_local, 'job_id', None) is not None
+
+
+def _job_runner(job_id, fn, args):
+    global g_job_slots
+    with g_jobs_lock:
+        if g_job_slots is None:
+            g_job_slots = threading.BoundedSemaphore(_jobs_cfg()[0])
+        job = g_jobs[job_id]
+    fields = {'job': job_id}
+    with g_job_slots:
+        if os.path.exists(_job_cancel_path(job_id)):
+            job['cancel'] = True
+        if job['cancel']:
+            status = 'cancelled'
+            _job_update(job_id, save=True, status=status, message='キャンセルしました', ts=_time.time())
+            metric_inc('gw_jobs_total', kind=job['kind'], status=status)
+            return
+        _job_update(job_id, save=True, status='running', message='実行中')
+        logger.info(f'ジョブ開始: {job["title"]}', extra=fields)
+        t0 = _time.time()
+        g_job_local.job_id = job_id
+        try:
+            result = fn(*args) or {}
+            status = 'done'
+            _job_update(job_id, save=True, status=status, progress=100, message='完了',
+                        ts=_time.time(), **result)
+            logger.info(f'ジョブ完了: {job["title"]} {_time.time() - t0:.1f}s', extra=fields)
+        except JobCancelled:
+            status = 'cancelled'
+            _job_update(job_id, save=True, status=status, message='キャンセルしました', ts=_time.time())
+            logger.info(f'ジョブ中止: {job["title"]}', extra=fields)
+        except Exception as e:
+            status = 'failed'
+            _job_update(job_id, save=True, status=status, message=str(e), ts=_time.time())
+            logger.error(f'ジョブ失敗: {job["title"]}: {e}', extra=fields)
+        finally:
+            g_job_local.job_id = None
+    metric_inc('gw_jobs_total', kind=job['kind'], status=status)
+
+
+def job_submit(kind, key, title, fn, *args):
+    """
+    fn(*args) をジョブとして投入し job_id を返す。同じ kind + key のジョブが待ち中・実行中ならその job_id。
+    fn は結果として job に足すフィールドの dict（result_url など）を返す。
+    """
+    jobs_cleanup()
+    with g_jobs_lock:
+        for jid, job in g_jobs.items():
+            if job['kind'] == kind and job['key'] == key and job['status'] in JOB_ACTIVE:
+                return jid
+        job_id = str(uuid.uuid4())
+        g_jobs[job_id] = {'kind': kind, 'key': key, 'title': title, 'status': 'queued',
+                          'progress': 0, 'message': '開始待ち', 'ts': _time.time(), 'pid': os.getpid(),
+                          'cancel': False}
+        _job_save(job_id, g_jobs[job_id])
+    threading.Thread(target=_job_runner, args=(job_id, fn, args), daemon=True).start()
+    return job_id
+
+
+def job_cancel(job_id):
+    """
+    キャンセルを要求する。待ち中・実行中のジョブがなければ False。
+    別プロセスで実行中のジョブには data/jobs/<id>.cancel を置く（実行側が次の進捗保存で拾う）。
+    """
+    with g_jobs_lock:
+        job = g_jobs.get(job_id)
+        if job is not None:
+            if job['status'] not in JOB_ACTIVE:
+                return False
+            job['cancel'] = True
+            job['message'] = 'キャンセル中...'
+            return True
+    job = job_get(job_id)
+    if job is None or job['status'] not in JOB_ACTIVE:
+        return False
+    with open(_job_cancel_path(job_id), 'w', encoding='utf-8'):
+        pass
+    return True
+
+
+def _page_job(path):
+    """重いページをこのスレッドで描き、結果の HTML を data/jobs/<id>.html に置く"""
+    job_id = g_job_local.job_id
+    r = app.test_client().get(path)
+    if r.status_code != 200:
+        job_check_cancel()          # キャンセルで描画が中断された（409）
+        raise RuntimeError(f'{path}: HTTP {r.status_code}')
+    out = os.path.join(JOB_DIR, f"{job_id}.html")
+    with open(out + '.tmp', 'wb') as f:
+        f.write(r.get_data())
+    os.replace(out + '.tmp', out)
+    return {'result_url': f'/jobs/{job_id}/result'}
+
+
+def heavy_when(predicate):
+    """
+    cache_by_day / cache_by_month の内側に付ける。predicate(machine_name, key) が真のページは
+    キャッシュにも 304 にも当たらなければジョブで描き、進捗ページへリダイレクトする。
+    """
+    def deco(view):
+        view.heavy = predicate
+        return view
+    return deco
+
+
+def _page_job_response(heavy, etag, title):
+    """ジョブにすべきならリダイレクト応答、そうでなければ None"""
+    if heavy is None or in_job() or not _jobs_cfg()[2] or request.headers.get('X-GW-Sync') == '1':
+        return None
+    if not heavy():
+        return None
+    job_id = job_submit('page', etag, title, _page_job, request.full_path)
+    return redirect(url_for('job_page', job_id=job_id))
+
+
+def _many_hinmoku_rows(machine_name, date):
+    machine = _get_machine_or_404(machine_name)
+    _, records, _ = read_hinmoku_csv(date, hinmoku_prefix=machine.get('hinmoku_prefix'))
+    return len(records or []) >= _jobs_cfg()[3]
+
+
+@app.route('/jobs/<job_id>')
+def job_page(job_id):
+    job = job_get(job_id)
+    if job is None:
+        abort(404, description='ジョブが見つかりません（期限切れの可能性があります）。')
+    return render_template('job.html', job_id=job_id, job=job)
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    if job_get(job_id) is None:
+        abort(404)
+    path = os.path.join(JOB_DIR, f"{job_id}.html")
+    if not os.path.exists(path):
+        abort(404, description='ジョブの結果が見つかりません。')
+    response = send_file(os.path.abspath(path), mimetype='text/html')
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/jobs/<job_id>')
+def api_job(job_id):
+    job = job_get(job_id)
+    if job is None:
+        return jsonify({'status': 'not_found'}), 404
+    return jsonify(job)
+
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def api_job_cancel(job_id):
+    if not job_cancel(job_id):
+        return jsonify({'error': '待ち中・実行中のジョブではありません'}), 400
+    return jsonify({'status': 'cancelling'})
+
+
+# ===== HTTP キャッシュ =====
+# 日別ページは「センサーCSV・品目CSVの mtime + 判定閾値 + アプリ本体」から ETag を作り、
+# If-None-Match / If-Modified-Since が一致すれば描画せずに 304 を返す。
+# 終わった日（昨日以前）は max-age を長くし、当日は毎回再検証させる。
+# 生成PNGは static_url() で ?v=<mtime> を付けて参照し、1年キャッシュ（immutable）にする。
+# HTML/JSON/テキストは Accept-Encoding に応じて brotli（あれば）か gzip で返す。
+
+HTTP_CLOSED_MAX_AGE = 86400            # 終わった日のページ
+HTTP_STATIC_MAX_AGE = 365 * 86400      # ?v= 付きの静的ファイル
+HTTP_COMPRESS_MIN   = 1024             # これより小さい応答は圧縮しない
+HTTP_COMPRESS_TYPES = ('text/html', 'application/json', 'text/plain', 'text/css',
+                       'application/javascript')
+HTTP_COMPRESS_CACHE = 64               # ETag 付き応答の圧縮結果を再利用する件数
+
+g_compress_cache = OrderedDict()       # {(etag, encoding): bytes}
+g_compress_lock  = threading.Lock()
+
+
+def _app_build_stamp():
+    """app.py とテンプレートの最新 mtime（デプロイで表示が変わったら ETag も変える）"""
+    latest = os.path.getmtime(os.path.abspath(__file__))
+    for root, _, files in os.walk(os.path.join(app.root_path, app.template_folder)):
+        for fn in files:
+            latest = max(latest, os.path.getmtime(os.path.join(root, fn)))
+    return str(int(latest))
+
+
+APP_BUILD = _app_build_stamp()
+
+
+def _validator(path, machine, key, mtimes, closed):
+    gen = sqlite_generation(machine['name'], key)
+    raw = f"{path}|{machine['name']}|{key}|{mtimes}|{gen}|{thresholds_fingerprint(machine)}|{APP_BUILD}"
+    etag = hashlib.sha1(raw.encode()).hexdigest()[:20]
+    return etag, datetime.fromtimestamp(int(max(mtimes)), timezone.utc), closed
+
+
+def day_validator(machine, date_str, path=''):
+    """日別ページ path の (etag, last_modified, closed)。その日のセンサーCSVがなければ None。"""
+    with g_day_index_lock:
+        info = _day_index(machine['name'])['days'].get(date_str)
+    if info is None:
+        return None
+    mtimes = [info[2]]
+    prefix = machine.get('hinmoku_prefix') or "A214"
+    try:
+        mtimes.append(os.path.getmtime(
+            os.path.join(HINMOKU_DIR, f"{prefix}_{date_str.replace('-', '')}.csv")))
+    except OSError:
+        pass
+    return _validator(path, machine, date_str, mtimes,
+                      date_str < datetime.now().strftime("%Y-%m-%d"))
+
+
+def month_validator(machine, year_month, path=''):
+    """月ページ path の (etag, last_modified, closed)。その月のセンサーCSVがなければ None。"""
+    with g_day_index_lock:
+        days = _day_index(machine['name'])['days']
+        mtimes = [v[2] for k, v in sorted(days.items()) if k[:7] == year_month]
+    if not mtimes:
+        return None
+    return _validator(path, machine, year_month, mtimes,
+                      year_month < datetime.now().strftime("%Y-%m"))
+
+
+def _render_page(render, etag, closed):
+    response = make_response(render())
+    body = response.get_data()
+    if response.status_code == 200 and closed and response.mimetype == 'text/html':
+        page_cache_put(etag, body)
+    return response.status_code, body, response.mimetype
+
+
+def _conditional_response(validator, render, page_cache=True, heavy=None, title=''):
+    """
+    検証子が一致すれば 304、終わった期間はページキャッシュ、どちらでもなければ render()。
+    同じページの描画が実行中なら、その結果を待って共有する。
+    page_cache=False（ストリーム返却のページ）は 304 判定と検証子の付与だけ行う。
+    heavy() が真なら render() の代わりにジョブを投入して進捗ページへリダイレクトする。
+    """
+    etag, last_modified, closed = validator
+    ims = request.if_modified_since
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        fresh = ims is not None and last_modified <= ims
+    if fresh:
+        response = Response(status=304)
+    elif not page_cache:
+        response = make_response(render())
+        if response.status_code != 200:
+            return response
+    else:
+        body = page_cache_get(etag) if closed else None
+        if body is not None:
+            response = Response(body, mimetype='text/html')
+        else:
+            redirect_to_job = _page_job_response(heavy, etag, title)
+            if redirect_to_job is not None:
+                return redirect_to_job
+            status, body, mimetype = single_flight(('page', etag), _render_page,
+                                                   render, etag, closed)
+            response = Response(body, status=status, mimetype=mimetype)
+            if status != 200:
+                return response
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    if closed:
+        response.cache_control.max_age = HTTP_CLOSED_MAX_AGE
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def _by_day(view, page_cache):
+    @functools.wraps(view)
+    def wrapper(machine_name, date, **kwargs):
+        v = day_validator(_get_machine_or_404(machine_name), date, request.full_path)
+        if v is None:
+            return view(machine_name, date, **kwargs)
+        heavy = getattr(view, 'heavy', None)
+        return _conditional_response(v, lambda: view(machine_name, date, **kwargs), page_cache,
+                                     heavy and (lambda: heavy(machine_name, date)),
+                                     f'{machine_name} {date} {request.path.rsplit("/", 1)[-1]}')
+    return wrapper
+
+
+def cache_by_day(view):
+    """/machine/<name>/date/<date>/... 用"""
+    return _by_day(view, page_cache=True)
+
 
-    return secs
+def revalidate_by_day(view):
+    """/machine/<name>/date/<date>/... のうちストリーム返却するページ用（304 判定のみ）"""
+    return _by_day(view, page_cache=False)
 
 
-def summarize_states_for_intervals(date_str, intervals, machine_name,
-                                    thresholds=None, current_threshold=None):
-    if not intervals:
-        return {k: 0 for k in ["自動加工中", "手動加工中", "加工完了", "アラーム", "停止"]}
-    total = {k: 0 for k in ["自動加工中", "手動加工中", "加工完了", "アラーム", "停止"]}
-    for s_dt, e_dt in intervals:
-        secs = summarize_states_for_interval(date_str, s_dt, e_dt, machine_name,
-                                              thresholds=thresholds,
-                                              current_threshold=current_threshold)
-        if secs is None:
-            continue
-        for k, v in secs.items():
-            total[k] += v
-    return total
+STREAM_FLUSH_BYTES = 8192   # ストリーム返却でまとめて書き出す大きさ
 
 
-def summarize_states_full_day_hours(date_str, machine_name,
-                                     thresholds=None, current_threshold=None):
-    csv_path = os.path.join(DATA_DIR, machine_name, f"{date_str}.csv")
-    if not os.path.exists(csv_path):
-        return None
-    states = ["自動加工中", "手動加工中", "加工完了", "アラーム", "停止"]
-    secs = {s: 0 for s in states}
-    with open(csv_path, newline='', encoding='utf-8') as f:
-        for row in csv.reader(f):
-            if len(row) < 5:
-                continue
-            try:
-                r, y, g, c = float(row[1]), float(row[2]), float(row[3]), float(row[4])
-                _, _, state, _ = get_light_status(r, y, g, c,
-                                                  thresholds=thresholds,
-                                                  current_threshold=current_threshold)
-                secs[state] += 60
-            except Exception:
-                continue
-    return {k: round(v / 3600.0, 2) for k, v in secs.items()}
+def stream_page(template_name, **context):
+    """
+    テンプレートを先頭から少しずつ送り出す。行データを generator で渡せば、
+    行数が増えても最初の1バイトまでの時間とメモリは一定。
+    """
+    def buffered(chunks):
+        buf, size = [], 0
+        for chunk in chunks:
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= STREAM_FLUSH_BYTES:
+                yield ''.join(buf)
+                buf, size = [], 0
+        yield ''.join(buf)
+    return Response(buffered(stream_template(template_name, **context)), mimetype='text/html')
+
+
+def cache_by_month(view):
+    """/machine/<name>/month/<ym>/... 用"""
+    @functools.wraps(view)
+    def wrapper(machine_name, year_month):
+        v = month_validator(_get_machine_or_404(machine_name), year_month, request.full_path)
+        if v is None:
+            return view(machine_name, year_month)
+        heavy = getattr(view, 'heavy', None)
+        return _conditional_response(v, lambda: view(machine_name, year_month), True,
+                                     heavy and (lambda: heavy(machine_name, year_month)),
+                                     f'{machine_name} {year_month} {request.path.rsplit("/", 1)[-1]}')
+    return wrapper
+
+
+@app.template_global()
+def static_url(filename):
+    """生成ファイルの URL に mtime を付ける（内容が変われば URL も変わる）"""
+    try:
+        v = int(os.path.getmtime(os.path.join("static", filename)))
+    except OSError:
+        return url_for('static', filename=filename)
+    return url_for('static', filename=filename, v=v)
+
+
+@app.after_request
+def _static_cache_headers(response):
+    if request.endpoint == 'static' and request.args.get('v') and response.status_code in (200, 304):
+        response.cache_control.public = True
+        response.cache_control.max_age = HTTP_STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+
+@app.after_request
+def _compress_response(response):
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in HTTP_COMPRESS_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    accept = request.accept_encodings
+    encoding = 'br' if HAS_BROTLI and accept['br'] else ('gzip' if accept['gzip'] else None)
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < HTTP_COMPRESS_MIN:
+        return response
+
+    etag, _ = response.get_etag()
+    key = (etag, encoding) if etag else None
+    body = None
+    if key:
+        with g_compress_lock:
+            body = g_compress_cache.get(key)
+            if body is not None:
+                g_compress_cache.move_to_end(key)
+    if body is None:
+        body = brotli.compress(data, quality=5) if encoding == 'br' else gzip.compress(data, 6)
+        if key:
+            with g_compress_lock:
+                g_compress_cache[key] = body
+                while len(g_compress_cache) > HTTP_COMPRESS_CACHE:
+                    g_compress_cache.popitem(last=False)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
 
 
 # ===== Flask Routes =====
@@ -895,14 +3911,14 @@ def index():
         machine_name      = m['name']
         thresholds        = m.get('patlite_thresholds', THRESHOLDS)
         curr_thresh       = m.get('current_threshold', CURRENT_THRESHOLD)
-        latest = get_latest_data(machine_name)
+        latest = _latest_from_memory(machine_name) or get_latest_data(machine_name)
 
         status_summary = None
         status_debug   = None
         if latest:
-            lights, machine_action, state, color = get_light_status(
+            lights, machine_action, state, color = classify_reading(
                 latest["red"], latest["yellow"], latest["green"], latest["current"],
-                thresholds=thresholds, current_threshold=curr_thresh
+                latest["mask"], thresholds=thresholds, current_threshold=curr_thresh
             )
             status_summary = {
                 "state":     state,
@@ -941,20 +3957,10 @@ def index():
         fiscal_start = datetime(now.year - 1, 4, 1)
     fiscal_end = fiscal_start.replace(year=fiscal_start.year + 1) - timedelta(days=1)
 
-    existing_days   = set()
-    existing_months = set()
+    existing_days = set()
     if selected_machine_name:
-        cal_dir = os.path.join(DATA_DIR, selected_machine_name)
-        if os.path.isdir(cal_dir):
-            for fname in os.listdir(cal_dir):
-                if fname.endswith(".csv"):
-                    try:
-                        date_obj = datetime.strptime(fname[:-4], "%Y-%m-%d")
-                        if fiscal_start <= date_obj <= fiscal_end:
-                            existing_days.add(date_obj.date())
-                            existing_months.add(date_obj.strftime("%Y-%m"))
-                    except Exception:
-                        continue
+        existing_days = set(sensor_days(selected_machine_name, fiscal_start.date(), fiscal_end.date()))
+    existing_months = {d.strftime("%Y-%m") for d in existing_days}
 
     calendar = {}
     current_day = fiscal_start
@@ -968,10 +3974,14 @@ def index():
         week = calendar[ym]["weeks"][-1]
         if len(week) == 0 and current_day.weekday() != 0:
             week.extend([None] * current_day.weekday())
+        date_str = current_day.strftime("%Y-%m-%d")
+        info = sensor_day_info(selected_machine_name, date_str) if current_day.date() in existing_days else None
         week.append({
-            "day":  current_day.day,
-            "date": current_day.strftime("%Y-%m-%d"),
-            "link": current_day.date() in existing_days
+            "day":     current_day.day,
+            "date":    date_str,
+            "link":    info is not None,
+            "partial": info is not None and info["partial"],
+            "ratio":   info["ratio"] if info else None
         })
         if current_day.weekday() == 6:
             calendar[ym]["weeks"].append([])
@@ -987,13 +3997,169 @@ def index():
         current_threshold=CURRENT_THRESHOLD,
         calendar=calendar,
         current_work=current_work,
+        fiscal_year=fiscal_start.year,
         today=today_str
     )
 
 
+@app.route("/api/status/stream")
+def status_stream():
+    """機械状態の Server-Sent Events。接続直後に全機械の直近状態、以降はポーリングごとに差分を送る。"""
+    global g_status_follow
+    q = queue.Queue(maxsize=100)
+    with g_status_lock:
+        g_status_subs.append(q)
+        snapshot = list(g_latest_status.values())
+        metric_set('gw_sse_clients', len(g_status_subs))
+        start_follow = not BACKGROUND_ENABLED and not g_status_follow
+        g_status_follow = g_status_follow or start_follow
+    if start_follow:
+        threading.Thread(target=status_follow_loop, daemon=True).start()
+
+    def sse(status):
+        return f"event: status\ndata: {json.dumps(status, ensure_ascii=False)}\n\n"
+
+    def generate():
+        try:
+            for st in snapshot:
+                yield sse(st)
+            while True:
+                try:
+                    st = q.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"   # プロキシ・ブラウザの無通信切断防止
+                    continue
+                yield sse(st)
+        finally:
+            with g_status_lock:
+                g_status_subs.remove(q)
+                metric_set('gw_sse_clients', len(g_status_subs))
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# ===== 月単位の並列計算 =====
+# 月ページ（overview / graph / summary）と月の作り直しは、日ごとの集計・グラフ描画をプロセスプールに分け、
+# 結果を親プロセスでまとめる（CSV の解析・状態判定・matplotlib は GIL を離さないのでスレッドでは並列にならない）。
+# ワーカーは spawn で作り、最初に使うときに起動して以後使い回す。判定閾値は引数で渡す。
+# fork だとポーリング・ジョブ・ログ等のスレッドが保持中のロックやログのキューをそのまま写してしまうので、
+# 新しいインタプリタで app を import し直し（GW_DISABLE_POLLING=1: スレッドを起動しない）、
+# 設定は親の config を initializer の引数で受け取る。
+# ワーカーで増えた counter / histogram（日別キャッシュのヒット・リングの読み出しなど）は結果と一緒に返し、
+# 親の /metrics に足し込む。日別デコードキャッシュはワーカーごとに持つ（上限はプロセスごと）。
+#   parallel:
+#     workers: 3        # 0: 並列化しない（リクエストのスレッドで直列に処理）
+
+PARALLEL_MIN_DAYS = 4       # これより少ない日数は直列に処理する
+
+g_pool      = None
+g_pool_lock = threading.Lock()
+
+
+def _parallel_workers():
+    return int((config.get('parallel') or {}).get('workers', 3))
+
+
+def _pool_worker_init(cfg):
+    """ワーカーの起動時: 親の設定（再読み込み後のものかもしれない）に差し替える"""
+    global config
+    config = cfg
+    metrics_take()                      # import 中に数えた分は親へ送らない
+
+
+def _process_pool():
+    global g_pool
+    workers = _parallel_workers()
+    if workers <= 0:
+        return None
+    with g_pool_lock:
+        if g_pool is None:
+            # spawn の子は親の環境変数を引き継ぐ。このプロセスは import 済みなので影響しない
+            os.environ['GW_DISABLE_POLLING'] = '1'
+            g_pool = ProcessPoolExecutor(max_workers=workers,
+                                         mp_context=multiprocessing.get_context('spawn'),
+                                         initializer=_pool_worker_init, initargs=(config,))
+        return g_pool
+
+
+def _pool_call(fn, *args):
+    """ワーカーで fn(*args) を実行し、(結果, その間に増えたメトリクス) を返す"""
+    return fn(*args), metrics_take()
+
+
+def parallel_map(fn, arg_list):
+    """
+    fn(*args) を arg_list の各要素についてプロセスプールで実行し、結果を同じ順のリストで返す。
+    workers=0・件数が少ない・ワーカーが落ちたときはこのスレッドで直列に実行する。
+    ジョブ内なら1件ごとに進捗を報告する（キャンセル要求があればそこで止まる）。
+    """
+    global g_pool
+    pool = _process_pool() if len(arg_list) >= PARALLEL_MIN_DAYS else None
+    total = len(arg_list)
+    if pool is not None:
+        try:
+            results = []
+            for r, taken in pool.map(_pool_call, [fn] * total, *zip(*arg_list)):
+                metrics_merge(taken)
+                results.append(r)
+                job_progress(int(len(results) / total * 100), f'{len(results)}/{total} 日')
+            return results
+        except BrokenProcessPool as e:
+            logger.warning(f'[parallel] ワーカーが異常終了したため直列で処理します: {e}')
+            with g_pool_lock:
+                if g_pool is pool:
+                    g_pool = None
+    results = []
+    for args in arg_list:
+        results.append(fn(*args))
+        job_progress(int(len(results) / total * 100), f'{len(results)}/{total} 日')
+    return results
+
+
+def _month_day_work(machine_name, date_str, thresholds, curr_thresh, summarize, render, force=False):
+    """
+    月ページ1日分の計算（ワーカーで実行）→ (date_str, 8-17時の状態別秒数, 24H の状態別時間, グラフの有無)
+    summarize=False なら集計は None、render=False ならグラフは描かない。force=True は描画済みでも描き直す。
+    """
+    secs_9h = hours_24h = None
+    if summarize:
+        start_dt = datetime.strptime(date_str, "%Y-%m-%d").replace(hour=8)
+        secs_9h = _summarize_states_for_interval(date_str, start_dt, start_dt.replace(hour=17),
+                                                 machine_name, thresholds, curr_thresh)
+        hours_24h = _summarize_states_full_day_hours(date_str, machine_name, thresholds, curr_thresh)
+    image = None
+    if render:
+        out_png_path = os.path.join("static", f"{machine_name}_{date_str}_graph.png")
+        image = _generate_graph_image(date_str, machine_name, None, None, out_png_path,
+                                      True, not force, thresholds, curr_thresh)
+    return date_str, secs_9h, hours_24h, image
+
+
+def rebuild_month(machine, year_month):
+    """
+    判定閾値の変更後などに、月の成果物（日別グラフ・月集計グラフ・月ページのキャッシュ）を作り直す。
+    作り直した日数を返す。
+    """
+    name = machine['name']
+    first = datetime.strptime(year_month, "%Y-%m").date()
+    last  = first.replace(day=monthrange(first.year, first.month)[1])
+    thresholds  = machine.get('patlite_thresholds', THRESHOLDS)
+    curr_thresh = machine.get('current_threshold', CURRENT_THRESHOLD)
+    days = sensor_days(name, first, last)
+    parallel_map(_month_day_work,
+                 [(name, str(d), thresholds, curr_thresh, False, True, True) for d in days])
+    client = app.test_client()
+    for view in ('overview', 'graph', 'summary'):
+        client.get(f"/machine/{name}/month/{year_month}/{view}", headers={'X-GW-Sync': '1'})
+    return len(days)
+
+
 # ===== /machine/<name>/month/<ym>/ =====
 
 @app.route("/machine/<machine_name>/month/<year_month>/overview")
+@cache_by_month
+@heavy_when(lambda machine_name, year_month: True)
 def show_month_overview(machine_name, year_month):
     machine = _get_machine_or_404(machine_name)
     thresholds    = machine.get('patlite_thresholds', THRESHOLDS)
@@ -1007,19 +4173,19 @@ def show_month_overview(machine_name, year_month):
     month  = target_month.month
     dd_max = monthrange(year, month)[1]
 
-    items = []
-    for day in range(1, dd_max + 1):
-        date_str = f"{year_month}-{day:02d}"
-        csv_path = os.path.join(DATA_DIR, machine_name, f"{date_str}.csv")
+    dates = [f"{year_month}-{day:02d}" for day in range(1, dd_max + 1)]
+    results = parallel_map(_month_day_work,
+                           [(machine_name, d, thresholds, curr_thresh, True, True)
+                            for d in dates if sensor_day_exists(machine_name, d)])
+    done = {r[0]: r for r in results}
 
+    items = []
+    for date_str in dates:
         durations      = None
         image_filename = None
 
-        if os.path.exists(csv_path):
-            durations = summarize_states_full_day_hours(date_str, machine_name,
-                                                        thresholds=thresholds,
-                                                        current_threshold=curr_thresh)
-            generate_graph_image(date_str, machine_name)
+        if date_str in done:
+            durations      = done[date_str][2]
             image_filename = f"{machine_name}_{date_str}_graph.png"
 
         items.append({
@@ -1034,31 +4200,24 @@ def show_month_overview(machine_name, year_month):
 
 
 @app.route("/machine/<machine_name>/month/<year_month>/graph")
+@cache_by_month
+@heavy_when(lambda machine_name, year_month: True)
 def show_month_graph(machine_name, year_month):
     machine = _get_machine_or_404(machine_name)
+    thresholds  = machine.get('patlite_thresholds', THRESHOLDS)
+    curr_thresh = machine.get('current_threshold', CURRENT_THRESHOLD)
     try:
         month_date = datetime.strptime(year_month, "%Y-%m")
     except Exception:
         abort(404)
 
-    year  = month_date.year
-    month = month_date.month
-    day   = 1
-    images = []
-
-    while True:
-        try:
-            current_date = datetime(year, month, day)
-        except Exception:
-            break
-        date_str = current_date.strftime("%Y-%m-%d")
-        csv_path = os.path.join(DATA_DIR, machine_name, f"{date_str}.csv")
-        image_filename = f"{machine_name}_{date_str}_graph.png"
-
-        if os.path.exists(csv_path):
-            generate_graph_image(date_str, machine_name)
-            images.append({"date": date_str, "image_filename": image_filename})
-        day += 1
+    dd_max = monthrange(month_date.year, month_date.month)[1]
+    dates  = [f"{year_month}-{day:02d}" for day in range(1, dd_max + 1)]
+    results = parallel_map(_month_day_work,
+                           [(machine_name, d, thresholds, curr_thresh, False, True)
+                            for d in dates if sensor_day_exists(machine_name, d)])
+    images = [{"date": r[0], "image_filename": f"{machine_name}_{r[0]}_graph.png"}
+              for r in results]
 
     if not images:
         abort(404)
@@ -1068,7 +4227,52 @@ def show_month_graph(machine_name, year_month):
                            year_month=year_month, images=images)
 
 
+def _render_month_summary_9h(machine_name, year_month, days, bar_values_pct,
+                             working_total_pct, out_png_path):
+    t0 = _time.perf_counter()
+    fig = new_figure(figsize=(16, 5))
+    ax = fig.add_subplot()
+
+    x      = days
+    width  = 0.13
+    offsets = {
+        "自動加工中": -2.5*width,
+        "手動加工中": -1.5*width,
+        "加工完了":   -0.5*width,
+        "アラーム":    0.5*width,
+        "停止":        1.5*width,
+        "未取得":      2.5*width,
+    }
+    colors = {
+        "自動加工中": "green",
+        "手動加工中": "blue",
+        "加工完了":   "yellow",
+        "アラーム":   "red",
+        "停止":       "gray",
+        "未取得":     "white",
+    }
+    for s in STATES:
+        xs = [v + offsets[s] for v in x]
+        ax.bar(xs, bar_values_pct[s], width=width, label=s, color=colors[s],
+               edgecolor="#999" if s == "未取得" else None, hatch="//" if s == "未取得" else None)
+
+    ax.plot(x, working_total_pct, marker="o", linestyle="-", label="稼働時間合計(%)")
+    ax.set_xticks(days, [str(d) for d in days])
+    ax.set_ylim(0, 100)
+    ax.set_xlabel("日")
+    ax.set_ylabel("稼働率(%)（9H=100%）")
+    ax.set_title(f"{machine_name} {year_month} 定時(8:00-17:00) 稼働率（9Hベース）")
+    ax.grid(True, axis="y", linestyle="--", linewidth=0.5)
+    ax.legend()
+    fig.tight_layout()
+
+    save_figure(fig, out_png_path)
+    metric_observe('gw_render_seconds', _time.perf_counter() - t0, kind='month_summary_9h')
+
+
 @app.route("/machine/<machine_name>/month/<year_month>/summary")
+@cache_by_month
+@heavy_when(lambda machine_name, year_month: True)
 def show_month_summary(machine_name, year_month):
     machine = _get_machine_or_404(machine_name)
     thresholds  = machine.get('patlite_thresholds', THRESHOLDS)
@@ -1078,7 +4282,7 @@ def show_month_summary(machine_name, year_month):
     except ValueError:
         abort(404)
 
-    states = ["自動加工中", "手動加工中", "加工完了", "アラーム", "停止"]
+    states = STATES
 
     summaries_9h  = {state: [] for state in states}
     labels_9h     = []
@@ -1089,25 +4293,14 @@ def show_month_summary(machine_name, year_month):
     if not os.path.isdir(machine_dir):
         abort(404, description="指定された機械のデータが見つかりませんでした")
 
-    for fname in sorted(os.listdir(machine_dir)):
-        if not fname.endswith(".csv"):
-            continue
-        try:
-            date_obj = datetime.strptime(fname[:-4], "%Y-%m-%d")
-        except ValueError:
-            continue
-        if date_obj.strftime("%Y-%m") != year_month:
-            continue
-
-        date_str = date_obj.strftime("%Y-%m-%d")
-        filepath = os.path.join(machine_dir, fname)
-
+    month_end = (target_month + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    # 日ごとの 9H（8:00-17:00）・24H 集計はプロセスプールで並列に計算する
+    results = parallel_map(_month_day_work,
+                           [(machine_name, str(day), thresholds, curr_thresh, True, False)
+                            for day in sensor_days(machine_name, target_month.date(),
+                                                   month_end.date())])
+    for date_str, secs_9h, hours_24h, _ in results:
         # 9H（8:00-17:00）
-        start_dt = datetime.combine(date_obj.date(), time(8, 0, 0))
-        end_dt   = datetime.combine(date_obj.date(), time(17, 0, 0))
-        secs_9h  = summarize_states_for_interval(date_str, start_dt, end_dt, machine_name,
-                                                  thresholds=thresholds,
-                                                  current_threshold=curr_thresh)
         if secs_9h is not None:
             labels_9h.append(date_str)
             for state in states:
@@ -1115,21 +4308,8 @@ def show_month_summary(machine_name, year_month):
 
         # 24H
         labels_24h.append(date_str)
-        durations_sec = {state: 0 for state in states}
-        with open(filepath, newline='', encoding='utf-8') as f:
-            for row in csv.reader(f):
-                if len(row) < 5:
-                    continue
-                try:
-                    r, y, g, c = float(row[1]), float(row[2]), float(row[3]), float(row[4])
-                    _, _, state, _ = get_light_status(r, y, g, c,
-                                                      thresholds=thresholds,
-                                                      current_threshold=curr_thresh)
-                    durations_sec[state] += 60
-                except Exception:
-                    continue
         for state in states:
-            summaries_24h[state].append(round(durations_sec[state] / 3600.0, 2))
+            summaries_24h[state].append(hours_24h.get(state, 0))
 
     if not labels_24h and not labels_9h:
         abort(404, description="指定された月にデータが見つかりませんでした")
@@ -1137,7 +4317,7 @@ def show_month_summary(machine_name, year_month):
     # 9H集計
     row_totals_9h    = {state: round(sum(summaries_9h[state]), 2) for state in states}
     num_days_9h      = len(labels_9h)
-    working_states   = ["自動加工中", "手動加工中", "加工完了"]
+    working_states   = WORKING_STATES
     column_totals_9h = []
     for i in range(num_days_9h):
         day_sum = sum(summaries_9h[s][i] for s in states if i < len(summaries_9h[s]))
@@ -1194,43 +4374,8 @@ def show_month_summary(machine_name, year_month):
     summary9_png  = f"{machine_name}_{year_month}_summary_9h.png"
     summary9_path = os.path.join("static", summary9_png)
 
-    set_japanese_font()
-    plt.figure(figsize=(16, 5))
-
-    x      = days
-    width  = 0.15
-    offsets = {
-        "自動加工中": -2*width,
-        "手動加工中": -1*width,
-        "加工完了":    0*width,
-        "アラーム":    1*width,
-        "停止":        2*width,
-    }
-    colors = {
-        "自動加工中": "green",
-        "手動加工中": "blue",
-        "加工完了":   "yellow",
-        "アラーム":   "red",
-        "停止":       "gray",
-    }
-    for s in states:
-        xs = [v + offsets[s] for v in x]
-        plt.bar(xs, bar_values_pct[s], width=width, label=s, color=colors[s])
-
-    plt.plot(x, working_total_pct, marker="o", linestyle="-", label="稼働時間合計(%)")
-    plt.xticks(days, [str(d) for d in days])
-    plt.ylim(0, 100)
-    plt.xlabel("日")
-    plt.ylabel("稼働率(%)（9H=100%）")
-    plt.title(f"{machine_name} {year_month} 定時(8:00-17:00) 稼働率（9Hベース）")
-    plt.grid(True, axis="y", linestyle="--", linewidth=0.5)
-    plt.legend()
-    plt.tight_layout()
-
-    if os.path.exists(summary9_path):
-        os.remove(summary9_path)
-    plt.savefig(summary9_path)
-    plt.close()
+    single_flight(('graph', summary9_path), _render_month_summary_9h,
+                  machine_name, year_month, days, bar_values_pct, working_total_pct, summary9_path)
 
     return render_template(
         "month/summary.html",
@@ -1255,9 +4400,90 @@ def show_month_summary(machine_name, year_month):
     )
 
 
+# ===== /machine/<name>/year/<fy>/ =====
+
+TREND_WIDTH_PX      = 1400   # 年度トレンドのグラフ描画幅
+TREND_PX_PER_BUCKET = 4      # 1バケットに割り当てる最小ピクセル数
+
+
+def _render_year_trend(machine_name, fiscal_year, res, aggs, out_png_path):
+    t0 = _time.perf_counter()
+    colors = {"自動加工中": "green", "手動加工中": "blue", "加工完了": "yellow",
+              "アラーム": "red", "停止": "gray", "未取得": "white"}
+    xs = [a['start'] for a in aggs]
+    pct = {s_: [] for s_ in STATES}
+    for a in aggs:
+        total = sum(a['sec'].values()) or 1
+        for s_ in STATES:
+            pct[s_].append(a['sec'][s_] / total * 100.0)
+
+    fig = new_figure(figsize=(TREND_WIDTH_PX / 100, 7))
+    ax1, ax2 = fig.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': [3, 1]})
+    if xs:
+        ax1.stackplot(xs, [pct[s_] for s_ in STATES], labels=STATES,
+                      colors=[colors[s_] for s_ in STATES], edgecolor='none')
+        cur_mean = [a['cur'][0] / a['n_current'] if a['n_current'] else float('nan') for a in aggs]
+        cur_max  = [a['cur'][1] if a['cur'][1] is not None else float('nan') for a in aggs]
+        ax2.plot(xs, cur_mean, label="電流 平均(A)")
+        ax2.plot(xs, cur_max, label="電流 最大(A)", linewidth=0.6)
+    ax1.set_xlim(datetime(fiscal_year, 4, 1), datetime(fiscal_year + 1, 4, 1))
+    ax1.set_ylim(0, 100)
+    ax1.set_ylabel("状態の割合(%)")
+    ax1.set_title(f"{machine_name} {fiscal_year}年度 稼働推移（{res}）")
+    ax1.legend(loc="upper left", ncol=len(STATES), fontsize=8)
+    ax2.set_ylabel("電流(A)")
+    ax2.legend(loc="upper left", fontsize=8)
+    ax2.grid(True, linestyle="--", linewidth=0.5)
+    fig.tight_layout()
+
+    save_figure(fig, out_png_path)
+    metric_observe('gw_render_seconds', _time.perf_counter() - t0, kind='year_trend')
+
+
+@app.route("/machine/<machine_name>/year/<int:fiscal_year>/trend")
+def show_year_trend(machine_name, fiscal_year):
+    """年度（4月〜翌3月）の稼働推移。ロールアップから描画幅に見合う粒度で読む。"""
+    machine = _get_machine_or_404(machine_name)
+    start = datetime(fiscal_year, 4, 1)
+    end   = datetime(fiscal_year + 1, 4, 1)
+    res = request.args.get('res') or None
+    if res is not None and res not in ('hour', 'day', 'week'):
+        abort(400, description="res は hour / day / week のいずれかです。")
+    res, aggs = query_rollup(machine, start, end, res=res,
+                             width_px=TREND_WIDTH_PX // TREND_PX_PER_BUCKET)
+
+    # 月別表は日集計をまとめる
+    _, days = query_rollup(machine, start, end, res='day')
+    months = {}
+    for a in days:
+        ym = a['start'].strftime("%Y-%m")
+        if ym not in months:
+            months[ym] = _rollup_new(a['start'].replace(day=1))
+        _rollup_merge(months[ym], a)
+    rows = []
+    for ym in sorted(months):
+        m = rollup_public(months[ym], 'day')
+        recorded = sum(v for k, v in m['hours'].items() if k != "未取得")
+        working  = round(sum(m['hours'][k] for k in WORKING_STATES), 2)
+        rows.append({'ym': ym, 'hours': m['hours'], 'working': working,
+                     'rate': round(working / recorded * 100.0, 1) if recorded else None,
+                     'current': m['current']})
+
+    image_filename = f"{machine_name}_FY{fiscal_year}_{res}_trend.png"
+    out_png_path = os.path.join("static", image_filename)
+    single_flight(('graph', out_png_path), _render_year_trend,
+                  machine_name, fiscal_year, res, aggs, out_png_path)
+    return render_template("year/trend.html",
+                           machine_name=machine_name, fiscal_year=fiscal_year,
+                           res=res, states=STATES, rows=rows,
+                           image_filename=image_filename)
+
+
 # ===== /machine/<name>/date/<date>/ =====
 
 @app.route("/machine/<machine_name>/date/<date>/overview")
+@cache_by_day
+@heavy_when(_many_hinmoku_rows)
 def show_date_overview(machine_name, date):
     machine = _get_machine_or_404(machine_name)
     thresholds  = machine.get('patlite_thresholds', THRESHOLDS)
@@ -1286,6 +4512,7 @@ def show_date_overview(machine_name, date):
     headers, records, _ = read_hinmoku_csv(date, hinmoku_prefix=hinmoku_prefix)
     if headers and records:
         for idx, row in enumerate(records, start=1):
+            job_progress(int(idx / len(records) * 100), f'品目 {idx}/{len(records)}')
             intervals = extract_intervals_from_row(date, row)
             if not intervals:
                 continue
@@ -1324,63 +4551,85 @@ def show_date_overview(machine_name, date):
                            date=date, year_month=year_month, items=items)
 
 
+def _fmt_reading(v):
+    """表示用: 欠測（None）は「—」"""
+    return "—" if v is None else v
+
+
+def _time_filter_args(date):
+    """?from=HH:MM / ?to=HH:MM → [start_dt, end_dt)。省略時はその日全体。"""
+    day_start, day_end = _day_range(date)
+
+    def parse(v, default):
+        if not v:
+            return default
+        if v == "24:00":
+            return day_end
+        try:
+            return datetime.combine(day_start.date(), datetime.strptime(v, "%H:%M").time())
+        except ValueError:
+            abort(400, description="時刻は HH:MM で指定してください。")
+    return parse(request.args.get('from'), day_start), parse(request.args.get('to'), day_end)
+
+
 @app.route("/machine/<machine_name>/date/<date>/table")
+@revalidate_by_day
 def show_table(machine_name, date):
-    machine = _get_machine_or_404(machine_name)
-    filepath = os.path.join(DATA_DIR, machine_name, f"{date}.csv")
-    if not os.path.exists(filepath):
+    _get_machine_or_404(machine_name)
+    if not sensor_day_exists(machine_name, date):
         abort(404)
-    rows = []
-    with open(filepath, newline='', encoding='utf-8') as f:
-        for row in csv.reader(f):
-            if len(row) < 5:
-                continue
-            rows.append({
-                "time": row[0], "red": row[1], "yellow": row[2],
-                "green": row[3], "current": row[4]
-            })
+    start_dt, end_dt = _time_filter_args(date)
+
+    def rows():
+        for t, red, yellow, green, current, mask in iter_sensor_rows(machine_name, date,
+                                                                     start_dt, end_dt):
+            yield {
+                "time": t.strftime("%H:%M:%S"),
+                "red": _fmt_reading(red), "yellow": _fmt_reading(yellow),
+                "green": _fmt_reading(green), "current": _fmt_reading(current)
+            }
     year_month = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m")
-    return render_template("date/sensor_data_list.html",
-                           machine_name=machine_name,
-                           date=date, year_month=year_month, rows=rows)
+    return stream_page("date/sensor_data_list.html",
+                       machine_name=machine_name, date=date, year_month=year_month,
+                       rows=rows(), time_from=request.args.get('from', ''),
+                       time_to=request.args.get('to', ''))
 
 
 @app.route("/machine/<machine_name>/date/<date>/status")
+@revalidate_by_day
 def show_status_table(machine_name, date):
     machine = _get_machine_or_404(machine_name)
     thresholds  = machine.get('patlite_thresholds', THRESHOLDS)
     curr_thresh = machine.get('current_threshold', CURRENT_THRESHOLD)
-    filepath = os.path.join(DATA_DIR, machine_name, f"{date}.csv")
-    if not os.path.exists(filepath):
+    if not sensor_day_exists(machine_name, date):
         abort(404)
-    rows = []
-    with open(filepath, newline='', encoding='utf-8') as f:
-        for row in csv.reader(f):
-            if len(row) < 5:
-                continue
-            red, yellow, green, current = (float(row[1]), float(row[2]),
-                                            float(row[3]), float(row[4]))
-            lights, machine_action, state, color = get_light_status(
-                red, yellow, green, current,
+    start_dt, end_dt = _time_filter_args(date)
+
+    def rows():
+        for t, red, yellow, green, current, mask in iter_sensor_rows(machine_name, date,
+                                                                     start_dt, end_dt):
+            lights, machine_action, state, color = classify_reading(
+                red, yellow, green, current, mask,
                 thresholds=thresholds, current_threshold=curr_thresh)
-            rows.append({
-                "time": row[0], "red": lights["red"], "yellow": lights["yellow"],
+            yield {
+                "time": t.strftime("%H:%M:%S"), "red": lights["red"], "yellow": lights["yellow"],
                 "green": lights["green"], "machine_action": machine_action,
                 "state": state, "color": color
-            })
+            }
     year_month = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m")
-    return render_template("date/status_list.html",
-                           machine_name=machine_name,
-                           date=date, year_month=year_month, rows=rows)
+    return stream_page("date/status_list.html",
+                       machine_name=machine_name, date=date, year_month=year_month,
+                       rows=rows(), time_from=request.args.get('from', ''),
+                       time_to=request.args.get('to', ''))
 
 
 @app.route("/machine/<machine_name>/date/<date>/graph")
+@cache_by_day
 def show_graph(machine_name, date):
     machine = _get_machine_or_404(machine_name)
     thresholds  = machine.get('patlite_thresholds', THRESHOLDS)
     curr_thresh = machine.get('current_threshold', CURRENT_THRESHOLD)
-    csv_path = os.path.join(DATA_DIR, machine_name, f"{date}.csv")
-    if not os.path.exists(csv_path):
+    if not sensor_day_exists(machine_name, date):
         abort(404)
 
     image_filename = f"{machine_name}_{date}_graph.png"
@@ -1397,32 +4646,17 @@ def show_graph(machine_name, date):
 
 
 @app.route("/machine/<machine_name>/date/<date>/summary")
+@cache_by_day
 def show_day_summary(machine_name, date):
     machine = _get_machine_or_404(machine_name)
     thresholds  = machine.get('patlite_thresholds', THRESHOLDS)
     curr_thresh = machine.get('current_threshold', CURRENT_THRESHOLD)
-    filepath = os.path.join(DATA_DIR, machine_name, f"{date}.csv")
-    if not os.path.exists(filepath):
+    if not sensor_day_exists(machine_name, date):
         abort(404)
 
-    states    = ["自動加工中", "手動加工中", "加工完了", "アラーム", "停止"]
-    durations = {state: 0 for state in states}
-
-    with open(filepath, newline='', encoding='utf-8') as f:
-        for row in csv.reader(f):
-            if len(row) < 5:
-                continue
-            try:
-                r, y, g, c = float(row[1]), float(row[2]), float(row[3]), float(row[4])
-                _, _, state, _ = get_light_status(r, y, g, c,
-                                                  thresholds=thresholds,
-                                                  current_threshold=curr_thresh)
-                durations[state] += 60
-            except Exception:
-                continue
-
-    for key in durations:
-        durations[key] = round(durations[key] / 3600, 2)
+    durations = summarize_states_full_day_hours(date, machine_name,
+                                                thresholds=thresholds,
+                                                current_threshold=curr_thresh)
 
     year_month = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m")
     return render_template("date/summary.html",
@@ -1431,6 +4665,7 @@ def show_day_summary(machine_name, date):
 
 
 @app.route("/machine/<machine_name>/date/<date>/hinmoku")
+@cache_by_day
 def show_hinmoku_for_date(machine_name, date):
     machine = _get_machine_or_404(machine_name)
     hinmoku_prefix = machine.get('hinmoku_prefix')
@@ -1461,6 +4696,7 @@ def show_hinmoku_for_date(machine_name, date):
 
 
 @app.route("/machine/<machine_name>/date/<date>/hinmoku/<int:hinmokuno>")
+@cache_by_day
 def show_hinmoku_graph(machine_name, date, hinmokuno):
     machine = _get_machine_or_404(machine_name)
     hinmoku_prefix = machine.get('hinmoku_prefix')
@@ -1496,6 +4732,7 @@ def show_hinmoku_graph(machine_name, date, hinmokuno):
 
 
 @app.route("/machine/<machine_name>/date/<date>/hinmoku/<int:hinmokuno>/summary")
+@cache_by_day
 def show_hinmoku_summary(machine_name, date, hinmokuno):
     machine = _get_machine_or_404(machine_name)
     thresholds     = machine.get('patlite_thresholds', THRESHOLDS)
@@ -1542,6 +4779,7 @@ def show_hinmoku_summary(machine_name, date, hinmokuno):
 
 
 @app.route("/machine/<machine_name>/date/<date>/hinmoku/<int:hinmokuno>/info")
+@cache_by_day
 def show_hinmoku_info(machine_name, date, hinmokuno):
     machine = _get_machine_or_404(machine_name)
     thresholds     = machine.get('patlite_thresholds', THRESHOLDS)
@@ -1675,7 +4913,9 @@ def _ota_recv(ser, timeout_sec=3.5):
     buf = bytearray()
     while _time.time() < deadline:
         if ser.in_waiting:
-            buf += ser.read(ser.in_waiting)
+            chunk = ser.read(ser.in_waiting)
+            metric_inc('gw_serial_rx_bytes_total', len(chunk))
+            buf += chunk
             if len(buf) >= 4 and buf[-2] == 0x0D and buf[-1] == 0x0A:
                 return bytes(buf)
         _time.sleep(0.005)
@@ -1695,10 +4935,13 @@ def _ota_worker(job_id, unit_addr, fw_bytes):
             g_ota_jobs[job_id].update({'progress': progress, 'status': status, 'message': message})
 
     update(0, 'running', 'OTA開始...')
+    t_start = _time.time()
     with g_ota_lock:
         job_info = g_ota_jobs.get(job_id, {})
+    fields = {'job': job_id, 'addr': unit_addr,
+              'machine': job_info.get('machine'), 'unit': job_info.get('unit')}
     logger.info(f'OTA開始: job={job_id[:8]} addr=0x{unit_addr:04X} size={total_size}B '
-                f'({job_info.get("machine","?")} / {job_info.get("unit","?")})')
+                f'({job_info.get("machine","?")} / {job_info.get("unit","?")})', extra=fields)
 
     try:
         with serial_lock:
@@ -1735,6 +4978,9 @@ def _ota_worker(job_id, unit_addr, fw_bytes):
                 if len(resp) >= 4 and resp[2:4] == b'UN':
                     err = resp[6] if len(resp) > 6 else 0
                     raise RuntimeError(f'NACK seq={seq} err=0x{err:02X}')
+                metric_inc('gw_ota_bytes_total', len(chunk))
+                metric_set('gw_ota_throughput_bytes_per_second',
+                           round((offset + len(chunk)) / max(_time.time() - t_start, 1e-3), 1))
                 _time.sleep(0.3)
                 progress = int((seq + 1) / num_chunks * 90) + 1
                 update(progress, 'running', f'{seq + 1}/{num_chunks} chunks')
@@ -1751,11 +4997,13 @@ def _ota_worker(job_id, unit_addr, fw_bytes):
             if len(resp) < 4 or resp[2:4] != b'UD':
                 raise RuntimeError(f'FIN unexpected response: {resp!r}')
             update(100, 'done', 'OTA完了。エッジが再起動中...')
-            logger.info(f'OTA完了: job={job_id[:8]} addr=0x{unit_addr:04X}')
+            g_no_combined.discard(unit_addr)   # 新ファームで 'A' / 'B' に対応した可能性があるため再判定
+            g_no_bulk.discard(unit_addr)
+            logger.info(f'OTA完了: job={job_id[:8]} addr=0x{unit_addr:04X}', extra=fields)
 
     except Exception as e:
         update(0, 'failed', str(e))
-        logger.error(f'OTA失敗: job={job_id[:8]} addr=0x{unit_addr:04X}: {e}')
+        logger.error(f'OTA失敗: job={job_id[:8]} addr=0x{unit_addr:04X}: {e}', extra=fields)
 
 
 # ===== メンテナンス =====
@@ -1905,23 +5153,810 @@ def ota_progress(job_id):
     return jsonify(safe)
 
 
+# ===== 全機械稼働レポート =====
+# 任意期間の「機械×月」稼働率（9H / 24H）とアラーム上位機械。ロールアップから集計する。
+# 初回はロールアップ作成で時間がかかるためバックグラウンドジョブで実行し、結果は
+# data/reports/<key>.json にキャッシュする（key = 期間 + 機械ごとの判定閾値）。
+# キャッシュは範囲内センサーCSVの最新 mtime が結果作成時より新しければ作り直す。
+
+REPORT_DIR  = "data/reports"
+REPORT_KEEP = 50          # キャッシュとして残す結果ファイル数
+REPORT_9H   = (8, 17)     # 定時 8:00〜17:00
+
+def _report_months(start_date, end_date):
+    months, d = [], start_date.replace(day=1)
+    while d <= end_date:
+        months.append(d)
+        d = (d + timedelta(days=32)).replace(day=1)
+    return months
+
+
+def report_key(start_date, end_date):
+    raw = json.dumps({'from': str(start_date), 'to': str(end_date),
+                      'machines': [[m['name'], thresholds_fingerprint(m)]
+                                   for m in config.get('machines', [])]}, sort_keys=True)
+    return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+
+def _report_source_mtime(start_date, end_date):
+    """範囲内センサーCSVの最新 mtime"""
+    lo, hi = str(start_date), str(end_date)
+    latest = 0.0
+    for m in config.get('machines', []):
+        with g_day_index_lock:
+            days = _day_index(m['name'])['days']
+            latest = max([latest] + [v[2] for k, v in days.items() if lo <= k <= hi])
+    return latest
+
+
+def load_cached_report(key, start_date=None, end_date=None):
+    """キャッシュ済みの結果。期間を渡すと鮮度も確認する（古ければ None）。"""
+    try:
+        with open(os.path.join(REPORT_DIR, f"{key}.json"), encoding='utf-8') as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if start_date and report.get('source_mtime', 0) < _report_source_mtime(start_date, end_date):
+        return None
+    return report
+
+
+def _report_cell(working_h, days, base_h):
+    return {'working_h': round(working_h, 2), 'days': days,
+            'util': round(working_h / (days * base_h) * 100.0, 1) if days else None}
+
+
+def build_fleet_report(start_date, end_date, progress=None):
+    """機械×月の稼働率（9H/24H）、機械ごとの合計、アラーム上位を集計する。"""
+    source_mtime = _report_source_mtime(start_date, end_date)
+    machines = list(config.get('machines', []))
+    months   = _report_months(start_date, end_date)
+    total    = max(1, len(machines) * len(months))
+    done     = 0
+    matrix, totals, alarms = {}, {}, []
+    fleet = {ym.strftime("%Y-%m"): {'w24': 0.0, 'd24': 0, 'w9': 0.0, 'd9': 0} for ym in months}
+
+    for m in machines:
+        name = m['name']
+        matrix[name] = {}
+        sum_w24 = sum_w9 = alarm_sec = 0.0
+        sum_d24 = sum_d9 = 0
+        for ym in months:
+            key = ym.strftime("%Y-%m")
+            ms = max(start_date, ym)
+            me = min(end_date, (ym + timedelta(days=32)).replace(day=1) - timedelta(days=1))
+            s_dt = datetime.combine(ms, time(0, 0))
+            e_dt = datetime.combine(me + timedelta(days=1), time(0, 0))
+            _, days  = query_rollup(m, s_dt, e_dt, res='day')
+            _, hours = query_rollup(m, s_dt, e_dt, res='hour')
+            w24 = sum(a['sec'][st] for a in days for st in WORKING_STATES) / 3600.0
+            d24 = len(days)
+            h9  = [a for a in hours if REPORT_9H[0] <= a['start'].hour < REPORT_9H[1]]
+            w9  = sum(a['sec'][st] for a in h9 for st in WORKING_STATES) / 3600.0
+            d9  = len({a['start'].date() for a in h9})
+            alarm_sec += sum(a['sec']["アラーム"] for a in days)
+            matrix[name][key] = {'24h': _report_cell(w24, d24, 24), '9h': _report_cell(w9, d9, 9)}
+            sum_w24 += w24
+            sum_d24 += d24
+            sum_w9  += w9
+            sum_d9  += d9
+            f = fleet[key]
+            f['w24'] += w24
+            f['d24'] += d24
+            f['w9']  += w9
+            f['d9']  += d9
+            done += 1
+            if progress:
+                progress(int(done / total * 100), f'{name} {key}')
+        totals[name] = {'24h': _report_cell(sum_w24, sum_d24, 24), '9h': _report_cell(sum_w9, sum_d9, 9)}
+
+        s_dt = datetime.combine(start_date, time(0, 0))
+        e_dt = datetime.combine(end_date + timedelta(days=1), time(0, 0))
+        st = event_stats(load_events(name, s_dt, e_dt), s_dt, e_dt)
+        alarms.append({'machine': name, 'count': st['counts']["アラーム"],
+                       'hours': round(alarm_sec / 3600.0, 2), 'mtbf_sec': st['mtbf_sec'],
+                       'longest_sec': st['longest'].get("アラーム", {}).get('sec')})
+
+    alarms.sort(key=lambda a: (a['hours'], a['count']), reverse=True)
+    return {
+        'from':         str(start_date),
+        'to':           str(end_date),
+        'generated':    datetime.now().strftime(EVENT_TS_FMT),
+        'source_mtime': source_mtime,
+        'months':       [ym.strftime("%Y-%m") for ym in months],
+        'machines':     [m['name'] for m in machines],
+        'matrix':       matrix,
+        'totals':       totals,
+        'fleet':        {k: {'24h': _report_cell(v['w24'], v['d24'], 24),
+                             '9h':  _report_cell(v['w9'], v['d9'], 9)} for k, v in fleet.items()},
+        'top_alarm':    alarms[:10],
+    }
+
+
+def _save_report(key, report):
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    path = os.path.join(REPORT_DIR, f"{key}.json")
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    files = sorted((os.path.join(REPORT_DIR, fn) for fn in os.listdir(REPORT_DIR)
+                    if fn.endswith('.json')), key=os.path.getmtime)
+    for old in files[:-REPORT_KEEP]:
+        try:
+            os.remove(old)
+        except FileNotFoundError:
+            pass
+
+
+def _report_job(key, start_date, end_date):
+    report = build_fleet_report(start_date, end_date, progress=job_progress)
+    _save_report(key, report)
+    return {'report_id': key, 'result_url': f'/report/{key}'}
+
+
+@app.route('/report')
+def report_page():
+    """全機械レポート: 期間フォーム（既定は当年度）"""
+    today = datetime.now().date()
+    fy = today.year if today.month >= 4 else today.year - 1
+    return render_template('report.html', report=None, report_id=None,
+                           default_from=f'{fy}-04-01', default_to=str(today))
+
+
+@app.route('/report/<report_id>')
+def report_view(report_id):
+    if not re.fullmatch(r'[0-9a-f]{16}', report_id):
+        abort(404)
+    report = load_cached_report(report_id)
+    if report is None:
+        abort(404, description='レポートが見つかりません（期限切れの可能性があります）。')
+    return render_template('report.html', report=report, report_id=report_id,
+                           default_from=report['from'], default_to=report['to'])
+
+
+@app.route('/api/report', methods=['POST'])
+def api_report_start():
+    """レポート作成を開始。キャッシュが新しければ即 done を返す。body: {"from": "YYYY-MM-DD", "to": "YYYY-MM-DD"}"""
+    body = request.get_json(force=True, silent=True) or {}
+    try:
+        start_date = datetime.strptime(body.get('from', ''), '%Y-%m-%d').date()
+        end_date   = datetime.strptime(body.get('to', ''), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': '日付の形式が不正です（YYYY-MM-DD）'}), 400
+    if end_date < start_date:
+        return jsonify({'error': '終了日が開始日より前です'}), 400
+
+    key = report_key(start_date, end_date)
+    if load_cached_report(key, start_date, end_date) is not None:
+        return jsonify({'status': 'done', 'report_id': key})
+
+    job_id = job_submit('report', key, f'全機械レポート {start_date}〜{end_date}',
+                        _report_job, key, start_date, end_date)
+    return jsonify({'status': 'running', 'job_id': job_id})
+
+
+@app.route('/api/report/progress/<job_id>')
+def api_report_progress(job_id):
+    """後方互換: /api/jobs/<job_id> と同じ"""
+    return api_job(job_id)
+
+
+# ===== メトリクス公開 =====
+
+@app.before_request
+def _metrics_request_start():
+    flask_g.req_t0 = _time.perf_counter()
+
+
+@app.before_request
+def _profile_request_start():
+    cfg = _profiling_cfg()
+    sig = request.args.get('profile')
+    forced = bool(sig and cfg.get('secret')
+                  and hmac.compare_digest(sig, profile_signature(request.path)))
+    if forced or cfg.get('enabled'):
+        flask_g.profiler = start_profile()
+        flask_g.profile_forced = forced
+
+
+@app.after_request
+def _metrics_request_end(response):
+    t0 = getattr(flask_g, 'req_t0', None)
+    if t0 is not None:
+        elapsed = _time.perf_counter() - t0
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metric_observe('gw_http_request_duration_seconds', elapsed,
+                       route=route, method=request.method, status=response.status_code)
+        prof = getattr(flask_g, 'profiler', None)
+        if prof is not None:
+            save_profile(prof, 'request', request.path, elapsed,
+                         forced=getattr(flask_g, 'profile_forced', False))
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    metric_set('gw_cmd_queue_depth', g_cmd_q.qsize())
+    metric_set('gw_poll_interval_seconds', config['poll_interval_sec'])
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+# ===== プロファイル一覧 =====
+
+@app.route('/profiles')
+def profiles_page():
+    entries = []
+    if os.path.isdir(PROFILE_DIR):
+        for fname in sorted((fn for fn in os.listdir(PROFILE_DIR) if fn.endswith('.prof')),
+                            reverse=True)[:20]:
+            meta = {}
+            try:
+                with open(os.path.join(PROFILE_DIR, fname + '.json'), encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                pass
+            try:
+                top = profile_top_functions(fname)
+            except Exception as e:
+                logger.warning(f'プロファイル読み込みエラー: {fname}: {e}')
+                continue
+            entries.append({'fname': fname, 'meta': meta, 'top': top})
+    return render_template('profiles.html', entries=entries,
+                           enabled=bool(_profiling_cfg().get('enabled')))
+
+
+@app.route('/profiles/<fname>')
+def profile_download(fname):
+    if not fname.endswith('.prof') or os.path.basename(fname) != fname:
+        abort(404)
+    path = os.path.join(PROFILE_DIR, fname)
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(path, as_attachment=True)
+
+
 # ===== ログ画面 =====
 
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40, 'CRITICAL': 50}
+_LOG_HEAD_RE = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d+ (\w+) ')
+
+
+def _log_files():
+    """ローテーション済みを含むログファイル一覧（古い順: app.log.5 … app.log.1, app.log）"""
+    files = []
+    for i in range(_fh.backupCount, 0, -1):
+        p = f'{LOG_FILE}.{i}'
+        if os.path.exists(p):
+            files.append(p)
+    if os.path.exists(LOG_FILE):
+        files.append(LOG_FILE)
+    return files
+
+
+def _tail_file(path, n, block=8192):
+    """ファイル末尾から後方にシークして最後の n 行を返す（ファイル全体は読まない）。"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        buf = b''
+        while pos > 0 and buf.count(b'\n') <= n:
+            step = min(block, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+    return buf.decode('utf-8', errors='replace').splitlines()[-n:]
+
+
+def tail_log(n):
+    """最新 n 行。app.log が n 行に満たなければローテーション済みファイルへ遡る。"""
+    lines = []
+    for path in reversed(_log_files()):
+        try:
+            lines = _tail_file(path, n - len(lines)) + lines
+        except FileNotFoundError:
+            continue   # 読み込み中にローテーションされた
+        if len(lines) >= n:
+            break
+    return lines
+
+
+def _parse_log_dt(v):
+    if not v:
+        return None
+    return datetime.strptime(v.replace('T', ' ')[:16], '%Y-%m-%d %H:%M')
+
+
+def search_log(level=None, machine=None, addr=None, since=None, until=None, job=None,
+               text=None, limit=1000):
+    """
+    ローテーション済みを含む全ログを古い順に1行ずつ走査し、条件に合うレコードを yield する。
+    タイムスタンプで始まらない行（トレースバック等）は直前のレコードの判定に従う。
+    """
+    min_level  = LOG_LEVELS.get((level or '').upper(), 0)
+    machine_re = re.compile(r'(?<![\w])' + re.escape(machine) + r'(?![\w])') if machine else None
+    addr       = addr.lower() if addr else None
+    job        = f'job={job[:8]}' if job else None
+    since_s    = since.strftime('%Y-%m-%d %H:%M:%S') if since else None
+    until_s    = until.strftime('%Y-%m-%d %H:%M:%S') if until else None
+
+    count = 0
+    for path in _log_files():
+        # 最終更新が since より前のファイルには該当行がない
+        if since and datetime.fromtimestamp(os.path.getmtime(path)) < since:
+            continue
+        matched = False
+        try:
+            f = open(path, encoding='utf-8', errors='replace')
+        except FileNotFoundError:
+            continue
+        with f:
+            for line in f:
+                line = line.rstrip('\n')
+                m = _LOG_HEAD_RE.match(line)
+                if m:
+                    ts, lv = m.group(1), m.group(2)
+                    if until_s and ts > until_s:
+                        return
+                    matched = (not (since_s and ts < since_s)
+                               and LOG_LEVELS.get(lv, 0) >= min_level
+                               and (machine_re is None or machine_re.search(line))
+                               and (addr is None or addr in line.lower())
+                               and (job is None or job in line)
+                               and (text is None or text in line))
+                if matched:
+                    yield line
+                    count += 1
+                    if count >= limit:
+                        return
+
+
 @app.route('/log')
 def log_page():
-    return render_template('log.html')
+    return render_template('log.html', machines=config['machines'])
 
 
 @app.route('/api/log')
 def api_log():
     n = request.args.get('n', 300, type=int)
-    lines = []
+    return jsonify({'lines': tail_log(max(1, min(n, 10000)))})
+
+
+@app.route('/api/log/stream')
+def api_log_stream():
+    """app.log の追記を Server-Sent Events で配信する（tail -F 相当、ローテーション追従）。"""
+    def generate():
+        f, inode, pending = None, None, ''
+        last_beat = _time.time()
+        try:
+            while True:
+                try:
+                    st = os.stat(LOG_FILE)
+                except FileNotFoundError:
+                    st = None
+                if st is not None and (f is None or st.st_ino != inode or st.st_size < f.tell()):
+                    # 初回は末尾から、ローテーション後は新ファイルの先頭から読む
+                    first = f is None
+                    if f is not None:
+                        f.close()
+                    f = open(LOG_FILE, encoding='utf-8', errors='replace')
+                    inode = st.st_ino
+                    if first:
+                        f.seek(0, os.SEEK_END)
+                if f is not None:
+                    chunk = f.read()
+                    if chunk:
+                        pending += chunk
+                        *lines, pending = pending.split('\n')
+                        for line in lines:
+                            yield f"data: {line}\n\n"
+                        last_beat = _time.time()
+                if _time.time() - last_beat > 15:
+                    yield ": keepalive\n\n"
+                    last_beat = _time.time()
+                _time.sleep(1.0)
+        finally:
+            if f is not None:
+                f.close()
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/log/search')
+def api_log_search():
+    """
+    全ログ（ローテーション済み含む）の絞り込み検索。マッチした行を text/plain でストリーム返却する。
+    パラメータ: level（以上）, machine, addr, since, until（YYYY-MM-DD HH:MM）, job, q, limit
+    """
     try:
-        with open(LOG_FILE, encoding='utf-8') as f:
-            lines = f.readlines()
-    except FileNotFoundError:
+        since = _parse_log_dt(request.args.get('since'))
+        until = _parse_log_dt(request.args.get('until'))
+    except ValueError:
+        return jsonify({'error': '日時の形式が不正です（YYYY-MM-DD HH:MM）'}), 400
+    if until is not None:
+        until += timedelta(seconds=59)
+    matches = search_log(level=request.args.get('level') or None,
+                         machine=request.args.get('machine') or None,
+                         addr=request.args.get('addr') or None,
+                         since=since, until=until,
+                         job=request.args.get('job') or None,
+                         text=request.args.get('q') or None,
+                         limit=request.args.get('limit', 1000, type=int))
+    return Response((line + '\n' for line in matches), mimetype='text/plain; charset=utf-8')
+
+
+# ===== 状態遷移イベント API =====
+
+def _event_range_args():
+    """?from= / ?to=（YYYY-MM-DD または YYYY-MM-DD HH:MM）。既定は当日0時〜現在。"""
+    def parse(v, default):
+        if not v:
+            return default
+        v = v.replace('T', ' ')
+        return datetime.strptime(v, '%Y-%m-%d') if len(v) == 10 else _parse_log_dt(v)
+    now = datetime.now()
+    start = parse(request.args.get('from'), datetime.combine(now.date(), time(0, 0)))
+    end   = parse(request.args.get('to'), now)
+    if len(request.args.get('to', '')) == 10:
+        end += timedelta(days=1)   # 日付指定はその日の終わりまで
+    return start, end
+
+
+@app.route('/api/events')
+def api_events():
+    """状態遷移イベント一覧。パラメータ: machine（必須）, from, to, state, merge=1（日付境界をつなぐ）"""
+    machine = _get_machine_or_404(request.args.get('machine', ''))
+    try:
+        start, end = _event_range_args()
+    except ValueError:
+        return jsonify({'error': '日時の形式が不正です（YYYY-MM-DD または YYYY-MM-DD HH:MM）'}), 400
+    events = load_events(machine['name'], start, end)
+    if request.args.get('merge'):
+        events = merge_events(events)
+    state = request.args.get('state')
+    if state:
+        events = [e for e in events if e[2] == state]
+    return jsonify({
+        'machine': machine['name'],
+        'from':    start.strftime(EVENT_TS_FMT),
+        'to':      end.strftime(EVENT_TS_FMT),
+        'events':  [{'start': s_.strftime(EVENT_TS_FMT), 'end': e_.strftime(EVENT_TS_FMT),
+                     'state': st, 'sec': sec} for s_, e_, st, sec in events],
+    })
+
+
+@app.route('/api/events/stats')
+def api_event_stats():
+    """状態ごとの件数・時間、MTBF/MTTR、最長の停止・アラーム。パラメータ: machine（必須）, from, to"""
+    machine = _get_machine_or_404(request.args.get('machine', ''))
+    try:
+        start, end = _event_range_args()
+    except ValueError:
+        return jsonify({'error': '日時の形式が不正です（YYYY-MM-DD または YYYY-MM-DD HH:MM）'}), 400
+    stats = event_stats(load_events(machine['name'], start, end), start, end)
+    return jsonify({'machine': machine['name'],
+                    'from': start.strftime(EVENT_TS_FMT), 'to': end.strftime(EVENT_TS_FMT),
+                    **stats})
+
+
+@app.route('/api/rollup')
+def api_rollup():
+    """
+    集計の取得。パラメータ: machine（必須）, from, to, res（minute/hour/day/week）,
+    width（res 未指定時: 描画幅[px]から粒度を自動選択、既定800）
+    """
+    machine = _get_machine_or_404(request.args.get('machine', ''))
+    try:
+        start, end = _event_range_args()
+    except ValueError:
+        return jsonify({'error': '日時の形式が不正です（YYYY-MM-DD または YYYY-MM-DD HH:MM）'}), 400
+    res = request.args.get('res') or None
+    if res is not None and res not in ROLLUP_RES:
+        return jsonify({'error': 'res は minute / hour / day / week のいずれかです'}), 400
+    res = res or pick_resolution(start, end, request.args.get('width', 800, type=int))
+    if res == 'minute' and end - start > timedelta(days=31):
+        return jsonify({'error': 'minute 粒度は31日以内で指定してください'}), 400
+    res, aggs = query_rollup(machine, start, end, res=res)
+    return jsonify({'machine': machine['name'], 'res': res,
+                    'from': start.strftime(EVENT_TS_FMT), 'to': end.strftime(EVENT_TS_FMT),
+                    'buckets': [rollup_public(a, res) for a in aggs]})
+
+
+# ===== データエクスポート API =====
+# 機械（複数可）× 期間のデータを CSV / JSON Lines / Parquet でストリーム返却する。
+# 機械×日（hour 粒度は機械×月のロールアップ）ごとに組み立てて送り出すので、
+# 何ヶ月分でもメモリに載るのは1日分だけ。Parquet は pyarrow がある場合のみ（1日分 = 1 row group）。
+
+EXPORT_MIMETYPES = {
+    'csv':     'text/csv; charset=utf-8',
+    'jsonl':   'application/x-ndjson; charset=utf-8',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def _export_columns(res, with_state):
+    """[(列名, pyarrow 型名)]"""
+    if res == 'minute':
+        cols = [('machine', 'string'), ('time', 'timestamp'), ('red', 'float'), ('yellow', 'float'),
+                ('green', 'float'), ('current', 'float'), ('mask', 'int')]
+        if with_state:
+            cols.append(('state', 'string'))
+    else:
+        cols = [('machine', 'string'), ('start', 'timestamp'), ('n_patlite', 'int'),
+                ('n_current', 'int')]
+        cols += [(f'{c}_mean', 'float') for c in LUX_KEYS]
+        cols += [('current_mean', 'float'), ('current_max', 'float')]
+        if with_state:
+            cols += [(f'hours_{s_}', 'float') for s_ in STATES]
+    return cols
+
+
+def _export_batches(machines, start, end, res, with_state):
+    """行（列順の値リスト）のリストを、機械×日（hour は機械×月）ごとに返す"""
+    for m in machines:
+        name = m['name']
+        if res == 'minute':
+            thresholds  = m.get('patlite_thresholds', THRESHOLDS)
+            curr_thresh = m.get('current_threshold', CURRENT_THRESHOLD)
+            for d in sensor_days(name, start.date(), (end - timedelta(seconds=1)).date()):
+                batch = []
+                for t, r, y, g, c, mask in iter_sensor_rows(name, str(d), start, end):
+                    row = [name, t, r, y, g, c, mask]
+                    if with_state:
+                        row.append(classify_reading(r, y, g, c, mask, thresholds=thresholds,
+                                                    current_threshold=curr_thresh)[2])
+                    batch.append(row)
+                if batch:
+                    yield batch
+            continue
+
+        chunk = start
+        while chunk < end:
+            nxt = min(end, (chunk.replace(day=1) + timedelta(days=32)).replace(
+                day=1, hour=0, minute=0, second=0, microsecond=0))
+            _, aggs = query_rollup(m, chunk, nxt, res='hour')
+            batch = []
+            for a in aggs:
+                pub = rollup_public(a, 'hour')
+                row = [name, a['start'], a['n_patlite'], a['n_current']]
+                row += [pub['lux'][c]['mean'] for c in LUX_KEYS]
+                row += [pub['current']['mean'], pub['current']['max']]
+                if with_state:
+                    row += [pub['hours'][s_] for s_ in STATES]
+                batch.append(row)
+            if batch:
+                yield batch
+            chunk = nxt
+
+
+def _export_value(v):
+    return v.strftime(EVENT_TS_FMT) if isinstance(v, datetime) else v
+
+
+def _export_csv(cols, batches):
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow([c for c, _ in cols])
+    for batch in batches:
+        w.writerows([['' if v is None else _export_value(v) for v in row] for row in batch])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+def _export_jsonl(cols, batches):
+    names = [c for c, _ in cols]
+    for batch in batches:
+        yield ''.join(json.dumps(dict(zip(names, map(_export_value, row))), ensure_ascii=False) + '\n'
+                      for row in batch)
+
+
+class _ChunkSink:
+    """ParquetWriter の書き込み先。書かれたバイト列を溜めて take() で取り出す。"""
+
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
         pass
-    return jsonify({'lines': [l.rstrip() for l in lines[-n:]]})
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _export_parquet(cols, batches):
+    types = {'string': pa.string(), 'timestamp': pa.timestamp('s'), 'float': pa.float64(),
+             'int': pa.int32()}
+    schema = pa.schema([(c, types[t]) for c, t in cols])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    for batch in batches:
+        columns = list(zip(*batch))
+        writer.write_table(pa.table([pa.array(col, type=schema.field(i).type)
+                                     for i, col in enumerate(columns)], schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+@app.route('/api/export')
+def api_export():
+    """
+    データのエクスポート。パラメータ: machine（カンマ区切り、省略時は全機械）, from, to,
+    format（csv / jsonl / parquet、既定 csv）, res（minute / hour、既定 minute）, state=1（状態判定を付ける）
+    """
+    names = [n for n in request.args.get('machine', '').split(',') if n]
+    machines = [_get_machine_or_404(n) for n in names] if names else list(config.get('machines', []))
+    try:
+        start, end = _event_range_args()
+    except ValueError:
+        return jsonify({'error': '日時の形式が不正です（YYYY-MM-DD または YYYY-MM-DD HH:MM）'}), 400
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_MIMETYPES:
+        return jsonify({'error': 'format は csv / jsonl / parquet のいずれかです'}), 400
+    if fmt == 'parquet' and not HAS_PYARROW:
+        return jsonify({'error': 'pyarrow がインストールされていないため parquet は使えません'}), 400
+    res = request.args.get('res', 'minute')
+    if res not in ('minute', 'hour'):
+        return jsonify({'error': 'res は minute / hour のいずれかです'}), 400
+    with_state = request.args.get('state') in ('1', 'true')
+
+    cols = _export_columns(res, with_state)
+    batches = _export_batches(machines, start, end, res, with_state)
+    body = {'csv': _export_csv, 'jsonl': _export_jsonl, 'parquet': _export_parquet}[fmt](cols, batches)
+    fname = f"export_{start.strftime('%Y%m%d%H%M')}_{end.strftime('%Y%m%d%H%M')}_{res}.{fmt}"
+    logger.info(f'[export] {fmt} {res} {start}〜{end} machines={[m["name"] for m in machines]}')
+    return Response(stream_with_context(body), mimetype=EXPORT_MIMETYPES[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="{fname}"'})
+
+
+# ===== 設定の再読み込み =====
+# config.yaml の mtime を check_sec ごとに確認し、変わっていれば読み直す。検証（read_config）に通らなければ
+# 今の設定のまま動かし続ける。通れば config を新しい dict に丸ごと差し替える（各処理は次に読むときから新しい設定）。
+# ポーリングは次の周期から機械の追加・削除を反映する。判定閾値（poll_interval_sec を含む）が変わった機械だけ、
+# 日別デコードキャッシュの判定結果・生成PNG・イベントログを作り直す。ページキャッシュ・ロールアップ・レポートは
+# キーに閾値のフィンガープリントが入っているので、そのままで別物になる。
+# serial_port / serial_baud の変更は再起動まで反映されない。
+#   config_reload:
+#     enabled: true
+#     check_sec: 5
+
+g_config_mtime       = None     # 今の設定を読んだときの config.yaml の mtime
+g_config_reload_lock = threading.Lock()
+
+metric_define('gw_config_reloads_total', 'counter', '設定の再読み込み回数（result=ok/invalid）')
+
+
+def _config_reload_cfg():
+    cfg = config.get('config_reload') or {}
+    return cfg.get('enabled', True), max(1, int(cfg.get('check_sec', 5)))
+
+
+def _config_mtime():
+    try:
+        return os.path.getmtime(CONFIG_PATH)
+    except OSError:
+        return None
+
+
+g_config_mtime = _config_mtime()
+
+
+def _invalidate_machine_outputs(name):
+    """判定閾値が変わった機械: このプロセスの判定結果と、生成PNG（ポーリング担当のみ）を捨てる"""
+    day_cache_drop_states(name)
+    if not BACKGROUND_ENABLED:
+        return 0
+    # 描画側のファイル名: <機械名>_<YYYY-MM-DD|YYYY-MM|FYyyyy>_<種類>.png
+    # （名前の前方一致だと A の変更で A_2 の PNG まで消してしまう）
+    png_re = re.compile(re.escape(name) + r'_(?:\d{4}-\d{2}(?:-\d{2})?|FY\d{4})_\w+\.png')
+    removed = 0
+    for fn in os.listdir("static") if os.path.isdir("static") else []:
+        if png_re.fullmatch(fn):
+            try:
+                os.remove(os.path.join("static", fn))
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def reload_config():
+    """
+    config.yaml を読み直して差し替える。
+    → {'added', 'removed', 'changed'}（機械名のリスト）。検証エラーなら {'error': 理由} で、設定は変えない。
+    """
+    global config, g_config_mtime, g_pool, g_job_slots
+    with g_config_reload_lock:
+        mtime = _config_mtime()
+        try:
+            new = read_config(CONFIG_PATH)
+        except Exception as e:
+            g_config_mtime = mtime          # 直るまで同じエラーを繰り返し出さない
+            metric_inc('gw_config_reloads_total', result='invalid')
+            logger.error(f'[config] 再読み込みを見送りました（今の設定のまま）: {e}')
+            return {'error': str(e)}
+        old = config
+        old_fp = {m['name']: thresholds_fingerprint(m, old) for m in old.get('machines', [])}
+        new_fp = {m['name']: thresholds_fingerprint(m, new) for m in new.get('machines', [])}
+        added   = [n for n in new_fp if n not in old_fp]
+        removed = [n for n in old_fp if n not in new_fp]
+        changed = [n for n in new_fp if n in old_fp and new_fp[n] != old_fp[n]]
+        config = new
+        g_config_mtime = mtime
+
+    for key in ('serial_port', 'serial_baud'):
+        if old.get(key) != new.get(key):
+            logger.warning(f'[config] {key} の変更は GW の再起動後に反映されます')
+    # プールのワーカーは起動時の設定を持っているので作り直させる。ジョブの同時実行数も読み直す
+    with g_pool_lock:
+        pool, g_pool = g_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False)
+    if (old.get('jobs') or {}).get('workers') != (new.get('jobs') or {}).get('workers'):
+        g_job_slots = None
+
+    pngs = sum(_invalidate_machine_outputs(n) for n in changed + removed)
+    if BACKGROUND_ENABLED:
+        with g_event_lock:
+            for name in changed + removed:
+                g_event_open.pop(name, None)       # 追いつき処理が終わるまで track_event は保留に回す
+            for name in removed:
+                g_event_pending.pop(name, None)
+        for name in added:
+            ring_seed(name)
+        rebuild = [m for m in new['machines'] if m['name'] in added + changed]
+        if rebuild:
+            threading.Thread(target=events_catch_up_all, args=(rebuild,), daemon=True).start()
+
+    metric_inc('gw_config_reloads_total', result='ok')
+    logger.info(f'[config] 設定を再読み込みしました: 追加={added} 削除={removed} 閾値変更={changed}'
+                f'（生成PNG {pngs} 件削除）')
+    return {'added': added, 'removed': removed, 'changed': changed}
+
+
+def config_watch_loop():
+    while True:
+        enabled, check_sec = _config_reload_cfg()
+        _time.sleep(check_sec)
+        if enabled and _config_mtime() != g_config_mtime:
+            reload_config()
+
+
+@app.route('/api/config/reload', methods=['POST'])
+def api_config_reload():
+    """config.yaml をすぐに読み直す（監視の周期を待たない）。検証エラーは 400。"""
+    result = reload_config()
+    if 'error' in result:
+        return jsonify(result), 400
+    return jsonify(result)
+
+
+# 前日分ページの事前描画（全ルート登録後に起動）
+if BACKGROUND_ENABLED:
+    threading.Thread(target=page_cache_warm_loop, daemon=True).start()
+    threading.Thread(target=archive_loop, daemon=True).start()
+
+# 設定ファイルの監視はポーリング担当以外のプロセス（Web ワーカー等）でも行う
+if HAS_YAML and os.environ.get('GW_DISABLE_POLLING') != '1':
+    threading.Thread(target=config_watch_loop, daemon=True).start()
 
 
 if __name__ == "__main__":
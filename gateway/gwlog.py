@@ -0,0 +1,66 @@
+"""
+GW共通ロギング（app.py / lora_logger.py / server_file_copy.py で共用）
+
+呼び出し側のスレッドは QueueHandler でキューに積むだけで、ファイル・コンソールへの実書き込みは
+QueueListener のバックグラウンドスレッドが行う。ポーリング・OTAスレッドが serial_lock を
+保持したまま SD カードへの書き込みでブロックしないようにするため。
+
+構造化フィールド（extra）は行末に付加される:
+    logger.warning('タイムアウト', extra={'machine': 'A214', 'addr': 0x0101, 'cmd': 'P'})
+    → "2026-01-01 12:00:00,000 WARNING タイムアウト [machine=A214 addr=0x0101 cmd=P]"
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s%(fields)s'
+FIELDS = ('machine', 'unit', 'addr', 'cmd', 'job')
+
+
+class _FieldsFilter(logging.Filter):
+    """extra で渡された構造化フィールドを %(fields)s に整形する。"""
+
+    def filter(self, record):
+        parts = []
+        for key in FIELDS:
+            value = getattr(record, key, None)
+            if value is None or value == '':
+                continue
+            if key == 'addr' and isinstance(value, int):
+                value = f'0x{value:04X}'
+            elif key == 'job':
+                value = str(value)[:8]
+            parts.append(f'{key}={value}')
+        record.fields = f" [{' '.join(parts)}]" if parts else ''
+        return True
+
+
+def setup_logger(name, log_file, max_bytes=2 * 1024 * 1024, backup_count=5, console=True):
+    """
+    キュー経由で書き込むロガーを作成し、(logger, file_handler) を返す。
+    file_handler はローテーション設定（backupCount 等）の参照用。
+    """
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    formatter = logging.Formatter(LOG_FORMAT)
+
+    fh = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    handlers = [fh]
+    if console:
+        handlers.append(logging.StreamHandler())
+    for h in handlers:
+        h.setFormatter(formatter)
+        h.addFilter(_FieldsFilter())
+
+    q = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)   # 終了時にキューを吐き出してから止める
+
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(logging.handlers.QueueHandler(q))
+    return logger, fh
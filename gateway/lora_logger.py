@@ -5,6 +5,12 @@ import datetime
 import csv
 import os
 
+from gwlog import setup_logger
+
+applog, _ = setup_logger(
+    'lora_logger',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'lora_logger.log'))
+
 class LoggerService:
     def __init__(self):
         self._lock = threading.Lock()
@@ -31,7 +37,7 @@ class LoggerService:
         self._thread.join()
 
     def _logging_loop(self):
-        print("logging start")
+        applog.info("logging start")
         while self._running:
             now = datetime.datetime.now()
             next_minute = (now + datetime.timedelta(minutes=1)).replace(second=0, microsecond=0)
@@ -45,11 +51,7 @@ class LoggerService:
                 green = self._lux_green
                 current = self._current_value
             
-            print("csv write")
-            print(red)
-            print(yellow)
-            print(green)
-            print(current)
+            applog.info(f"csv write red={red} yellow={yellow} green={green} current={current}")
             timestamp = datetime.datetime.now().strftime("%H:%M:%S")
             date_str = datetime.datetime.now().strftime("%Y-%m-%d")
 
@@ -65,7 +67,7 @@ class LoggerService:
                     writer = csv.writer(f)
                     writer.writerow(line)
             except Exception as e:
-                print(f"ログ書き込みエラー: {e}")
+                applog.error(f"ログ書き込みエラー: {e}")
 
 def data_receive_action(data, logger):
     if len(data) < 4:
@@ -84,35 +86,33 @@ def data_receive_action(data, logger):
                     float_bytes = data[4:last_index + 1]
                     float_str = bytes(float_bytes).decode("ascii")
                     current = float(float_str)
-                    print(current)
+                    applog.info(f"current={current}", extra={'cmd': 'C'})
                     logger.set_current_value(current)
                     break
         except Exception as e:
-            print(f"電流変換失敗: {e}")
+            applog.warning(f"電流変換失敗: {e}", extra={'cmd': 'C'})
 
     elif mode == 'D':
         if len(data) >= 10:
             red = (data[4] << 8) | data[5]
             yellow = (data[6] << 8) | data[7]
             green = (data[8] << 8) | data[9]
-            print(red)
-            print(yellow)
-            print(green)
+            applog.info(f"red={red} yellow={yellow} green={green}", extra={'cmd': 'D'})
             logger.set_pat_light_values(red, yellow, green)
 
 def main():
-    print("start main")
+    applog.info("start main")
     logger = LoggerService()
     try:
         with serial.Serial("/dev/ttyUSB0", 9600, timeout=1) as ser:
             while True:
                 if ser.in_waiting:
                     data = ser.read_until(b'\r\n')
-                    print(data)
+                    applog.info(f"recv {data!r}")
                     if data:
                         data_receive_action(data, logger)
     except KeyboardInterrupt:
-        print("終了します")
+        applog.info("終了します")
     finally:
         logger.stop()
 
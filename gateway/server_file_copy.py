@@ -6,9 +6,10 @@ import tempfile
 import shutil
 import subprocess
 from pathlib import Path
-from datetime import datetime
 import hashlib
 
+from gwlog import setup_logger
+
 # ===== Config (ASCII only) =====
 SERVER_IP   = "172.20.11.20"
 SHARE_NAME  = "\u5168\u793e\u516c\u958b\u60c5\u5831"  # "全社公開情報"
@@ -29,9 +30,11 @@ INTERVAL_SEC = 60
 SMBCLIENT    = "smbclient"
 # ===============================
 
+logger, _ = setup_logger("server_file_copy",
+                         str(Path(__file__).resolve().parent / "logs" / "server_file_copy.log"))
+
 def log(msg: str) -> None:
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{now}] {msg}", flush=True)
+    logger.info(msg)
 
 def run(cmd, **kwargs) -> subprocess.CompletedProcess:
     kwargs.setdefault("check", True)
@@ -118,7 +121,7 @@ def main() -> None:
     try:
         run([SMBCLIENT, "-V"], capture_output=True)
     except Exception:
-        print("smbclient not found. Install it with: sudo apt install smbclient", flush=True)
+        logger.error("smbclient not found. Install it with: sudo apt install smbclient")
         raise SystemExit(1)
 
     log(f"Start watching //{SERVER_IP}/{SHARE_NAME}/{REMOTE_PATH} -> {DEST_DIR}")
@@ -126,14 +129,14 @@ def main() -> None:
         try:
             one_cycle()
         except subprocess.CalledProcessError as e:
-            log(f"ERROR: command failed (rc={e.returncode})")
-            log(f"cmd: {e.cmd}")
+            logger.error(f"command failed (rc={e.returncode})")
+            logger.error(f"cmd: {e.cmd}")
             if e.stdout:
-                log(f"stdout: {e.stdout}")
+                logger.error(f"stdout: {e.stdout}")
             if e.stderr:
-                log(f"stderr: {e.stderr}")
+                logger.error(f"stderr: {e.stderr}")
         except Exception as e:
-            log(f"ERROR: {e}")
+            logger.error(f"{e}")
         time.sleep(INTERVAL_SEC)
 
 if __name__ == "__main__":
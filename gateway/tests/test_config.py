@@ -0,0 +1,43 @@
+"""
+read_config の検証（機械・ユニットアドレスの重複）
+
+    cd gateway && python -m pytest -q tests
+"""
+
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault('GW_DISABLE_POLLING', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def _write(tmp_path, machines):
+    lines = ['gw_addr: 0x0000', 'poll_interval_sec: 60', 'machines:']
+    for name, patlite, current in machines:
+        lines += [f'  - name: {name}', f'    patlite_addr: {patlite}', f'    current_addr: {current}']
+    path = tmp_path / 'config.yaml'
+    path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    return str(path)
+
+
+def test_shared_unit_within_one_machine_is_allowed(tmp_path):
+    cfg = app.read_config(_write(tmp_path, [('A214', '0x0101', '0x0101'),
+                                            ('A215', '0x0201', '0x0202')]))
+    assert [(m['patlite_addr'], m['current_addr']) for m in cfg['machines']] == \
+        [(0x0101, 0x0101), (0x0201, 0x0202)]
+
+
+def test_address_used_by_another_machine_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match='0x0101 が機械 A214'):
+        app.read_config(_write(tmp_path, [('A214', '0x0101', '0x0101'),
+                                          ('A215', '0x0201', '0x0101')]))
+
+
+def test_duplicate_machine_name_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match='名前が重複'):
+        app.read_config(_write(tmp_path, [('A214', '0x0101', '0x0102'),
+                                          ('A214', '0x0201', '0x0202')]))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+rebuild_months.py  –  月の成果物（日別グラフ・月集計グラフ・月ページ）の作り直し
+
+判定閾値（patlite_thresholds / current_threshold）を変えたあとなどに、
+指定範囲の月について日別グラフを描き直し、月別ページ（概要・グラフ・集計）を再生成する。
+日ごとの計算は app.py の parallel_map でプロセスプールに分ける（--workers で並列数を指定）。
+
+使い方:
+    python3 tools/rebuild_months.py                               # 全機械・データのある全月
+    python3 tools/rebuild_months.py --machine A214 --from 2026-04 --to 2026-09
+    python3 tools/rebuild_months.py --workers 0                   # 逐次で実行
+
+    --workdir で data/ の相対パスの基準ディレクトリを指定できる（デフォルト: gateway/）。
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+GATEWAY_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gateway"))
+
+
+def load_app(workdir):
+    os.environ["GW_DISABLE_POLLING"] = "1"
+    os.chdir(workdir)
+    sys.path.insert(0, GATEWAY_DIR)
+    import app
+    return app
+
+
+def parse_month(s):
+    return datetime.strptime(s, "%Y-%m").date() if s else None
+
+
+def months_with_data(app, name, month_from, month_to):
+    months = sorted({d.strftime("%Y-%m") for d in app.sensor_days(name, month_from, None)})
+    if month_to:
+        months = [ym for ym in months if ym <= month_to.strftime("%Y-%m")]
+    return months
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="月の日別グラフ・月ページの作り直し")
+    parser.add_argument("--workdir", default=GATEWAY_DIR, help="GW の作業ディレクトリ（data/ の基準）")
+    parser.add_argument("--machine", help="機械名（省略時は全機械）")
+    parser.add_argument("--from", dest="month_from", help="開始月 YYYY-MM")
+    parser.add_argument("--to",   dest="month_to",   help="終了月 YYYY-MM")
+    parser.add_argument("--workers", type=int, help="並列プロセス数（省略時は config.yaml の parallel.workers）")
+    args = parser.parse_args()
+
+    app = load_app(args.workdir)
+    if args.workers is not None:
+        app.config["parallel"] = {"workers": args.workers}
+    machines = app.config.get("machines", [])
+    if args.machine:
+        machines = [m for m in machines if m["name"] == args.machine]
+        if not machines:
+            print(f"[ERROR] 機械 '{args.machine}' が config.yaml にありません")
+            sys.exit(1)
+
+    t0 = time.time()
+    total = 0
+    for machine in machines:
+        for ym in months_with_data(app, machine["name"], parse_month(args.month_from), parse_month(args.month_to)):
+            t1 = time.time()
+            n = app.rebuild_month(machine, ym)
+            total += n
+            print(f"  {machine['name']} {ym}: {n} 日 / {time.time() - t1:.1f} 秒")
+    print(f"作り直し完了: {total} 日 / {time.time() - t0:.1f} 秒")
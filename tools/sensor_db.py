@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+sensor_db.py  –  センサーデータの保管（SQLite バックエンド・アーカイブ）用ツール
+
+data/sensor/<機械名>/YYYY-MM-DD.csv を SQLite（storage.sqlite_path）に取り込み、
+CSV と SQLite で月集計にかかる時間を比較する。
+終わった月の CSV を書庫（data/archive/<機械名>.zip）へ移す処理を、GW の定時実行を待たずに行う。
+app.py を GW_DISABLE_POLLING=1 で import するので、GW 稼働中に実行してもポーリングとは競合しない
+（DB は WAL モードのため、取り込み中も GW 側の読み書きは継続できる）。
+
+使い方:
+    python3 tools/sensor_db.py import                         # 全機械・全日を取り込み
+    python3 tools/sensor_db.py import --machine A214 --from 2026-04-01
+    python3 tools/sensor_db.py bench --machine A214 --month 2026-09
+    python3 tools/sensor_db.py archive                        # config.yaml の archive 設定で実行
+    python3 tools/sensor_db.py archive --before 2026-01-01    # この日より前をすべて書庫へ
+
+    --workdir で data/ の相対パスの基準ディレクトリを指定できる（デフォルト: gateway/）。
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+GATEWAY_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gateway"))
+
+
+def load_app(workdir):
+    os.environ["GW_DISABLE_POLLING"] = "1"
+    os.chdir(workdir)
+    sys.path.insert(0, GATEWAY_DIR)
+    import app
+    return app
+
+
+def parse_date(s):
+    return datetime.strptime(s, "%Y-%m-%d").date() if s else None
+
+
+def cmd_import(app, args):
+    names = [args.machine] if args.machine else [m["name"] for m in app.config.get("machines", [])]
+    t0 = time.time()
+    total = 0
+    for name in names:
+        days = app.sensor_days(name, parse_date(args.date_from), parse_date(args.date_to))
+        for i, d in enumerate(days, start=1):
+            n = app.sqlite_import_day(name, str(d))
+            total += n
+            print(f"\r  {name}: {i}/{len(days)} 日 ({d}, {n} 行)", end="", flush=True)
+        print()
+    print(f"取り込み完了: {total} 行 / {time.time() - t0:.1f} 秒")
+
+
+def _month_summary(app, machine, year_month):
+    """show_month_summary と同じ集計（9H + 24H）を1ヶ月分行う"""
+    thresholds  = machine.get("patlite_thresholds", app.THRESHOLDS)
+    curr_thresh = machine.get("current_threshold", app.CURRENT_THRESHOLD)
+    first = datetime.strptime(year_month, "%Y-%m")
+    last  = (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    for d in app.sensor_days(machine["name"], first.date(), last.date()):
+        date_str = str(d)
+        start_dt = datetime.combine(d, datetime.min.time()).replace(hour=8)
+        app._summarize_states_for_interval(date_str, start_dt, start_dt.replace(hour=17),
+                                           machine["name"], thresholds, curr_thresh)
+        app._summarize_states_full_day_hours(date_str, machine["name"], thresholds, curr_thresh)
+
+
+def cmd_bench(app, args):
+    machine = next((m for m in app.config.get("machines", []) if m["name"] == args.machine), None)
+    if machine is None:
+        print(f"[ERROR] 機械 '{args.machine}' が config.yaml にありません")
+        sys.exit(1)
+    storage = app.config.setdefault("storage", {})
+    original = storage.get("backend", "csv")
+    app.config["day_cache"] = {"memory_mb": 0}       # 毎回デコードさせる
+    print(f"{args.machine} {args.month} 月集計（{args.repeat} 回の中央値）")
+    try:
+        for backend in ("csv", "sqlite"):
+            storage["backend"] = backend
+            times = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                _month_summary(app, machine, args.month)
+                times.append(time.perf_counter() - t0)
+            times.sort()
+            print(f"  {backend:7s} {times[len(times) // 2] * 1000:8.1f} ms")
+    finally:
+        storage["backend"] = original
+
+
+def cmd_archive(app, args):
+    if args.before:
+        names = [args.machine] if args.machine else [m["name"] for m in app.config.get("machines", [])]
+        before = parse_date(args.before)
+        for name in names:
+            print(f"  {name}: {app.archive_machine(name, before)} 日")
+        return
+    total, pruned = app.archive_run()
+    print(f"書庫へ移動: {total} 日 / 生成PNG削除: {pruned} 件")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="センサーデータ SQLite 取り込み・ベンチマーク")
+    parser.add_argument("--workdir", default=GATEWAY_DIR, help="GW の作業ディレクトリ（data/ の基準）")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_imp = sub.add_parser("import", help="data/sensor の CSV を SQLite に取り込む")
+    p_imp.add_argument("--machine", help="機械名（省略時は全機械）")
+    p_imp.add_argument("--from", dest="date_from", help="開始日 YYYY-MM-DD")
+    p_imp.add_argument("--to",   dest="date_to",   help="終了日 YYYY-MM-DD")
+
+    p_bench = sub.add_parser("bench", help="CSV と SQLite で月集計の所要時間を比較する")
+    p_bench.add_argument("--machine", required=True, help="機械名")
+    p_bench.add_argument("--month",   required=True, help="対象月 YYYY-MM")
+    p_bench.add_argument("--repeat",  default=5, type=int, help="繰り返し回数（デフォルト: 5）")
+
+    p_arc = sub.add_parser("archive", help="終わった月の CSV を書庫へ移し、古い生成PNGを消す")
+    p_arc.add_argument("--machine", help="機械名（--before 指定時のみ。省略時は全機械）")
+    p_arc.add_argument("--before",  help="この日（YYYY-MM-DD）より前を書庫へ（省略時は config.yaml の keep_months）")
+
+    args = parser.parse_args()
+    app = load_app(args.workdir)
+    {"import": cmd_import, "bench": cmd_bench, "archive": cmd_archive}[args.cmd](app, args)